@@ -0,0 +1,95 @@
+"""Bulk order submission and batch auction benchmark.
+
+Market makers refresh --quotes two-sided quotes per update: every update
+cancels the maker's previous quotes and posts new ones around a drifting
+mid price. The same update stream is applied once with one place_order /
+cancel_order call per order and once with one submit_batch call per
+update. Then --auction-orders orders are collected for a token in auction
+mode and cleared with run_auction:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_batch_auction.py --updates 500 --quotes 200
+"""
+import argparse
+import time
+
+import numpy as np
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain
+
+DecentralizedExchange = EnhancedQuantumFuseBlockchain.DecentralizedExchange
+
+
+def quote_updates(updates: int, quotes: int, makers: int, seed: int):
+    rng = np.random.default_rng(seed)
+    mid = 100 + np.cumsum(rng.normal(0, 0.05, updates))
+    for i in range(updates):
+        is_buy = np.arange(quotes) % 2 == 0
+        offsets = np.round(rng.uniform(0.01, 1.0, quotes), 2)
+        prices = np.round(np.where(is_buy, mid[i] - offsets, mid[i] + offsets), 2)
+        yield f"maker-{i % makers}", rng.integers(1, 100, quotes), prices, is_buy
+
+
+def bench_single(args):
+    exchange = DecentralizedExchange()
+    live = {}
+    count = 0
+    start = time.perf_counter()
+    for maker, amounts, prices, is_buy in quote_updates(args.updates, args.quotes, args.makers, 7):
+        for order_id in live.get(maker, ()):
+            exchange.cancel_order(order_id)
+        live[maker] = [exchange.place_order(maker, "QFT", amount, price, buy)
+                       for amount, price, buy in zip(amounts.tolist(), prices.tolist(), is_buy.tolist())]
+        count += len(amounts)
+    elapsed = time.perf_counter() - start
+    print(f"single calls  {count / elapsed:10,.0f} orders/s  ({exchange.stats['trades']:,} trades)")
+    return count / elapsed
+
+
+def bench_bulk(args):
+    exchange = DecentralizedExchange()
+    live = {}
+    count = 0
+    start = time.perf_counter()
+    for maker, amounts, prices, is_buy in quote_updates(args.updates, args.quotes, args.makers, 7):
+        result = exchange.submit_batch("QFT", [maker] * len(amounts), amounts, prices, is_buy,
+                                       cancels=live.get(maker, ()))
+        live[maker] = result["order_id"][result["remaining"] > 0].tolist()
+        count += len(amounts)
+    elapsed = time.perf_counter() - start
+    print(f"submit_batch  {count / elapsed:10,.0f} orders/s  ({exchange.stats['trades']:,} trades)")
+    return count / elapsed
+
+
+def bench_auction(args):
+    exchange = DecentralizedExchange()
+    exchange.set_auction_mode("QFT")
+    rng = np.random.default_rng(11)
+    n = args.auction_orders
+    is_buy = rng.random(n) < 0.5
+    prices = np.round(rng.normal(100, 2, n), 2)
+    exchange.submit_batch("QFT", ["trader"] * n, rng.integers(1, 100, n), prices, is_buy)
+    start = time.perf_counter()
+    result = exchange.run_auction("QFT")
+    elapsed = time.perf_counter() - start
+    book = exchange.order_book["QFT"]
+    print(f"auction       {n:,} orders on {len(book.bids) + len(book.asks):,} levels left cleared in"
+          f" {elapsed * 1e3:.1f} ms: price {result['price']}, volume {result['volume']:,},"
+          f" {len(result['fills']['amount']):,} fills")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--quotes", type=int, default=200, help="orders per quote update")
+    parser.add_argument("--makers", type=int, default=10)
+    parser.add_argument("--auction-orders", type=int, default=200_000)
+    args = parser.parse_args()
+
+    single = bench_single(args)
+    bulk = bench_bulk(args)
+    print(f"bulk speedup  {bulk / single:.2f}x")
+    bench_auction(args)
+
+
+if __name__ == "__main__":
+    main()
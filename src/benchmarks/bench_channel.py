@@ -0,0 +1,114 @@
+"""Peer channel benchmark.
+
+Compares the old send path (a fresh TCP connection plus one RSA-OAEP
+operation per message) against the session-keyed PeerTransport over
+loopback:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_channel.py --count 2000
+
+RSA-OAEP with a 2048-bit key cannot carry more than 190 bytes, so the
+legacy path is measured with small messages only.
+"""
+import argparse
+import queue
+import socket
+import statistics
+import threading
+import time
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from quantumfuse_node import PeerTransport
+
+OAEP = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+
+def listening_socket() -> socket.socket:
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(("127.0.0.1", 0))
+    server_socket.listen(128)
+    return server_socket
+
+
+def report(name: str, size: int, elapsed: float, latencies):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<10} {size:>7} B  {len(latencies) / elapsed:10,.0f} msg/s"
+          f"  latency mean {statistics.mean(latencies) * 1e6:9.1f} us  p99 {p99 * 1e6:9.1f} us")
+
+
+def bench_legacy(private_key, count: int, size: int):
+    server_socket = listening_socket()
+    received = queue.Queue()
+
+    def serve():
+        for _ in range(count):
+            client, _ = server_socket.accept()
+            with client:
+                ciphertext = client.recv(4096)
+            private_key.decrypt(ciphertext, OAEP)
+            received.put(time.perf_counter())
+
+    threading.Thread(target=serve, daemon=True).start()
+    address = server_socket.getsockname()
+    public_key = private_key.public_key()
+    message = b"x" * size
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(count):
+        sent = time.perf_counter()
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.connect(address)
+            s.sendall(public_key.encrypt(message, OAEP))
+        latencies.append(received.get() - sent)
+    report("legacy", size, time.perf_counter() - start, latencies)
+    server_socket.close()
+
+
+def bench_session(private_key, count: int, size: int):
+    received = queue.Queue()
+    receiver = PeerTransport(lambda payload, peer: received.put(time.perf_counter()), private_key)
+    server_socket = listening_socket()
+    receiver.start(server_socket)
+    sender = PeerTransport(lambda payload, peer: None, private_key)
+    sender.start()
+    address = server_socket.getsockname()
+    message = b"x" * size
+
+    # Open the connection and complete the handshake outside the timed region.
+    sender.send_threadsafe(address, message)
+    received.get()
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(count):
+        sent = time.perf_counter()
+        sender.send_threadsafe(address, message)
+        latencies.append(received.get() - sent)
+    report("session", size, time.perf_counter() - start, latencies)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        sender.send_threadsafe(address, message)
+    for _ in range(count):
+        received.get()
+    elapsed = time.perf_counter() - start
+    print(f"{'pipelined':<10} {size:>7} B  {count / elapsed:10,.0f} msg/s")
+    sender.stop()
+    receiver.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=2000, help="messages per measurement")
+    args = parser.parse_args()
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    bench_legacy(private_key, args.count, 150)
+    for size in (150, 4096, 65536):
+        bench_session(private_key, args.count, size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Cross-shard transfer benchmark.
+
+Drives the CrossShardCoordinator with a mix of intra- and cross-shard
+transfers from --threads client threads, mining a block on every shard
+after each --block-interval transfers so receipts are batched per block:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_cross_shard.py --transfers 50000 --cross-ratio 0.5
+"""
+import argparse
+import random
+import threading
+import time
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain, StateStore, Transaction
+
+
+def mine_all(shards, coordinator):
+    for shard in shards:
+        coordinator.apply_receipts(shard.shard_id)
+        block = shard.create_block("miner")
+        if block is not None:
+            shard.add_block(block)
+            coordinator.on_block(shard.shard_id, block)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--accounts", type=int, default=10_000)
+    parser.add_argument("--transfers", type=int, default=50_000)
+    parser.add_argument("--cross-ratio", type=float, default=0.5)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--block-interval", type=int, default=2000, help="transfers between blocks")
+    args = parser.parse_args()
+
+    shards = [EnhancedQuantumFuseBlockchain.Shard(i, max_block_transactions=args.block_interval)
+              for i in range(args.shards)]
+    state = StateStore()
+    coordinator = EnhancedQuantumFuseBlockchain.CrossShardCoordinator(shards, state)
+    accounts_by_shard = {shard.shard_id: [] for shard in shards}
+    for i in range(args.accounts):
+        address = f"account-{i}"
+        state.credit("QFC", address, 1_000_000)
+        accounts_by_shard[coordinator.get_shard_id(address)].append(address)
+
+    rng = random.Random(7)
+    transfers = []
+    for i in range(args.transfers):
+        source = rng.randrange(args.shards)
+        destination = source
+        if rng.random() < args.cross_ratio:
+            destination = rng.choice([s for s in range(args.shards) if s != source])
+        transfers.append(Transaction(rng.choice(accounts_by_shard[source]),
+                                     rng.choice(accounts_by_shard[destination]), 1.0, nonce=i))
+    for tx in transfers:
+        tx.calculate_hash()
+
+    chunks = [transfers[i::args.threads] for i in range(args.threads)]
+    done = [0]
+    lock = threading.Lock()
+
+    def client(chunk):
+        for tx in chunk:
+            coordinator.initiate_cross_shard_transaction(tx)
+            with lock:
+                done[0] += 1
+                if done[0] % args.block_interval == 0:
+                    mine_all(shards, coordinator)
+
+    coordinator.reset_metrics()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(chunk,)) for chunk in chunks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    mine_all(shards, coordinator)
+    mine_all(shards, coordinator)
+    elapsed = time.perf_counter() - start
+
+    metrics = coordinator.metrics()
+    committed = metrics.get("intra_shard", 0) + metrics.get("cross_shard", 0)
+    print(f"{args.transfers} transfers, {args.cross_ratio:.0%} cross-shard, {args.shards} shards, "
+          f"{args.threads} threads: {committed / elapsed:,.0f} committed tx/s in {elapsed:.2f}s")
+    print(f"intra-shard {metrics.get('intra_shard', 0):>7}  {metrics['intra_shard_tps']:10,.0f} tx/s")
+    print(f"cross-shard {metrics.get('cross_shard', 0):>7}  {metrics['cross_shard_tps']:10,.0f} tx/s"
+          f"  prepare->commit {metrics['mean_commit_latency_ms'] * 1e3:.1f} us")
+    print(f"receipts    {metrics.get('receipt_entries', 0):>7} in {metrics.get('receipt_batches', 0)} batches"
+          f" ({metrics['receipts_per_batch']:.0f}/batch), pending {sum(metrics['pending_receipts'].values())}")
+    print(f"aborted     {sum(v for k, v in metrics.items() if k.startswith('aborted_'))}")
+
+
+if __name__ == "__main__":
+    main()
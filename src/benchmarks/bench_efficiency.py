@@ -0,0 +1,80 @@
+"""Consensus efficiency model benchmark.
+
+Feeds --blocks synthetic block records through GreenProofOfWork.record_block
+and adjust_difficulty, retraining the ConsensusEfficiencyModel every
+--retrain-interval blocks, once with the refit done inline on the mining
+thread and once in the background process, and reports the per-block
+stall each adds to mining. Then compares one-row predictions against a
+single batched call:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_efficiency.py --blocks 5000
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain
+
+ConsensusEfficiencyModel = EnhancedQuantumFuseBlockchain.AIOptimizer.ConsensusEfficiencyModel
+GreenProofOfWork = EnhancedQuantumFuseBlockchain.GreenConsensus.GreenProofOfWork
+
+
+def run(label: str, args, background: bool):
+    model = ConsensusEfficiencyModel(buffer_size=args.buffer, retrain_interval=args.retrain_interval,
+                                     n_estimators=args.estimators, background=background)
+    pow_engine = GreenProofOfWork(initial_difficulty=3, adjustment_interval=10)
+    pow_engine.efficiency_model = model
+    rng = random.Random(7)
+
+    def mine_block():
+        block_time = pow_engine.target_block_time * 2 ** (pow_engine.difficulty - 3) * rng.uniform(0.5, 1.5)
+        pow_engine.record_block(block_time, rng.choice(pow_engine.renewable_energy_sources))
+        pow_engine.adjust_difficulty()
+
+    # Both runs start from a trained model, so both pay for predictions in adjust_difficulty.
+    for _ in range(args.retrain_interval - 1):
+        pow_engine.difficulty = rng.randint(1, 5)
+        mine_block()
+    model.train(*model.samples())
+    stalls = []
+    for _ in range(args.blocks):
+        start = time.perf_counter()
+        mine_block()
+        stalls.append(time.perf_counter() - start)
+    model.wait()
+    model.shutdown()
+    stalls.sort()
+    print(f"{label:<11} {args.blocks} blocks, model v{model.version}: per block mean {np.mean(stalls) * 1e3:7.3f} ms"
+          f"  p99 {stalls[int(len(stalls) * 0.99)] * 1e3:7.3f} ms  max {stalls[-1] * 1e3:8.1f} ms"
+          f"  total {sum(stalls):6.2f}s")
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--blocks", type=int, default=5000)
+    parser.add_argument("--buffer", type=int, default=4096)
+    parser.add_argument("--retrain-interval", type=int, default=256)
+    parser.add_argument("--estimators", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=300, help="rows for the prediction comparison")
+    args = parser.parse_args()
+
+    run("inline", args, background=False)
+    model = run("background", args, background=True)
+
+    rows = np.random.default_rng(7).random((args.rows, 5))
+    start = time.perf_counter()
+    for row in rows:
+        model.predict_efficiency(list(row))
+    single = time.perf_counter() - start
+    start = time.perf_counter()
+    model.predict(rows)
+    batched = time.perf_counter() - start
+    print(f"predict {args.rows} rows: one at a time {single / args.rows * 1e6:8.1f} us/row,"
+          f" batched {batched / args.rows * 1e6:6.1f} us/row ({single / batched:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
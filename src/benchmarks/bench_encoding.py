@@ -0,0 +1,100 @@
+"""Transaction/Block encoding benchmark.
+
+Compares the original dict-backed, JSON-hashed Transaction against the
+__slots__ Transaction with its fixed-layout binary encoding:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_encoding.py --count 100000
+
+Memory is measured with tracemalloc for --count pending transactions and
+scaled to 1M.
+"""
+import argparse
+import hashlib
+import json
+import time
+import tracemalloc
+from typing import Any, Dict
+
+from quantumfuse_blockchain import Block, Transaction
+
+
+class LegacyTransaction:
+    # The pre-__slots__ Transaction: a plain object hashed through sorted JSON.
+    def __init__(self, sender: str, recipient: str, amount: float, asset: str = "QFC"):
+        self.sender = sender
+        self.recipient = recipient
+        self.amount = amount
+        self.asset = asset
+        self.timestamp = time.time()
+        self.signature = ""
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "sender": self.sender,
+            "recipient": self.recipient,
+            "amount": self.amount,
+            "asset": self.asset,
+            "timestamp": self.timestamp,
+            "signature": self.signature
+        }
+
+    def calculate_hash(self) -> str:
+        transaction_string = json.dumps(self.to_dict(), sort_keys=True)
+        return hashlib.sha256(transaction_string.encode()).hexdigest()
+
+
+def measure_memory(cls, count: int) -> float:
+    senders = [f"sender-{i % 1000}" for i in range(1000)]
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    pending = [cls(senders[i % 1000], "recipient", float(i), "QFC") for i in range(count)]
+    used = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(baseline, "filename"))
+    tracemalloc.stop()
+    del pending
+    return used / count
+
+
+def measure_rate(fn, items) -> float:
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return len(items) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=100_000, help="pending transactions to allocate")
+    args = parser.parse_args()
+
+    legacy_bytes = measure_memory(LegacyTransaction, args.count)
+    slotted_bytes = measure_memory(Transaction, args.count)
+    print(f"memory per 1M pending transactions: legacy {legacy_bytes * 1e6 / 2**20:8.1f} MiB"
+          f"  slots {slotted_bytes * 1e6 / 2**20:8.1f} MiB")
+
+    sample = min(args.count, 50_000)
+    legacy = [LegacyTransaction("Alice", "Bob", float(i)) for i in range(sample)]
+    slotted = [Transaction("Alice", "Bob", float(i)) for i in range(sample)]
+    rates = [
+        ("encode", measure_rate(lambda tx: json.dumps(tx.to_dict(), sort_keys=True).encode(), legacy),
+         measure_rate(Transaction.to_bytes, slotted)),
+        ("hash (cold)", measure_rate(LegacyTransaction.calculate_hash, legacy),
+         measure_rate(Transaction.calculate_hash, slotted)),
+        ("hash (repeat)", measure_rate(LegacyTransaction.calculate_hash, legacy),
+         measure_rate(Transaction.calculate_hash, slotted)),
+    ]
+    for name, before, after in rates:
+        print(f"{name:<14} legacy {before:12,.0f} tx/s  binary {after:12,.0f} tx/s  ({after / before:5.1f}x)")
+
+    json_size = sum(len(json.dumps(tx.to_dict()).encode()) for tx in slotted[:1000]) / 1000
+    binary_size = sum(len(tx.to_bytes()) for tx in slotted[:1000]) / 1000
+    print(f"wire size      json   {json_size:12.1f} B     binary {binary_size:12.1f} B")
+
+    block = Block(1, slotted[:1000], "0" * 64)
+    start = time.perf_counter()
+    for _ in range(1000):
+        block.calculate_hash()
+    print(f"block header hash (1000 tx block): {1000 / (time.perf_counter() - start):,.0f} hashes/s")
+
+
+if __name__ == "__main__":
+    main()
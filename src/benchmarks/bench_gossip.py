@@ -0,0 +1,117 @@
+"""Gossip propagation benchmark.
+
+Starts --nodes QuantumFuseNodes on loopback, wires them into a random graph
+of --degree peers each, injects --transactions signed transactions at
+random nodes and measures how long each takes to reach every node and how
+many bytes the network spent doing it:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_gossip.py --nodes 16 --degree 4
+
+The "push" figure is what the previous full-payload broadcast would have
+sent for the same graph: every body to every peer of every node that
+accepted it.
+"""
+import argparse
+import random
+import statistics
+import threading
+import time
+from collections import Counter
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from quantumfuse_blockchain import Transaction
+from quantumfuse_node import QuantumFuseNode
+
+
+def build_network(count: int, degree: int, fanout: int, public_key):
+    nodes = [QuantumFuseNode("127.0.0.1", 0, stake=0.8, gossip_fanout=fanout) for _ in range(count)]
+    for node in nodes:
+        node.identity_registry["Alice"] = public_key
+        node.start(interactive=False)
+    # A ring keeps the graph connected; random chords bring every node up to the target degree.
+    edges = {(i, (i + 1) % count) for i in range(count)}
+    while len(edges) < count * degree // 2:
+        a, b = random.sample(range(count), 2)
+        if (b, a) not in edges:
+            edges.add((a, b))
+    for a, b in edges:
+        nodes[a].peers.append(nodes[b].address)
+        nodes[b].peers.append(nodes[a].address)
+    return nodes, len(edges)
+
+
+def record_arrivals(nodes, arrivals, done, total):
+    lock = threading.Lock()
+    for node in nodes:
+        original = node.broadcast_transactions
+
+        def broadcast(transactions, exclude=None, original=original):
+            now = time.perf_counter()
+            with lock:
+                for transaction in transactions:
+                    arrivals[transaction.calculate_hash()].append(now)
+                    if len(arrivals[transaction.calculate_hash()]) == total:
+                        done.release()
+            original(transactions, exclude)
+
+        node.broadcast_transactions = broadcast
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=16)
+    parser.add_argument("--degree", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=8, help="peers each node announces to")
+    parser.add_argument("--transactions", type=int, default=200)
+    args = parser.parse_args()
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    nodes, edge_count = build_network(args.nodes, args.degree, args.fanout, key.public_key())
+    arrivals = {}
+    done = threading.Semaphore(0)
+    record_arrivals(nodes, arrivals, done, args.nodes)
+
+    transactions = []
+    for i in range(args.transactions):
+        tx = Transaction("Alice", f"recipient-{i}", 1.0 + i, nonce=i)
+        tx.sign_transaction(key)
+        transactions.append(tx)
+        arrivals[tx.calculate_hash()] = []
+
+    latencies = []
+    start = time.perf_counter()
+    for tx in transactions:
+        injected = time.perf_counter()
+        random.choice(nodes).add_transaction(tx.to_dict())
+        if not done.acquire(timeout=30):
+            print(f"transaction {tx.calculate_hash()[:16]} reached only "
+                  f"{len(arrivals[tx.calculate_hash()])}/{args.nodes} nodes")
+            continue
+        latencies.append(max(arrivals[tx.calculate_hash()]) - injected)
+    elapsed = time.perf_counter() - start
+
+    stats = Counter()
+    for node in nodes:
+        stats.update(node.gossip_stats)
+        stats.update({"bytes_sent": node.transport.stats["bytes_sent"]})
+    body_size = len(nodes[0].relay_cache.get(transactions[0].calculate_hash()))
+    push_bytes = body_size * 2 * edge_count
+
+    latencies.sort()
+    print(f"{args.nodes} nodes, {edge_count} links, fanout {args.fanout}, {len(latencies)} transactions in {elapsed:.1f}s")
+    print(f"full propagation  mean {statistics.mean(latencies) * 1e3:7.1f} ms"
+          f"  p50 {latencies[len(latencies) // 2] * 1e3:7.1f} ms  max {latencies[-1] * 1e3:7.1f} ms")
+    print(f"per transaction   inv {stats['inv_sent'] / args.transactions:6.1f}"
+          f"  getdata {stats['getdata_sent'] / args.transactions:6.1f}"
+          f"  bodies {stats['bodies_sent'] / args.transactions:6.1f}"
+          f"  duplicates dropped {stats['duplicates_dropped'] / args.transactions:6.1f}")
+    print(f"bytes/transaction gossip {stats['bytes_sent'] / args.transactions:9,.0f}"
+          f"  push {push_bytes:9,.0f}  (body {body_size} B)")
+
+    for node in nodes:
+        node.stop()
+
+
+if __name__ == "__main__":
+    main()
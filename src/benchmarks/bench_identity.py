@@ -0,0 +1,96 @@
+"""Identity registry benchmark.
+
+Registers --users identities from PEM public keys, then verifies
+--transactions signed transactions from random senders, once parsing the
+sender's stored PEM for every check and twice through
+DecentralizedIdentity.get_public_keys with a key cache of --cache-size,
+starting cold. Also times bulk attribute verification and saving and
+reloading the registry:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_identity.py --users 2000 --transactions 5000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain, SignatureVerifier, Transaction
+
+DecentralizedIdentity = EnhancedQuantumFuseBlockchain.DecentralizedIdentity
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--transactions", type=int, default=5000)
+    parser.add_argument("--cache-size", type=int, default=10_000)
+    parser.add_argument("--distinct-keys", type=int, default=20, help="RSA keys shared round-robin by the users")
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    private_keys = [rsa.generate_private_key(public_exponent=65537, key_size=2048) for _ in range(args.distinct_keys)]
+    users = [f"user-{i}" for i in range(args.users)]
+    with tempfile.TemporaryDirectory() as directory:
+        identities = DecentralizedIdentity(os.path.join(directory, "identities.json"), cache_size=args.cache_size)
+        for i, user in enumerate(users):
+            identities.create_identity(user, DecentralizedIdentity.encode_public_key(
+                private_keys[i % args.distinct_keys].public_key()))
+            identities.add_attribute(user, "kyc", "verified" if i % 3 else "pending")
+
+        transactions = []
+        for _ in range(args.transactions):
+            i = rng.randrange(args.users)
+            transaction = Transaction(users[i], "merchant", rng.randint(1, 100))
+            transaction.sign_transaction(private_keys[i % args.distinct_keys])
+            transactions.append(transaction)
+        verifier = SignatureVerifier(max_workers=1)
+
+        start = time.perf_counter()
+        keys = [serialization.load_pem_public_key(identities.identities[t.sender]["public_key"].encode())
+                for t in transactions]
+        parse_time = time.perf_counter() - start
+        assert all(verifier.verify_batch(transactions, keys))
+        start = time.perf_counter()
+        keys = identities.get_public_keys(t.sender for t in transactions)
+        cold_time = time.perf_counter() - start
+        assert all(verifier.verify_batch(transactions, keys))
+        start = time.perf_counter()
+        keys = identities.get_public_keys(t.sender for t in transactions)
+        warm_time = time.perf_counter() - start
+        start = time.perf_counter()
+        verifier.verify_batch(transactions, keys)
+        verify_time = time.perf_counter() - start
+        verifier.shutdown()
+        print(f"key lookup   parse PEM {parse_time / args.transactions * 1e6:8.1f} us"
+              f"   cache cold {cold_time / args.transactions * 1e6:6.1f} us"
+              f"   warm {warm_time / args.transactions * 1e6:6.2f} us"
+              f"   (hits {identities.stats['hits']:,}, misses {identities.stats['misses']:,};"
+              f" RSA verify itself {verify_time / args.transactions * 1e6:.1f} us)")
+
+        claims = [(rng.choice(users), "kyc", "verified") for _ in range(100_000)]
+        start = time.perf_counter()
+        single = [identities.verify_attribute(*claim) for claim in claims]
+        single_time = time.perf_counter() - start
+        start = time.perf_counter()
+        assert identities.verify_attributes(claims) == single
+        bulk_time = time.perf_counter() - start
+        print(f"attributes   one call each {len(claims) / single_time:10,.0f} claims/s"
+              f"   verify_attributes {len(claims) / bulk_time:10,.0f} claims/s")
+
+        start = time.perf_counter()
+        identities.save()
+        save_time = time.perf_counter() - start
+        start = time.perf_counter()
+        reloaded = DecentralizedIdentity(identities.path)
+        load_time = time.perf_counter() - start
+        assert len(reloaded) == args.users
+        print(f"persistence  save {save_time * 1e3:.1f} ms, load {load_time * 1e3:.1f} ms"
+              f" for {args.users:,} identities ({os.path.getsize(identities.path) / 1024:,.0f} KiB)")
+
+
+if __name__ == "__main__":
+    main()
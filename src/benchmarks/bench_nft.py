@@ -0,0 +1,69 @@
+"""NFT registry benchmark.
+
+Bulk-mints --nfts NFTs over --owners owners, transfers --transfers of them
+with transfer_many, then compares owner and fraction-holder lookups via the
+secondary indexes against the full registry scan they replace:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_nft.py --nfts 200000 --owners 10000
+"""
+import argparse
+import random
+import time
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nfts", type=int, default=200_000)
+    parser.add_argument("--owners", type=int, default=10_000)
+    parser.add_argument("--transfers", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    market = EnhancedQuantumFuseBlockchain.NFTMarketplace()
+    owners = [f"owner-{i}" for i in range(args.owners)]
+    start = time.perf_counter()
+    market.mint_many((f"nft-{i}", rng.choice(owners), {"edition": i}) for i in range(args.nfts))
+    elapsed = time.perf_counter() - start
+    print(f"mint_many      {args.nfts:>9,} NFTs    {args.nfts / elapsed:10,.0f} /s")
+
+    transfers = []
+    for _ in range(args.transfers):
+        token_id = f"nft-{rng.randrange(args.nfts)}"
+        transfers.append((token_id, market.nfts[token_id]["owner"], rng.choice(owners)))
+    start = time.perf_counter()
+    moved = sum(market.transfer_many(transfers))
+    elapsed = time.perf_counter() - start
+    print(f"transfer_many  {args.transfers:>9,} calls   {args.transfers / elapsed:10,.0f} /s ({moved:,} moved)")
+
+    for i in range(0, args.nfts, 10):
+        token_id = f"nft-{i}"
+        owner = market.nfts[token_id]["owner"]
+        market.fractionalize_nft(token_id, {owner: 0.5, rng.choice(owners): 0.25, rng.choice(owners): 0.25})
+
+    sample = rng.sample(owners, args.queries)
+    start = time.perf_counter()
+    indexed = [market.tokens_of_owner(owner, limit=10**9) for owner in sample]
+    indexed_time = (time.perf_counter() - start) / args.queries
+    start = time.perf_counter()
+    scanned = [[token_id for token_id, nft in market.nfts.items() if nft["owner"] == owner] for owner in sample]
+    scan_time = (time.perf_counter() - start) / args.queries
+    assert [sorted(tokens) for tokens in indexed] == [sorted(tokens) for tokens in scanned]
+    print(f"owner lookup   indexed {indexed_time * 1e6:9.1f} us   scan {scan_time * 1e6:9.1f} us"
+          f"   ({scan_time / indexed_time:,.0f}x)")
+
+    start = time.perf_counter()
+    holdings = [market.fractions_of_holder(owner, limit=10**9) for owner in sample]
+    indexed_time = (time.perf_counter() - start) / args.queries
+    start = time.perf_counter()
+    for owner in sample:
+        [(token_id, nft["fractions"][owner]) for token_id, nft in market.nfts.items() if owner in nft["fractions"]]
+    scan_time = (time.perf_counter() - start) / args.queries
+    print(f"holder lookup  indexed {indexed_time * 1e6:9.1f} us   scan {scan_time * 1e6:9.1f} us"
+          f"   ({scan_time / indexed_time:,.0f}x, {sum(map(len, holdings)) / args.queries:.0f} holdings/holder)")
+
+
+if __name__ == "__main__":
+    main()
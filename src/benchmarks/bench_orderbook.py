@@ -0,0 +1,128 @@
+"""Limit order book benchmark.
+
+Loads --resting non-crossing orders into the DecentralizedExchange, then
+times --orders operations against the deep book: a mix of new resting
+orders, cancels of random resting orders and marketable orders that sweep
+one or more price levels:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_orderbook.py --resting 1000000 --orders 200000
+
+For reference the previous list-based book (re-sort on every insert,
+list.pop(0) on every fill) is run on a book of --legacy-resting orders.
+"""
+import argparse
+import random
+import time
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain
+
+
+class LegacyExchange:
+    # The order book as it was before the matching engine.
+    def __init__(self):
+        self.order_book = {}
+
+    def place_order(self, user, token_id, amount, price, is_buy):
+        if token_id not in self.order_book:
+            self.order_book[token_id] = {"buy": [], "sell": []}
+        order = {"user": user, "amount": amount, "price": price}
+        side = self.order_book[token_id]["buy" if is_buy else "sell"]
+        side.append(order)
+        side.sort(key=lambda x: x["price"], reverse=is_buy)
+
+    def match_orders(self, token_id):
+        buy_orders = self.order_book[token_id]["buy"]
+        sell_orders = self.order_book[token_id]["sell"]
+        while buy_orders and sell_orders and buy_orders[0]["price"] >= sell_orders[0]["price"]:
+            trade_amount = min(buy_orders[0]["amount"], sell_orders[0]["amount"])
+            buy_orders[0]["amount"] -= trade_amount
+            sell_orders[0]["amount"] -= trade_amount
+            if buy_orders[0]["amount"] == 0:
+                buy_orders.pop(0)
+            if sell_orders[0]["amount"] == 0:
+                sell_orders.pop(0)
+
+
+def resting_order(rng):
+    # Bids 90.00-99.99, asks 100.01-109.99, one cent ticks.
+    is_buy = rng.random() < 0.5
+    price = (rng.randint(9000, 9999) if is_buy else rng.randint(10001, 10999)) / 100
+    return rng.randint(1, 100), price, is_buy
+
+
+def operations(rng, count: int):
+    ops = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.5:
+            ops.append(("place",) + resting_order(rng))
+        elif kind < 0.8:
+            ops.append(("cancel",))
+        else:
+            is_buy = rng.random() < 0.5
+            # Marketable: crosses the spread by up to 5 cents.
+            price = (10000 + rng.randint(1, 5)) / 100 if is_buy else (10000 - rng.randint(1, 5)) / 100
+            ops.append(("take", rng.randint(50, 500), price, is_buy))
+    return ops
+
+
+def bench_engine(resting: int, count: int):
+    rng = random.Random(7)
+    exchange = EnhancedQuantumFuseBlockchain.DecentralizedExchange()
+    start = time.perf_counter()
+    order_ids = [exchange.place_order("maker", "QFT", *resting_order(rng)) for _ in range(resting)]
+    print(f"engine  loaded {resting:>9,} resting orders in {time.perf_counter() - start:6.2f}s")
+
+    ops = operations(rng, count)
+    start = time.perf_counter()
+    for op in ops:
+        if op[0] == "cancel":
+            i = rng.randrange(len(order_ids))
+            order_ids[i], order_ids[-1] = order_ids[-1], order_ids[i]
+            exchange.cancel_order(order_ids.pop())
+        else:
+            order_id = exchange.place_order("taker" if op[0] == "take" else "maker", "QFT", *op[1:])
+            if op[0] == "place":
+                order_ids.append(order_id)
+    elapsed = time.perf_counter() - start
+    book = exchange.order_book["QFT"]
+    print(f"engine  {count:>9,} ops in {elapsed:6.2f}s: {count / elapsed:10,.0f} orders/s,"
+          f" {exchange.stats['trades']:,} trades, {exchange.stats['cancelled']:,} cancels,"
+          f" {len(exchange.orders):,} resting on {len(book.bids) + len(book.asks):,} levels")
+    return count / elapsed
+
+
+def bench_legacy(resting: int, count: int):
+    rng = random.Random(7)
+    exchange = LegacyExchange()
+    # Build the starting book with one sort per side rather than one per order.
+    book = exchange.order_book["QFT"] = {"buy": [], "sell": []}
+    for _ in range(resting):
+        amount, price, is_buy = resting_order(rng)
+        book["buy" if is_buy else "sell"].append({"user": "maker", "amount": amount, "price": price})
+    book["buy"].sort(key=lambda x: x["price"], reverse=True)
+    book["sell"].sort(key=lambda x: x["price"])
+    ops = [op for op in operations(rng, count) if op[0] != "cancel"]  # The old book could not cancel.
+    start = time.perf_counter()
+    for op in ops:
+        exchange.place_order("maker", "QFT", *op[1:])
+        exchange.match_orders("QFT")
+    elapsed = time.perf_counter() - start
+    print(f"legacy  {len(ops):>9,} ops on {resting:,} resting in {elapsed:6.2f}s: {len(ops) / elapsed:10,.0f} orders/s")
+    return len(ops) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--resting", type=int, default=1_000_000)
+    parser.add_argument("--orders", type=int, default=200_000)
+    parser.add_argument("--legacy-resting", type=int, default=100_000)
+    parser.add_argument("--legacy-orders", type=int, default=500)
+    args = parser.parse_args()
+
+    bench_engine(args.resting, args.orders)
+    bench_legacy(args.legacy_resting, args.legacy_orders)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Shard rebalancing benchmark.
+
+Submits --per-round transfers every round from senders drawn from a Zipf
+distribution (a few hot accounts, a long tail) and produces one block per
+shard per round, each capped at --capacity transactions. The same stream
+is run once with static routing and once with the ShardRebalancer moving
+ring arcs every --epoch rounds:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_rebalance.py --shards 4 --rounds 60
+
+With static routing the shards that own the hot accounts fill up while the
+others idle; rebalancing should raise committed throughput and keep the
+backlog down until the hottest single account alone exceeds a shard.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain, Transaction
+
+
+def zipf_stream(accounts: int, exponent: float, per_round: int, rounds: int, seed: int):
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, accounts + 1) ** exponent
+    senders = rng.choice(accounts, size=(rounds, per_round), p=weights / weights.sum())
+    recipients = rng.integers(0, accounts, size=(rounds, per_round))
+    return senders, recipients
+
+
+def run(label: str, args, senders, recipients, rebalance: bool):
+    blockchain = EnhancedQuantumFuseBlockchain(num_shards=args.shards, difficulty=1)
+    blockchain.consensus.green_pow.difficulty = 1
+    blockchain.consensus.green_pow.adjustment_interval = 10**9
+    for shard in blockchain.shards:
+        shard.max_block_transactions = args.capacity
+    rebalancer = blockchain.shard_rebalancer
+    rebalancer.epoch_rounds = args.epoch if rebalance else 10**9
+    rebalancer.max_shards = args.max_shards if rebalance else args.shards
+    for account in range(args.accounts):
+        blockchain.add_balance(f"account-{account}", 10**9)
+
+    blockchain.shard_scheduler.reset_metrics()
+    start = time.perf_counter()
+    for round_number in range(args.rounds):
+        for i, (sender, recipient) in enumerate(zip(senders[round_number], recipients[round_number])):
+            blockchain.add_transaction(Transaction(f"account-{sender}", f"account-{recipient}", 1.0,
+                                                   nonce=round_number * args.per_round + i))
+        blockchain.mine_all_shards("miner")
+    elapsed = time.perf_counter() - start
+
+    committed = blockchain.shard_scheduler.stats["transactions"]
+    submitted = args.rounds * args.per_round
+    backlog = [len(shard.pending_transactions) for shard in blockchain.shards]
+    print(f"{label:<10} committed {committed:>7} of {submitted} ({committed / submitted:5.1%})"
+          f"  {committed / args.rounds:7.1f} tx/round  {committed / elapsed:8,.0f} tx/s"
+          f"  backlog {sum(backlog):>6} (max shard {max(backlog)})")
+    if rebalance:
+        moved = sum(record.get("moved_arcs", 0) for record in rebalancer.history)
+        handed = sum(record.get("moved_transactions", 0) for record in rebalancer.history)
+        splits = [record["split"] for record in rebalancer.history if record["split"] is not None]
+        merges = [record["merged"] for record in rebalancer.history if record["merged"] is not None]
+        print(f"{'':<10} {len(rebalancer.history)} epochs, {moved} arc moves, {handed} mempool transactions handed off,"
+              f" splits {splits}, merges {merges}, {len(blockchain.cross_shard_coordinator.active_shard_ids())}"
+              f" active shards")
+    blockchain.close()
+    return committed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--max-shards", type=int, default=8)
+    parser.add_argument("--accounts", type=int, default=5000)
+    parser.add_argument("--exponent", type=float, default=1.1, help="Zipf exponent of the sender distribution")
+    parser.add_argument("--per-round", type=int, default=400, help="transfers submitted per round")
+    parser.add_argument("--capacity", type=int, default=150, help="transactions per block")
+    parser.add_argument("--rounds", type=int, default=60)
+    parser.add_argument("--epoch", type=int, default=5, help="rounds per rebalancing epoch")
+    args = parser.parse_args()
+
+    senders, recipients = zipf_stream(args.accounts, args.exponent, args.per_round, args.rounds, seed=7)
+    print(f"{args.shards} shards x {args.capacity} tx/block, {args.per_round} tx/round, Zipf s={args.exponent}"
+          f" over {args.accounts} accounts, {args.rounds} rounds")
+    static = run("static", args, senders, recipients, rebalance=False)
+    balanced = run("rebalanced", args, senders, recipients, rebalance=True)
+    print(f"throughput gain {balanced / max(static, 1):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
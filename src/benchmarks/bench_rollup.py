@@ -0,0 +1,59 @@
+"""Rollup benchmark.
+
+Deposits funds for --accounts L2 accounts, then sequences --transfers
+random transfers between them into rollup batches of --batch transfers.
+Reports L2 throughput (queueing, applying to the state tree and sealing
+the compressed batch), the bytes each transfer costs on chain against a
+main-chain Transaction, and how fast a verifier can re-execute the posted
+batches from genesis:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_rollup.py --accounts 10000 --transfers 200000
+"""
+import argparse
+import random
+import time
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain, Transaction
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--accounts", type=int, default=10_000)
+    parser.add_argument("--transfers", type=int, default=200_000)
+    parser.add_argument("--batch", type=int, default=5_000)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    layer2 = EnhancedQuantumFuseBlockchain.Layer2Solution()
+    accounts = [f"account-{i}" for i in range(args.accounts)]
+    for account in accounts:
+        layer2.deposit_to_rollup(account, 1000)
+    layer2.create_rollup_batch()
+    transfers = [(rng.choice(accounts), rng.choice(accounts), rng.randint(1, 20)) for _ in range(args.transfers)]
+
+    start = time.perf_counter()
+    for i in range(0, len(transfers), args.batch):
+        for sender, recipient, amount in transfers[i:i + args.batch]:
+            layer2.submit_l2_transfer(sender, recipient, amount)
+        layer2.create_rollup_batch()
+    elapsed = time.perf_counter() - start
+    batches = layer2.rollup_batches[1:]
+    sequenced = sum(batch["count"] for batch in batches)
+    posted = sum(batch["posted_bytes"] for batch in batches)
+    print(f"sequencer  {sequenced / elapsed:10,.0f} L2 tx/s  ({len(batches)} batches,"
+          f" {layer2.stats['rollup_rejected']:,} rejected)")
+
+    l1_bytes = len(Transaction(accounts[0], accounts[1], 5).to_bytes())
+    print(f"on chain   {posted / sequenced:10.2f} bytes/tx  (main-chain transaction without signature:"
+          f" {l1_bytes} bytes, {l1_bytes * sequenced / posted:.0f}x)")
+
+    start = time.perf_counter()
+    state, bad = layer2.replay_rollup()
+    elapsed = time.perf_counter() - start
+    assert bad is None and state.root == layer2.rollup_state.root
+    print(f"replay     {(sequenced + args.accounts) / elapsed:10,.0f} tx/s re-executed from genesis,"
+          f" all {len(layer2.rollup_batches)} roots verified")
+
+
+if __name__ == "__main__":
+    main()
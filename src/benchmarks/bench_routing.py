@@ -0,0 +1,97 @@
+"""AI routing inference benchmark.
+
+Routes --transactions transfers through the TransactionRoutingModel three
+ways: one forward pass per transaction (the previous
+optimize_transaction_routing path), one forward pass per batch with the
+eager model, and the same with the TorchScript-compiled model. Then
+--threads client threads submit one transaction at a time through the
+RoutingService micro-batching queue, to show the latency it adds:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_routing.py --transactions 20000 --batch 256
+"""
+import argparse
+import statistics
+import threading
+import time
+
+import torch
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain, Transaction
+
+
+def bench_per_transaction(optimizer, service, transactions):
+    start = time.perf_counter()
+    for transaction in transactions:
+        optimizer.optimize_transaction_routing(torch.from_numpy(service.featurize([transaction])))
+    return time.perf_counter() - start
+
+
+def bench_batched(service, transactions, batch: int):
+    start = time.perf_counter()
+    for i in range(0, len(transactions), batch):
+        service.predict(service.featurize(transactions[i:i + batch]))
+    return time.perf_counter() - start
+
+
+def bench_queue(service, transactions, threads: int):
+    latencies = []
+    lock = threading.Lock()
+
+    def client(chunk):
+        for transaction in chunk:
+            submitted = time.perf_counter()
+            service.submit(transaction).result()
+            with lock:
+                latencies.append(time.perf_counter() - submitted)
+
+    workers = [threading.Thread(target=client, args=(transactions[i::threads],)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transactions", type=int, default=20_000)
+    parser.add_argument("--batch", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=16, help="client threads for the queue measurement")
+    parser.add_argument("--max-delay", type=float, default=0.002, help="micro-batch flush deadline in seconds")
+    parser.add_argument("--torch-threads", type=int, default=1)
+    args = parser.parse_args()
+
+    blockchain = EnhancedQuantumFuseBlockchain(num_shards=5, difficulty=1)
+    optimizer = blockchain.ai_optimizer
+    transactions = [Transaction(f"sender-{i}", f"recipient-{i % 997}", 1.0 + i % 50, fee=0.01, nonce=i)
+                    for i in range(args.transactions)]
+    eager = optimizer.RoutingService(optimizer.transaction_routing_model, blockchain.cross_shard_coordinator,
+                                     threads=args.torch_threads)
+    scripted = optimizer.RoutingService(optimizer.transaction_routing_model, blockchain.cross_shard_coordinator,
+                                        torchscript=True)
+    count = len(transactions)
+    print(f"{count} transactions, batch {args.batch}, {torch.get_num_threads()} torch thread(s)")
+
+    per_tx = bench_per_transaction(optimizer, eager, transactions[:count // 4]) * 4
+    print(f"{'per transaction':<16} {count / per_tx:10,.0f} tx/s  {per_tx / count * 1e6:7.1f} us/tx")
+    for label, service in (("batched eager", eager), ("batched script", scripted)):
+        # TorchScript's profiling executor specializes during the first calls; keep them untimed.
+        bench_batched(service, transactions[:args.batch * 8], args.batch)
+        elapsed = bench_batched(service, transactions, args.batch)
+        print(f"{label:<16} {count / elapsed:10,.0f} tx/s  {elapsed / count * 1e6:7.1f} us/tx"
+              f"  speedup {per_tx / elapsed:5.1f}x")
+    eager.stop()
+
+    scripted.max_batch, scripted.max_delay = args.batch, args.max_delay
+    elapsed, latencies = bench_queue(scripted, transactions, args.threads)
+    metrics = scripted.metrics()
+    print(f"{'queued':<16} {count / elapsed:10,.0f} tx/s  {args.threads} clients, mean batch {metrics['mean_batch']:.1f},"
+          f" latency p50 {latencies[len(latencies) // 2] * 1e3:.2f} ms"
+          f" p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.2f} ms mean {statistics.mean(latencies) * 1e3:.2f} ms")
+    scripted.stop()
+    blockchain.close()
+
+
+if __name__ == "__main__":
+    main()
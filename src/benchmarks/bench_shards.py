@@ -0,0 +1,72 @@
+"""Parallel shard production benchmark.
+
+Fills every shard's mempool, then produces --rounds blocks on all shards at
+once with the ShardScheduler, for each combination of shard count and
+worker count:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_shards.py --shards 4,16,64 --workers 1,8
+
+Proof of work dominates block production, so aggregate TPS should scale
+with workers until every core is busy.
+"""
+import argparse
+import os
+import time
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain, Transaction
+
+
+def run(num_shards: int, workers: int, difficulty: int, transactions: int, rounds: int):
+    blockchain = EnhancedQuantumFuseBlockchain(num_shards=num_shards, difficulty=difficulty, mining_workers=workers)
+    pow_engine = blockchain.consensus.green_pow
+    pow_engine.adjustment_interval = 10**9
+    coordinator = blockchain.cross_shard_coordinator
+    for shard in blockchain.shards:
+        shard.max_block_transactions = transactions
+    i = 0
+    remaining = {shard.shard_id: transactions * rounds for shard in blockchain.shards}
+    while any(remaining.values()):
+        sender = f"sender-{i}"
+        shard_id = coordinator.get_shard_id(sender)
+        if remaining[shard_id]:
+            blockchain.shards[shard_id].add_transaction(Transaction(sender, "recipient", 1.0))
+            remaining[shard_id] -= 1
+        i += 1
+
+    scheduler = blockchain.shard_scheduler
+    if workers > 1:
+        # Start the worker processes outside the timed region.
+        list(scheduler._get_pool().map(abs, range(workers)))
+    scheduler.reset_metrics()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        scheduler.produce_blocks("miner")
+    elapsed = time.perf_counter() - start
+    metrics = scheduler.metrics()
+    per_shard = [shard["tps"] for shard in metrics["shards"].values()]
+    print(f"shards {num_shards:>3}  workers {workers:>3}  {metrics['blocks']:>4} blocks in {elapsed:6.2f}s"
+          f"  aggregate {metrics['tps']:9,.0f} tx/s  per shard {min(per_shard):7,.0f}-{max(per_shard):7,.0f} tx/s")
+    blockchain.close()
+    return metrics["tps"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", default="1,4,16", help="comma-separated shard counts")
+    parser.add_argument("--workers", default=f"1,{os.cpu_count()}", help="comma-separated worker counts")
+    parser.add_argument("--difficulty", type=int, default=4)
+    parser.add_argument("--transactions", type=int, default=200, help="transactions per block")
+    parser.add_argument("--rounds", type=int, default=2)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores, difficulty {args.difficulty}, {args.transactions} tx per block")
+    for num_shards in (int(n) for n in args.shards.split(",")):
+        worker_counts = sorted({int(n) for n in args.workers.split(",")})
+        baseline = run(num_shards, worker_counts[0], args.difficulty, args.transactions, args.rounds)
+        for workers in worker_counts[1:]:
+            tps = run(num_shards, workers, args.difficulty, args.transactions, args.rounds)
+            print(f"{'':>26}speedup over {worker_counts[0]} worker(s): {tps / baseline:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""State channel benchmark.
+
+Opens --channels signed channels and streams --rounds rounds of payments
+through them: every round each channel receives one update signed by both
+users with a nonce one higher than the last. The stream is applied once
+with one update_state_channel call per update, which checks every
+signature, and once with apply_updates in batches of --batch updates,
+which keeps only the newest update per channel and checks only its
+signatures. Signing is done up front and not timed. Finally every channel
+is closed and the opens and closes are settled as one batch:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_state_channels.py --channels 200 --rounds 50
+"""
+import argparse
+import random
+import time
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain, StateStore
+
+Layer2Solution = EnhancedQuantumFuseBlockchain.Layer2Solution
+
+
+def open_channels(layer2, args, keys):
+    public_keys = [key.public_key() for key in keys]
+    return [layer2.open_state_channel(f"user-{2 * i}", f"user-{2 * i + 1}", 100, public_keys)
+            for i in range(args.channels)]
+
+
+def signed_stream(channel_ids, args, keys):
+    rng = random.Random(7)
+    balances = {channel_id: 100.0 for channel_id in channel_ids}
+    stream = []
+    for nonce in range(1, args.rounds + 1):
+        for channel_id in channel_ids:
+            balances[channel_id] = min(200.0, max(0.0, balances[channel_id] + rng.randint(-5, 5)))
+            state = (balances[channel_id], 200.0 - balances[channel_id])
+            stream.append((channel_id, nonce, state,
+                           [Layer2Solution.sign_update(key, channel_id, nonce, state) for key in keys]))
+    return stream
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=2000)
+    args = parser.parse_args()
+
+    keys = [rsa.generate_private_key(public_exponent=65537, key_size=2048) for _ in range(2)]
+    single = Layer2Solution()
+    channel_ids = open_channels(single, args, keys)
+    start = time.perf_counter()
+    stream = signed_stream(channel_ids, args, keys)
+    print(f"signed {len(stream):,} updates in {time.perf_counter() - start:.1f}s (not timed below)")
+
+    start = time.perf_counter()
+    for channel_id, nonce, state, signatures in stream:
+        channel = single.state_channels[channel_id]
+        single.update_state_channel(channel_id, dict(zip(channel.users, state)), nonce, signatures)
+    elapsed = time.perf_counter() - start
+    print(f"one at a time  {len(stream) / elapsed:10,.0f} updates/s  ({single.stats['verified']:,} verified)")
+
+    state = StateStore()
+    for i in range(2 * args.channels):
+        state.credit("QFC", f"user-{i}", 100)  # Opening a channel locks each user's deposit.
+    batched = Layer2Solution(state)
+    assert open_channels(batched, args, keys) == channel_ids
+    start = time.perf_counter()
+    for i in range(0, len(stream), args.batch):
+        batched.apply_updates(stream[i:i + args.batch])
+    elapsed = time.perf_counter() - start
+    print(f"apply_updates  {len(stream) / elapsed:10,.0f} updates/s  ({batched.stats['verified']:,} verified,"
+          f" {batched.stats['superseded']:,} superseded)")
+    assert all(batched.state_channels[c].balances == single.state_channels[c].balances for c in channel_ids)
+
+    for channel_id in channel_ids:
+        batched.close_state_channel(channel_id)
+    start = time.perf_counter()
+    settlement = batched.settle("block")
+    elapsed = time.perf_counter() - start
+    print(f"settle         {settlement['opens']:,} opens + {settlement['closes']:,} closes in one batch,"
+          f" {len(settlement['deltas']):,} balance changes in {elapsed * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Chain synchronization benchmark.
+
+Builds a multi-shard chain of --blocks blocks on --peers local source nodes,
+then starts a fresh node, points it at every source and times the
+headers-first sync until the fresh node holds the full chain:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_sync.py --blocks 5000 --peers 2
+
+Blocks are mined at difficulty 1 so building the source chain stays quick;
+sync verifies every header's proof of work regardless of difficulty, and every
+transaction's signature, balance and nonce before a block is applied.
+"""
+import argparse
+import time
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from quantumfuse_blockchain import Block, Transaction
+from quantumfuse_node import QuantumFuseNode
+
+
+def allocate(node, senders, blocks: int):
+    # Every node starts from the same allocation and knows the senders' keys.
+    for sender, private_key in senders.items():
+        node.blockchain.identity_manager.create_identity(sender, private_key.public_key())
+        node.blockchain.add_balance(sender, blocks)
+
+
+def build_chain(node, senders, blocks: int):
+    pow_engine = node.blockchain.consensus.green_pow
+    shards = node.blockchain.shards
+    for i in range(blocks):
+        shard_id = i % len(shards)
+        tip = shards[shard_id].get_latest_block()
+        transactions = []
+        for sender, private_key in senders.items():
+            transaction = Transaction(sender, f"recipient-{i}", 1.0, nonce=i)
+            transaction.sign_transaction(private_key)
+            transactions.append(transaction)
+        block = Block(tip.index + 1, transactions, tip.hash)
+        block.nonce, block.hash = pow_engine._search_nonces(block.pow_data(), "solar", 1, 0, 1)
+        block.energy_source = "solar"
+        node.blockchain.append_block(shard_id, block)
+
+
+def copy_chain(source, target):
+    for shard_id, shard in enumerate(source.blockchain.shards):
+        for block in source.blockchain.get_blocks(shard_id, 1, len(shard.chain)):
+            target.blockchain.append_block(shard_id, block)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--blocks", type=int, default=5000)
+    parser.add_argument("--peers", type=int, default=2, help="source nodes serving the chain")
+    parser.add_argument("--transactions", type=int, default=10, help="transactions per block")
+    parser.add_argument("--blocks-per-request", type=int, default=64)
+    parser.add_argument("--in-flight", type=int, default=8)
+    args = parser.parse_args()
+
+    senders = {f"sender-{j}": rsa.generate_private_key(public_exponent=65537, key_size=2048)
+               for j in range(args.transactions)}
+    sources = [QuantumFuseNode("127.0.0.1", 0, stake=0.8, difficulty=1) for _ in range(args.peers)]
+    for source in sources:
+        allocate(source, senders, args.blocks)
+    start = time.perf_counter()
+    build_chain(sources[0], senders, args.blocks)
+    for source in sources[1:]:
+        copy_chain(sources[0], source)
+    print(f"built {args.blocks} blocks x {args.transactions} tx on {args.peers} peers "
+          f"in {time.perf_counter() - start:.1f}s")
+    for source in sources:
+        source.start(interactive=False)
+
+    fresh = QuantumFuseNode("127.0.0.1", 0, stake=0.8, difficulty=1)
+    allocate(fresh, senders, args.blocks)
+    fresh.chain_sync.blocks_per_request = args.blocks_per_request
+    fresh.chain_sync.max_in_flight = args.in_flight
+    fresh.start(interactive=False)
+    target = sources[0].chain_sync.heights()
+
+    start = time.perf_counter()
+    for source in sources:
+        fresh.connect_to_peer(source.address)
+    while fresh.chain_sync.heights() != target:
+        time.sleep(0.01)
+        if time.perf_counter() - start > 600:
+            print(f"timed out at {fresh.chain_sync.heights()} of {target}")
+            break
+    elapsed = time.perf_counter() - start
+
+    synced = sum(fresh.chain_sync.heights()) - len(target)
+    stats = fresh.chain_sync.stats
+    received = fresh.transport.stats["bytes_received"]
+    print(f"synced {synced} blocks in {elapsed:.2f}s: {synced / elapsed:,.0f} blocks/s, "
+          f"{synced * args.transactions / elapsed:,.0f} tx/s, {received / elapsed / 2**20:.1f} MiB/s received")
+    print(f"headers {stats['headers']}  blocks {stats['blocks']}  failed requests {stats['failed_requests']}  "
+          f"served per peer {[source.chain_sync.stats['served_blocks'] for source in sources]}")
+
+    for node in sources + [fresh]:
+        node.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Transaction graph benchmark.
+
+Feeds --blocks blocks of --per-block transfers among --addresses
+addresses into a TransactionGraph one block at a time, then times the
+investigation queries and the CSR export. For reference, the same
+component query is answered the way it would be without the index:
+rebuild the networkx graph from every block and run
+weakly_connected_components, and the export is compared with
+networkx.to_scipy_sparse_array:
+
+    PYTHONPATH=src/quantumfuse python src/benchmarks/bench_tx_graph.py --blocks 1000 --per-block 1000
+"""
+import argparse
+import time
+
+import networkx as nx
+import numpy as np
+
+from quantumfuse_blockchain import Block, Transaction, TransactionGraph
+
+
+def blocks(args):
+    rng = np.random.default_rng(7)
+    for index in range(1, args.blocks + 1):
+        senders = rng.integers(0, args.addresses, args.per_block)
+        # Recipients skew towards a few exchanges and merchants.
+        recipients = np.where(rng.random(args.per_block) < 0.3, rng.integers(0, 100, args.per_block),
+                              rng.integers(0, args.addresses, args.per_block))
+        amounts = np.round(rng.lognormal(3, 1, args.per_block), 2)
+        yield Block(index, [Transaction(f"addr-{s}", f"addr-{r}", a)
+                            for s, r, a in zip(senders.tolist(), recipients.tolist(), amounts.tolist())], "0")
+
+
+def timed(label, count, function):
+    start = time.perf_counter()
+    for _ in range(count):
+        result = function()
+    elapsed = (time.perf_counter() - start) / count
+    print(f"{label:<34} {elapsed * 1e3:10.3f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--blocks", type=int, default=1000)
+    parser.add_argument("--per-block", type=int, default=1000)
+    parser.add_argument("--addresses", type=int, default=500_000)
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+
+    chain = list(blocks(args))
+    graph = TransactionGraph()
+    start = time.perf_counter()
+    for block in chain:
+        graph.add_block(block)
+    elapsed = time.perf_counter() - start
+    transactions = args.blocks * args.per_block
+    print(f"indexed {transactions:,} transactions in {elapsed:.1f}s ({transactions / elapsed:,.0f} tx/s,"
+          f" {elapsed / args.blocks * 1e3:.2f} ms/block): {len(graph.nodes):,} addresses,"
+          f" {graph.edge_count:,} edges, {graph.component_count:,} components")
+
+    rng = np.random.default_rng(11)
+    sample = [f"addr-{i}" for i in rng.integers(100, args.addresses, args.queries) if f"addr-{i}" in graph.graph]
+    queries = iter(sample * 1000)
+    timed("2-hop outgoing neighborhood", len(sample), lambda: graph.neighborhood(next(queries), 2, "out"))
+    timed("3-hop fund trace", len(sample), lambda: graph.trace_funds(next(queries), hops=3))
+    timed("cluster of an address (indexed)", len(sample), lambda: graph.component_id(next(queries)))
+
+    def rebuild_components():
+        rebuilt = nx.DiGraph()
+        for block in chain:
+            for transaction in block.transactions:
+                rebuilt.add_edge(transaction.sender, transaction.recipient)
+        return nx.number_weakly_connected_components(rebuilt)
+
+    assert timed("components by rebuilding", 1, rebuild_components) == graph.component_count
+
+    indptr, indices, data, nodes = timed("to_csr", 3, graph.to_csr)
+    timed("nx.to_scipy_sparse_array", 1, lambda: nx.to_scipy_sparse_array(graph.graph, nodelist=nodes,
+                                                                          weight="amount", format="csr"))
+    out_volume = np.add.reduceat(data, indptr[:-1][np.diff(indptr) > 0])
+    print(f"CSR: {len(indices):,} edges; largest single-address outflow {out_volume.max():,.2f}")
+
+
+if __name__ == "__main__":
+    main()
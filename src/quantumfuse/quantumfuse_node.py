@@ -1,32 +1,695 @@
+import asyncio
+import base64
+import concurrent.futures
 import hashlib
+import itertools
 import json
+import struct
 import time
 import threading
 import socket
 import random
-from typing import List, Dict, Any, Tuple
+from collections import Counter, OrderedDict
+from typing import List, Dict, Any, Tuple, Callable, Optional
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import padding, x25519
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.backends import default_backend
+from cryptography.exceptions import InvalidSignature, InvalidTag
 import requests
-from quantumfuse_blockchain import QuantumFuseBlockchain, Transaction, Block
+from quantumfuse_blockchain import QuantumFuseBlockchain, Transaction, Block, BlockHeader, SignatureVerifier, Mempool
+
+class LRUCache:
+    # Bounded recency cache; doubles as the gossip "seen" set when values are left as None.
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key, value=None) -> bool:
+        # Returns True only the first time a key is seen (while it is still cached).
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return False
+            self.items[key] = value
+            if len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+            return True
+
+    def set(self, key, value):
+        # Unlike add, overwrites the value of a key that is already cached.
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+class SecureChannel:
+    # Per-connection session. Each side sends an ephemeral X25519 key signed with its RSA
+    # identity key; HKDF over the shared secret yields one ChaCha20-Poly1305 key per direction,
+    # and every frame after the handshake costs only symmetric crypto.
+    PROTOCOL = b"QFS1"
+    INITIATOR, RESPONDER = b"I", b"R"
+    KEY_LENGTH = struct.Struct(">H")
+    NONCE = struct.Struct(">4xQ")
+    TAG_BYTES = 16  # Poly1305 tag; a sealed frame is this much longer than its plaintext.
+    PSS = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH)
+
+    def __init__(self, send_key: bytes, receive_key: bytes, remote_public_key):
+        self.send_cipher = ChaCha20Poly1305(send_key)
+        self.receive_cipher = ChaCha20Poly1305(receive_key)
+        self.remote_public_key = remote_public_key
+        # TCP delivers in order, so the nonce is an implicit per-direction counter.
+        self.send_counter = 0
+        self.receive_counter = 0
+
+    def encrypt(self, plaintext: bytes) -> bytes:
+        # Checked before sealing, so an oversized frame does not use up a nonce.
+        if len(plaintext) + self.TAG_BYTES > PeerTransport.MAX_FRAME_BYTES:
+            raise ValueError(f"Sealed frame of {len(plaintext) + self.TAG_BYTES} bytes exceeds "
+                             f"{PeerTransport.MAX_FRAME_BYTES}")
+        ciphertext = self.send_cipher.encrypt(self.NONCE.pack(self.send_counter), plaintext, None)
+        self.send_counter += 1
+        return ciphertext
+
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        try:
+            plaintext = self.receive_cipher.decrypt(self.NONCE.pack(self.receive_counter), ciphertext, None)
+        except InvalidTag:
+            raise ValueError("Frame failed authentication")
+        self.receive_counter += 1
+        return plaintext
+
+    @classmethod
+    def encode_hello(cls, private_key, role: bytes, ephemeral_public: bytes, peer_ephemeral: bytes = b"") -> bytes:
+        identity = private_key.public_key().public_bytes(
+            serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        # The responder also signs the initiator's ephemeral key, binding its reply to this session.
+        signature = private_key.sign(cls.PROTOCOL + role + ephemeral_public + peer_ephemeral, cls.PSS, hashes.SHA256())
+        return ephemeral_public + cls.KEY_LENGTH.pack(len(identity)) + identity + signature
+
+    @classmethod
+    def decode_hello(cls, hello: bytes, role: bytes, peer_ephemeral: bytes = b""):
+        try:
+            ephemeral_public = hello[:32]
+            (identity_length,) = cls.KEY_LENGTH.unpack_from(hello, 32)
+            identity_end = 34 + identity_length
+            remote_public_key = serialization.load_der_public_key(hello[34:identity_end], backend=default_backend())
+            remote_public_key.verify(hello[identity_end:], cls.PROTOCOL + role + ephemeral_public + peer_ephemeral,
+                                     cls.PSS, hashes.SHA256())
+        except (struct.error, ValueError, TypeError, AttributeError, InvalidSignature):
+            raise ValueError("Invalid session handshake")
+        return ephemeral_public, remote_public_key
+
+    @classmethod
+    def derive(cls, ephemeral, peer_ephemeral_public: bytes, initiator_hello: bytes, responder_hello: bytes,
+               role: bytes, remote_public_key) -> "SecureChannel":
+        shared = ephemeral.exchange(x25519.X25519PublicKey.from_public_bytes(peer_ephemeral_public))
+        keys = HKDF(
+            algorithm=hashes.SHA256(), length=64,
+            salt=hashlib.sha256(initiator_hello + responder_hello).digest(), info=cls.PROTOCOL + b" session"
+        ).derive(shared)
+        initiator_key, responder_key = keys[:32], keys[32:]
+        if role == cls.INITIATOR:
+            return cls(initiator_key, responder_key, remote_public_key)
+        return cls(responder_key, initiator_key, remote_public_key)
+
+    @staticmethod
+    def ephemeral_keypair():
+        private = x25519.X25519PrivateKey.generate()
+        return private, private.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+    @classmethod
+    async def initiate(cls, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, private_key) -> "SecureChannel":
+        ephemeral, ephemeral_public = cls.ephemeral_keypair()
+        hello = cls.encode_hello(private_key, cls.INITIATOR, ephemeral_public)
+        writer.write(PeerTransport.encode_frame(hello))
+        await writer.drain()
+        reply = await PeerTransport.read_frame(reader)
+        peer_ephemeral, remote_public_key = cls.decode_hello(reply, cls.RESPONDER, ephemeral_public)
+        return cls.derive(ephemeral, peer_ephemeral, hello, reply, cls.INITIATOR, remote_public_key)
+
+    @classmethod
+    async def accept(cls, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, private_key) -> "SecureChannel":
+        hello = await PeerTransport.read_frame(reader)
+        peer_ephemeral, remote_public_key = cls.decode_hello(hello, cls.INITIATOR)
+        ephemeral, ephemeral_public = cls.ephemeral_keypair()
+        reply = cls.encode_hello(private_key, cls.RESPONDER, ephemeral_public, peer_ephemeral)
+        writer.write(PeerTransport.encode_frame(reply))
+        await writer.drain()
+        return cls.derive(ephemeral, peer_ephemeral, hello, reply, cls.RESPONDER, remote_public_key)
+
+class PeerTransport:
+    # Frames are a 4-byte big-endian length followed by the payload.
+    FRAME_HEADER = struct.Struct(">I")
+    MAX_FRAME_BYTES = 16 * 2**20
+    # Largest payload whose sealed frame still fits under the cap.
+    MAX_PAYLOAD_BYTES = MAX_FRAME_BYTES - SecureChannel.TAG_BYTES
+
+    class PeerConnection:
+        # One long-lived outbound connection per peer, fed from a bounded queue. The peer answers
+        # our requests over the same session, so a reader task dispatches whatever comes back.
+        def __init__(self, transport, peer: Tuple[str, int]):
+            self.transport = transport
+            self.peer = peer
+            self.queue = asyncio.Queue(maxsize=transport.queue_size)
+            self.writer = None
+            self.connected = False
+            self.reconnects = 0
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+        async def run(self):
+            backoff = self.transport.initial_backoff
+            pending = None
+            while True:
+                replies = None
+                try:
+                    reader, self.writer = await asyncio.wait_for(
+                        asyncio.open_connection(*self.peer), self.transport.connect_timeout
+                    )
+                    channel = await asyncio.wait_for(
+                        SecureChannel.initiate(reader, self.writer, self.transport.private_key),
+                        self.transport.connect_timeout
+                    )
+                    if not self.transport.authorize(channel.remote_public_key):
+                        raise ValueError(f"Peer {self.peer} is not authorized")
+                    replies = asyncio.get_running_loop().create_task(self.read_replies(reader, channel))
+                    self.connected = True
+                    backoff = self.transport.initial_backoff
+                    while True:
+                        # A frame dequeued but not yet drained is retried on the next connection.
+                        if pending is None:
+                            pending = await self.queue.get()
+                        try:
+                            frame = PeerTransport.encode_frame(channel.encrypt(pending))
+                        except ValueError:
+                            # It can never be sent; retrying it would wedge the connection.
+                            self.transport.stats["dropped"] += 1
+                            pending = None
+                            continue
+                        self.writer.write(frame)
+                        await self.writer.drain()
+                        self.transport.stats["frames_sent"] += 1
+                        self.transport.stats["bytes_sent"] += len(pending)
+                        pending = None
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    pass
+                except ValueError as e:
+                    print(f"Session with {self.peer} failed: {e}")
+                finally:
+                    self.connected = False
+                    if replies is not None:
+                        replies.cancel()
+                    self.close_writer()
+                self.reconnects += 1
+                self.transport.stats["reconnects"] += 1
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+                backoff = min(backoff * 2, self.transport.max_backoff)
+
+        async def read_replies(self, reader: asyncio.StreamReader, channel: SecureChannel):
+            try:
+                while True:
+                    payload = channel.decrypt(await PeerTransport.read_frame(reader))
+                    self.transport.stats["frames_received"] += 1
+                    self.transport.stats["bytes_received"] += len(payload)
+                    await asyncio.get_running_loop().run_in_executor(None, self.transport.dispatch, payload, self.peer)
+            except (asyncio.IncompleteReadError, ConnectionError, OSError):
+                pass
+            except ValueError as e:
+                print(f"Session with {self.peer} failed: {e}")
+            # Closing the writer makes the next send fail, which reconnects.
+            self.close_writer()
+
+        def close_writer(self):
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+    class InboundSession:
+        # An authenticated inbound connection. Handlers get it as the frame's peer and answer
+        # requests with reply(), over the session the request came in on.
+        def __init__(self, transport, writer: asyncio.StreamWriter, channel: SecureChannel, peer):
+            self.transport = transport
+            self.writer = writer
+            self.channel = channel
+            self.peer = peer
+            self.closed = False
+
+        def __repr__(self) -> str:
+            return f"InboundSession({self.peer})"
+
+        async def write(self, payload: bytes):
+            if self.closed:
+                raise ConnectionError("Session closed")
+            # Sealing and writing happen without an await in between, so concurrent replies keep nonce order.
+            self.writer.write(PeerTransport.encode_frame(self.channel.encrypt(payload)))
+            await self.writer.drain()
+            self.transport.stats["frames_sent"] += 1
+            self.transport.stats["bytes_sent"] += len(payload)
+
+        def reply(self, payload: bytes, timeout: float = 1.0) -> bool:
+            transport = self.transport
+            if self.closed or not transport.running or len(payload) > transport.MAX_PAYLOAD_BYTES:
+                transport.stats["dropped"] += 1
+                return False
+            future = asyncio.run_coroutine_threadsafe(self.write(payload), transport.loop)
+            try:
+                future.result(timeout)
+                return True
+            except (TimeoutError, ConnectionError, OSError):
+                future.cancel()
+                transport.stats["dropped"] += 1
+                return False
+
+    def __init__(self, on_message: Callable[[bytes, Any], None], private_key=None, queue_size: int = 1024,
+                 connect_timeout: float = 5.0, initial_backoff: float = 0.1, max_backoff: float = 30.0,
+                 authorize: Optional[Callable[[Any], bool]] = None):
+        self.on_message = on_message
+        # RSA identity key that signs this side of every session handshake.
+        self.private_key = private_key or rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend()
+        )
+        self.authorize = authorize or (lambda public_key: True)
+        self.queue_size = queue_size
+        self.connect_timeout = connect_timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.connections: Dict[Tuple[str, int], "PeerTransport.PeerConnection"] = {}
+        self.inbound_writers = set()
+        self.server = None
+        self.thread = None
+        self.stats = {"frames_sent": 0, "bytes_sent": 0, "frames_received": 0,
+                      "bytes_received": 0, "dropped": 0, "reconnects": 0}
+
+    @classmethod
+    def encode_frame(cls, payload: bytes) -> bytes:
+        if len(payload) > cls.MAX_FRAME_BYTES:
+            raise ValueError(f"Frame of {len(payload)} bytes exceeds {cls.MAX_FRAME_BYTES}")
+        return cls.FRAME_HEADER.pack(len(payload)) + payload
+
+    @classmethod
+    async def read_frame(cls, reader: asyncio.StreamReader) -> bytes:
+        (length,) = cls.FRAME_HEADER.unpack(await reader.readexactly(cls.FRAME_HEADER.size))
+        if length > cls.MAX_FRAME_BYTES:
+            raise ValueError(f"Frame of {length} bytes exceeds {cls.MAX_FRAME_BYTES}")
+        return await reader.readexactly(length)
+
+    @property
+    def running(self) -> bool:
+        return self.loop is not None and self.loop.is_running()
+
+    def start(self, server_socket: Optional[socket.socket] = None):
+        # The event loop lives on its own thread so the node's synchronous API keeps working.
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run_loop, args=(server_socket, ready), daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def run_loop(self, server_socket: Optional[socket.socket], ready: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        if server_socket is not None:
+            server_socket.setblocking(False)
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.handle_inbound, sock=server_socket)
+            )
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def stop(self, timeout: float = 5.0):
+        if not self.running:
+            return
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        self.loop.close()
+        self.loop = None
+
+    async def shutdown(self):
+        if self.server is not None:
+            self.server.close()
+        for connection in self.connections.values():
+            connection.task.cancel()
+            connection.close_writer()
+        for writer in list(self.inbound_writers):
+            writer.close()
+        await asyncio.gather(*(c.task for c in self.connections.values()), return_exceptions=True)
+        self.connections.clear()
+
+    def get_connection(self, peer: Tuple[str, int]) -> "PeerTransport.PeerConnection":
+        peer = tuple(peer)
+        connection = self.connections.get(peer)
+        if connection is None:
+            connection = self.connections[peer] = self.PeerConnection(self, peer)
+        return connection
+
+    async def send(self, peer: Tuple[str, int], payload: bytes):
+        # Waits while the peer's queue is full, pushing backpressure onto the producer.
+        await self.get_connection(peer).queue.put(payload)
+
+    def send_threadsafe(self, peer: Tuple[str, int], payload: bytes, timeout: float = 1.0) -> bool:
+        if not self.running:
+            return False
+        if len(payload) > self.MAX_PAYLOAD_BYTES:
+            # Over the frame cap once sealed: rejected here rather than queued and retried on every reconnect.
+            self.stats["dropped"] += 1
+            return False
+        future = asyncio.run_coroutine_threadsafe(self.send(peer, payload), self.loop)
+        try:
+            future.result(timeout)
+            return True
+        except TimeoutError:
+            # A peer that cannot drain its queue in time loses the frame rather than stalling the node.
+            future.cancel()
+            self.stats["dropped"] += 1
+            return False
+
+    async def handle_inbound(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        self.inbound_writers.add(writer)
+        session = None
+        try:
+            channel = await asyncio.wait_for(SecureChannel.accept(reader, writer, self.private_key), self.connect_timeout)
+            if not self.authorize(channel.remote_public_key):
+                raise ValueError("peer is not authorized")
+            session = self.InboundSession(self, writer, channel, peer)
+            while True:
+                payload = channel.decrypt(await self.read_frame(reader))
+                self.stats["frames_received"] += 1
+                self.stats["bytes_received"] += len(payload)
+                # Handlers verify signatures and touch chain state, so keep them off the loop;
+                # awaiting each one preserves per-connection ordering.
+                await self.loop.run_in_executor(None, self.dispatch, payload, session)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except ValueError as e:
+            print(f"Dropping connection from {peer}: {e}")
+        finally:
+            if session is not None:
+                session.closed = True
+            self.inbound_writers.discard(writer)
+            writer.close()
+
+    def dispatch(self, payload: bytes, peer):
+        try:
+            self.on_message(payload, peer)
+        except Exception as e:
+            print(f"Error handling message from {peer}: {e}")
+
+    def metrics(self) -> Dict[str, Any]:
+        return dict(self.stats, peers={
+            f"{host}:{port}": {"connected": c.connected, "queued": c.queue.qsize(), "reconnects": c.reconnects}
+            for (host, port), c in self.connections.items()
+        })
+
+class ChainSync:
+    # Headers-first catch-up. A shard's headers come from the tallest peer and are checked for
+    # linkage and proof of work before any body is requested. Bodies are then fetched in ranges
+    # from every peer that has them, up to max_in_flight requests at a time, and applied in order
+    # while later ranges are still downloading. Progress is the local chain itself, so a node with
+    # a persistent block store resumes an interrupted sync from its stored height.
+    MAX_HEADERS_PER_MESSAGE = 2000
+    MAX_BLOCKS_PER_MESSAGE = 256
+    MAX_BLOCK_BYTES_PER_MESSAGE = 4 * 2**20
+
+    def __init__(self, node, headers_per_request: int = 2000, blocks_per_request: int = 64,
+                 max_in_flight: int = 8, request_timeout: float = 10.0, max_retries: int = 3):
+        self.node = node
+        self.headers_per_request = min(headers_per_request, self.MAX_HEADERS_PER_MESSAGE)
+        self.blocks_per_request = min(blocks_per_request, self.MAX_BLOCKS_PER_MESSAGE)
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.peer_heights: Dict[Tuple[str, int], List[int]] = {}
+        self.banned = set()
+        self.pending: Dict[int, concurrent.futures.Future] = {}
+        self.request_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.rerun = False
+        self.targets: Dict[int, int] = {}
+        self.stats = Counter()
+
+    def heights(self) -> List[int]:
+        return [len(shard.chain) for shard in self.node.blockchain.shards]
+
+    def update_peer(self, peer: Tuple[str, int], heights: List[int]):
+        if peer in self.banned:
+            return
+        self.peer_heights[peer] = list(heights)
+        if any(height > local for height, local in zip(heights, self.heights())):
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                # The running pass picks up the new peer heights before it exits.
+                self.rerun = True
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def wait(self, timeout: float = None) -> bool:
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+        return self.thread is None
+
+    def run(self):
+        while True:
+            progressed = False
+            for shard_id in range(len(self.node.blockchain.shards)):
+                progressed = self.sync_shard(shard_id) or progressed
+            with self.lock:
+                if not (progressed or self.rerun):
+                    self.thread = None
+                    break
+                self.rerun = False
+        self.node.blockchain.visualization.update_blockchain(self.node.blockchain)
+
+    def progress(self) -> Dict[str, Any]:
+        heights = self.heights()
+        return {
+            "syncing": self.thread is not None,
+            "shards": [{"height": height, "target": max(self.targets.get(i, 0), height)}
+                       for i, height in enumerate(heights)],
+            **self.stats
+        }
+
+    def sync_shard(self, shard_id: int) -> bool:
+        chain = self.node.blockchain.shards[shard_id].chain
+        local = len(chain)
+        peers = sorted((peer for peer, heights in self.peer_heights.items()
+                        if heights[shard_id] > local and peer not in self.banned),
+                       key=lambda peer: -self.peer_heights[peer][shard_id])
+        if not peers:
+            return False
+        self.targets[shard_id] = self.peer_heights[peers[0]][shard_id]
+        headers = self.fetch_headers(shard_id, peers[0], local, chain[-1].hash)
+        if headers:
+            self.fetch_bodies(shard_id, headers, peers)
+        return len(chain) > local
+
+    def fetch_headers(self, shard_id: int, peer: Tuple[str, int], start: int, tip_hash: str) -> List[BlockHeader]:
+        consensus = self.node.blockchain.consensus
+        target = self.peer_heights[peer][shard_id]
+        headers = []
+        previous_hash = tip_hash
+        while start + len(headers) < target:
+            index = start + len(headers)
+            try:
+                batch = self.call(peer, 'get_headers', shard=shard_id, start=index,
+                                  count=min(self.headers_per_request, target - index))
+            except (concurrent.futures.TimeoutError, ConnectionError, ValueError):
+                self.stats["failed_requests"] += 1
+                break
+            if not batch:
+                break
+            for header in batch:
+                if (header.index != start + len(headers) or header.previous_hash != previous_hash or
+                        not consensus.validate_header(header)):
+                    # Keep the verified prefix, and stop syncing from a peer that served a bad header.
+                    print(f"Invalid header {header.index} for shard {shard_id} from {peer}")
+                    self.stats["invalid_headers"] += 1
+                    self.banned.add(peer)
+                    return headers
+                headers.append(header)
+                previous_hash = header.hash
+            self.stats["headers"] += len(batch)
+        return headers
+
+    def fetch_bodies(self, shard_id: int, headers: List[BlockHeader], peers: List[Tuple[str, int]]):
+        ranges = [headers[i:i + self.blocks_per_request] for i in range(0, len(headers), self.blocks_per_request)]
+        in_flight = {}
+        try:
+            for i in range(len(ranges)):
+                for j in range(i, min(i + self.max_in_flight, len(ranges))):
+                    if j not in in_flight:
+                        in_flight[j] = self.request_range(shard_id, ranges[j], peers, j)
+                batch, attempts = ranges[i], 0
+                while batch:
+                    request_id, future = in_flight.pop(i)
+                    try:
+                        blocks = self.wait_for(request_id, future)
+                    except (concurrent.futures.TimeoutError, ConnectionError, ValueError):
+                        blocks = []
+                    # Peers may return fewer blocks than asked; each must match its verified header.
+                    valid = 0 < len(blocks) <= len(batch) and all(
+                        block.header().to_bytes() == header.to_bytes() for block, header in zip(blocks, batch)
+                    )
+                    if valid:
+                        applied = 0
+                        with self.node.chain_lock:
+                            for block in blocks:
+                                if not self.node.blockchain.append_block(shard_id, block):
+                                    break
+                                applied += 1
+                        self.stats["blocks"] += applied
+                        if applied < len(blocks):
+                            # The verified headers commit to these transactions, so their source is at fault.
+                            print(f"Invalid transactions in block {blocks[applied].index} for shard {shard_id}")
+                            self.stats["invalid_blocks"] += 1
+                            self.banned.add(peers[0])
+                            return
+                        batch, attempts = batch[len(blocks):], 0
+                    else:
+                        self.stats["failed_requests"] += 1
+                        attempts += 1
+                        if attempts > self.max_retries:
+                            return
+                    if batch:
+                        in_flight[i] = self.request_range(shard_id, batch, peers, i + attempts)
+        finally:
+            for request_id, _ in in_flight.values():
+                self.forget(request_id)
+
+    def request_range(self, shard_id: int, headers: List[BlockHeader], peers: List[Tuple[str, int]], turn: int):
+        # Spread ranges across every peer tall enough to serve them; retries rotate to the next one.
+        end = headers[-1].index
+        eligible = [peer for peer in peers if self.peer_heights[peer][shard_id] > end] or peers[:1]
+        return self.request(eligible[turn % len(eligible)], 'get_blocks', shard=shard_id,
+                            start=headers[0].index, count=len(headers))
+
+    def request(self, peer: Tuple[str, int], message_type: str, **fields):
+        request_id = next(self.request_ids)
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.pending[request_id] = future
+        message = dict(fields, type=message_type, request_id=request_id)
+        message['from'] = self.node.address
+        if not self.node.send_message_to_peer(peer, json.dumps(message)):
+            self.forget(request_id)
+            future.set_exception(ConnectionError(f"Could not reach {peer}"))
+        return request_id, future
+
+    def call(self, peer: Tuple[str, int], message_type: str, **fields):
+        return self.wait_for(*self.request(peer, message_type, **fields))
+
+    def wait_for(self, request_id: int, future: concurrent.futures.Future):
+        try:
+            return future.result(self.request_timeout)
+        finally:
+            self.forget(request_id)
+
+    def forget(self, request_id: int):
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+    def resolve(self, request_id: int, decode: Callable[[], Any]):
+        # Decoding runs on the transport's handler thread, overlapping the sync thread's work.
+        with self.lock:
+            future = self.pending.pop(request_id, None)
+        if future is None:
+            return
+        try:
+            future.set_result(decode())
+        except (ValueError, struct.error) as e:
+            future.set_exception(ValueError(f"Malformed sync response: {e}"))
+
+    def resolve_headers(self, data: Dict[str, Any]):
+        def decode():
+            raw = base64.b64decode(data['headers'])
+            headers, offset = [], 0
+            while offset < len(raw):
+                header, offset = BlockHeader.from_bytes(raw, offset)
+                headers.append(header)
+            return headers
+        self.resolve(data['request_id'], decode)
+
+    def resolve_blocks(self, data: Dict[str, Any]):
+        self.resolve(data['request_id'], lambda: [Block.from_bytes(base64.b64decode(block)) for block in data['blocks']])
+
+    def serve_headers(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        headers = self.node.blockchain.get_headers(data['shard'], data['start'],
+                                                   min(data['count'], self.MAX_HEADERS_PER_MESSAGE))
+        return {'type': 'headers', 'request_id': data['request_id'],
+                'headers': base64.b64encode(b"".join(header.to_bytes() for header in headers)).decode()}
+
+    def serve_blocks(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        encoded, size = [], 0
+        for block in self.node.blockchain.get_blocks(data['shard'], data['start'],
+                                                     min(data['count'], self.MAX_BLOCKS_PER_MESSAGE)):
+            raw = block.to_bytes()
+            # Always send at least one block; the requester asks again for whatever is cut off.
+            if encoded and size + len(raw) > self.MAX_BLOCK_BYTES_PER_MESSAGE:
+                break
+            encoded.append(base64.b64encode(raw).decode())
+            size += len(raw)
+        self.stats["served_blocks"] += len(encoded)
+        return {'type': 'blocks', 'request_id': data['request_id'], 'blocks': encoded}
 
 class QuantumFuseNode:
-    def __init__(self, host: str, port: int, stake: float):
+    def __init__(self, host: str, port: int, stake: float, gossip_fanout: int = 8,
+                 seen_cache_size: int = 100_000, relay_cache_size: int = 10_000, request_timeout: float = 5.0,
+                 num_shards: int = 3, difficulty: int = 4, data_dir: str = None, rejected_ttl: float = 30.0):
         self.host = host
         self.port = port
         self.stake = stake  # PoS stake for validation priority
         self.peers: List[Tuple[str, int]] = []
-        self.blockchain = QuantumFuseBlockchain(num_shards=3, difficulty=4)
-        self.pending_transactions = []
+        self.blockchain = QuantumFuseBlockchain(num_shards=num_shards, difficulty=difficulty, data_dir=data_dir)
+        self.chain_lock = threading.Lock()
+        self.pending_transactions = Mempool()
         self.multi_sig_transactions = []
-        self.identity_registry = {}  # Store decentralized identities (DIDs)
+        # Decentralized identities (DIDs); the blockchain's registry, so keys are parsed and cached in one place.
+        self.identity_registry = self.blockchain.identity_manager
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
         self.private_key, self.public_key = self.generate_rsa_keys()
         self.on_ramp = QFCOnRamp(self.blockchain)
+        self.signature_verifier = SignatureVerifier()
+        self.transport: Optional[PeerTransport] = None
+        # Gossip state: hashes already accepted, hashes recently rejected (hash -> retry time; an item
+        # can become valid later, e.g. once its sender's identity is registered), bodies we can serve
+        # to getdata, and fetches in flight.
+        self.gossip_fanout = gossip_fanout
+        self.seen = LRUCache(seen_cache_size)
+        self.rejected = LRUCache(seen_cache_size)
+        self.rejected_ttl = rejected_ttl
+        self.relay_cache = LRUCache(relay_cache_size)
+        self.requested: Dict[str, float] = {}
+        self.request_timeout = request_timeout
+        self.gossip_lock = threading.Lock()
+        self.gossip_stats = Counter()
+        self.chain_sync = ChainSync(self)
 
     def generate_rsa_keys(self):
         private_key = rsa.generate_private_key(
@@ -37,130 +700,274 @@ class QuantumFuseNode:
         public_key = private_key.public_key()
         return private_key, public_key
 
-    def start(self):
+    def start(self, interactive: bool = True):
+        # interactive=False serves peers in the background and returns, for headless nodes.
         print(f"QuantumFuse Node starting on {self.host}:{self.port}")
-        threading.Thread(target=self.listen_for_peers, daemon=True).start()
-        threading.Thread(target=self.visualizer.start, daemon=True).start()
-        self.run()
+        self.listen_for_peers()
+        if interactive:
+            threading.Thread(target=self.blockchain.visualization.start, daemon=True).start()
+            self.run()
+
+    def stop(self):
+        if self.transport is not None:
+            self.transport.stop()
+        self.server_socket.close()
+        self.signature_verifier.shutdown()
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        # The bound address, so nodes started on port 0 advertise where they actually listen.
+        return self.server_socket.getsockname()[:2]
+
+    @property
+    def miner_address(self) -> str:
+        # Chain accounts are strings; block rewards go to the node's "host:port".
+        return "%s:%d" % self.address
 
     def listen_for_peers(self):
-        while True:
-            client_socket, address = self.server_socket.accept()
-            threading.Thread(target=self.handle_peer, args=(client_socket,), daemon=True).start()
+        # Created on start so an idle node holds no reference cycle through the transport's callback.
+        if self.transport is None:
+            self.transport = PeerTransport(self.handle_frame, self.private_key)
+        if not self.transport.running:
+            self.transport.start(self.server_socket)
 
-    def handle_peer(self, client_socket):
-        while True:
-            try:
-                message = client_socket.recv(4096).decode()
-                if message:
-                    self.process_message(message)
-            except Exception as e:
-                print(f"Error handling peer: {e}")
-                break
-        client_socket.close()
+    def handle_frame(self, payload: bytes, peer):
+        self.process_message(payload.decode(), peer)
 
-    def process_message(self, message: str):
+    def process_message(self, message: str, session=None):
+        # session is how the message reached us: the inbound session it arrived on, or the address of
+        # a peer we dialed. Requests are answered there, never at the self-declared 'from' address,
+        # which is only used to skip a peer we already know when relaying.
         try:
             data = json.loads(message)
-            if data['type'] == 'transaction':
-                self.add_transaction(data['transaction'])
+            claimed = tuple(data['from']) if data.get('from') else None
+            exclude = claimed if claimed in self.peers else None
+            origin = session
+            if data['type'] == 'inv':
+                self.handle_inv(data['items'], origin)
+            elif data['type'] == 'getdata':
+                self.handle_getdata(data['items'], origin)
+            elif data['type'] == 'transaction':
+                self.add_transactions([data['transaction']], exclude)
             elif data['type'] == 'multi_sig_transaction':
                 self.add_multi_sig_transaction(data['transaction'])
             elif data['type'] == 'block':
-                self.add_block(data['block'])
+                self.add_block(data['block'], exclude)
             elif data['type'] == 'sync_request':
-                self.sync_chain(data['from'])
+                # Answer with our heights; replying with another sync_request would ping-pong forever.
+                if origin is None:
+                    return
+                self.chain_sync.update_peer(origin, data['heights'])
+                self.send_message_to_peer(origin, json.dumps({
+                    'type': 'sync_status', 'from': self.address, 'heights': self.chain_sync.heights()
+                }))
+            elif data['type'] == 'sync_status' and origin is not None:
+                self.chain_sync.update_peer(origin, data['heights'])
+            elif data['type'] == 'get_headers' and origin is not None:
+                self.send_message_to_peer(origin, json.dumps(self.chain_sync.serve_headers(data)))
+            elif data['type'] == 'get_blocks' and origin is not None:
+                self.send_message_to_peer(origin, json.dumps(self.chain_sync.serve_blocks(data)))
+            elif data['type'] == 'headers':
+                self.chain_sync.resolve_headers(data)
+            elif data['type'] == 'blocks':
+                self.chain_sync.resolve_blocks(data)
         except json.JSONDecodeError:
             print("Received invalid message")
 
-    def add_transaction(self, transaction_data: Dict[str, Any]):
-        transaction = Transaction(**transaction_data)
-        if self.verify_transaction(transaction):
-            self.pending_transactions.append(transaction)
-            self.broadcast_transaction(transaction)
-            print(f"Transaction added: {transaction}")
+    def handle_inv(self, items: List[List[str]], origin: Any):
+        # Fetch only bodies we have not handled and nobody is already sending us.
+        now = time.monotonic()
+        wanted = []
+        with self.gossip_lock:
+            for kind, item_hash in items:
+                if (item_hash in self.seen or self.requested.get(item_hash, 0) > now or
+                        self.rejected.get(item_hash, 0) > now):
+                    continue
+                self.requested[item_hash] = now + self.request_timeout
+                wanted.append([kind, item_hash])
+            if len(self.requested) > self.seen.capacity:
+                self.requested = {h: deadline for h, deadline in self.requested.items() if deadline > now}
+        if wanted and origin is not None:
+            self.gossip_stats["getdata_sent"] += 1
+            self.send_message_to_peer(origin, json.dumps({'type': 'getdata', 'from': self.address, 'items': wanted}))
+
+    def handle_getdata(self, items: List[List[str]], origin: Any):
+        if origin is None:
+            return
+        for kind, item_hash in items:
+            body = self.relay_cache.get(item_hash)
+            if body is not None:
+                self.gossip_stats["bodies_sent"] += 1
+                self.send_message_to_peer(origin, body)
+
+    def announce(self, items: List[Tuple[str, str, str]], exclude: Optional[Tuple[str, int]] = None):
+        # items are (kind, hash, body message); bodies stay in the relay cache until a peer asks.
+        for kind, item_hash, body in items:
+            self.seen.add(item_hash)
+            self.relay_cache.add(item_hash, body)
+        peers = [peer for peer in self.peers if tuple(peer) != exclude]
+        if not peers or not items:
+            return
+        message = json.dumps({
+            'type': 'inv',
+            'from': self.address,
+            'items': [[kind, item_hash] for kind, item_hash, _ in items]
+        })
+        for peer in random.sample(peers, min(self.gossip_fanout, len(peers))):
+            self.gossip_stats["inv_sent"] += 1
+            self.send_message_to_peer(peer, message)
+
+    def add_transaction(self, transaction_data: Dict[str, Any]) -> bool:
+        return self.add_transactions([transaction_data])[0]
+
+    def add_transactions(self, transactions_data: List[Dict[str, Any]],
+                         origin: Optional[Tuple[str, int]] = None) -> List[bool]:
+        transactions = []
+        for data in transactions_data:
+            try:
+                transactions.append(Transaction.from_dict(data))
+            except (KeyError, TypeError, ValueError):
+                transactions.append(None)  # Malformed; rejected without aborting the rest of the batch.
+        results = [False] * len(transactions)
+        # Anything already accepted, or rejected within the retry window, is dropped before
+        # verification, so gossip cannot echo. Hashes are marked seen only once accepted.
+        now = time.monotonic()
+        parsed = [i for i, transaction in enumerate(transactions) if transaction is not None]
+        fresh, batch_hashes = [], set()
+        for i in parsed:
+            tx_hash = transactions[i].calculate_hash()
+            if tx_hash not in self.seen and tx_hash not in batch_hashes and self.rejected.get(tx_hash, 0) <= now:
+                batch_hashes.add(tx_hash)
+                fresh.append(i)
+        self.gossip_stats["malformed_dropped"] += len(transactions) - len(parsed)
+        self.gossip_stats["duplicates_dropped"] += len(parsed) - len(fresh)
+        accepted = []
+        for i, valid in zip(fresh, self.verify_transactions([transactions[i] for i in fresh])):
+            # Transactions evicted for low fees are not announced either.
+            if valid and self.pending_transactions.add(transactions[i]):
+                self.seen.add(transactions[i].calculate_hash())
+                results[i] = True
+                accepted.append(transactions[i])
+                print(f"Transaction added: {transactions[i]}")
+            else:
+                self.rejected.set(transactions[i].calculate_hash(), now + self.rejected_ttl)
+        if accepted:
+            self.broadcast_transactions(accepted, exclude=origin)
+        return results
 
     def add_multi_sig_transaction(self, transaction_data: Dict[str, Any]):
-        transaction = Transaction(**transaction_data)
+        transaction = Transaction.from_dict(transaction_data)
         if self.verify_multi_sig_transaction(transaction):
             self.multi_sig_transactions.append(transaction)
             self.broadcast_transaction(transaction)
             print(f"Multi-Sig Transaction added: {transaction}")
 
     def verify_transaction(self, transaction: Transaction) -> bool:
-        return transaction.amount > 0 and self.verify_identity(transaction.sender)
+        return self.verify_transactions([transaction])[0]
+
+    def verify_transactions(self, transactions: List[Transaction]) -> List[bool]:
+        # Cheap checks first; only the survivors go through the batched signature pipeline.
+        results = [transaction.amount > 0 and self.verify_identity(transaction.sender) for transaction in transactions]
+        to_verify = [i for i, passed in enumerate(results) if passed]
+        signature_results = self.signature_verifier.verify_batch(
+            [transactions[i] for i in to_verify],
+            self.identity_registry.get_public_keys(transactions[i].sender for i in to_verify)
+        )
+        for i, valid in zip(to_verify, signature_results):
+            results[i] = valid
+        return results
 
     def verify_multi_sig_transaction(self, transaction: Transaction) -> bool:
-        valid_sigs = sum(1 for sig in transaction.signatures if self.verify_signature(sig, transaction))
-        return valid_sigs >= len(transaction.signatures) // 2 + 1
+        # Each signer counts once, however many signatures it attached.
+        signatures = list({sig["signer"]: sig for sig in transaction.signatures}.values())
+        if not signatures:
+            return False
+        results = self.signature_verifier.verify_batch(
+            [transaction] * len(signatures),
+            self.identity_registry.get_public_keys(sig["signer"] for sig in signatures),
+            [sig["signature"] for sig in signatures]
+        )
+        return sum(results) >= len(signatures) // 2 + 1
 
     def verify_identity(self, identity: str) -> bool:
         return identity in self.identity_registry
 
-    def verify_signature(self, signature: str, transaction: Transaction) -> bool:
-        # Implement signature verification logic
-        return True  # Placeholder
+    def get_public_key(self, identity: str):
+        return self.identity_registry.get_public_key(identity)
+
+    def verify_signature(self, signature: Dict[str, str], transaction: Transaction) -> bool:
+        return self.signature_verifier.verify(
+            transaction, self.get_public_key(signature["signer"]), signature["signature"]
+        )
 
     def is_validator(self) -> bool:
         return random.random() < self.stake / 10
 
     def create_block(self):
         if self.is_validator():
-            new_block = self.blockchain.mine_block(self.public_key)
+            new_block = self.blockchain.mine_block(self.miner_address)
             if new_block:
                 self.broadcast_block(new_block)
                 print(f"New block created and broadcasted: {new_block}")
 
-    def add_block(self, block_data: Dict[str, Any]):
-        block = Block(**block_data)
-        if self.blockchain.add_block(block):
-            self.visualizer.update_blockchain(self.blockchain)
+    def add_block(self, block_data: Dict[str, Any], origin: Optional[Tuple[str, int]] = None):
+        block = Block.from_dict(block_data)
+        now = time.monotonic()
+        if block.hash in self.seen or self.rejected.get(block.hash, 0) > now:
+            return
+        with self.chain_lock:
+            added = self.blockchain.add_block(block)
+        if added:
+            self.seen.add(block.hash)
+            self.broadcast_block(block, exclude=origin)
+        else:
+            # A block can arrive before its parent; let it be retried once the window passes.
+            self.rejected.set(block.hash, now + self.rejected_ttl)
 
     def sync_chain(self, peer: Tuple[str, int]):
-        latest_block = self.blockchain.get_latest_block()
+        # The peer answers with its shard heights; ChainSync downloads anything we are missing.
         sync_message = json.dumps({
             'type': 'sync_request',
-            'from': (self.host, self.port),
-            'latest_block_index': latest_block.index
+            'from': self.address,
+            'heights': self.chain_sync.heights()
         })
         self.send_message_to_peer(peer, sync_message)
 
     def broadcast_transaction(self, transaction: Transaction):
-        message = json.dumps({
-            'type': 'transaction',
-            'transaction': transaction.__dict__
-        })
-        self.broadcast_message(message)
+        self.broadcast_transactions([transaction])
 
-    def broadcast_block(self, block: Block):
-        message = json.dumps({
+    def broadcast_transactions(self, transactions: List[Transaction], exclude: Optional[Tuple[str, int]] = None):
+        self.announce([
+            ('transaction', transaction.calculate_hash(), json.dumps({
+                'type': 'transaction',
+                'from': self.address,
+                'transaction': transaction.to_dict()
+            }))
+            for transaction in transactions
+        ], exclude)
+
+    def broadcast_block(self, block: Block, exclude: Optional[Tuple[str, int]] = None):
+        self.announce([('block', block.hash, json.dumps({
             'type': 'block',
-            'block': block.__dict__
-        })
-        self.broadcast_message(message)
+            'from': self.address,
+            'block': block.to_dict()
+        }))], exclude)
 
     def broadcast_message(self, message: str):
         for peer in self.peers:
             self.send_message_to_peer(peer, message)
 
-    def send_message_to_peer(self, peer: Tuple[str, int], message: str):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(peer)
-                encrypted_message = self.encrypt_message(message)
-                s.sendall(encrypted_message)
-        except Exception as e:
-            print(f"Failed to send message to {peer}: {e}")
-
-    def encrypt_message(self, message: str) -> bytes:
-        return self.public_key.encrypt(
-            message.encode(),
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+    def send_message_to_peer(self, peer, message: str) -> bool:
+        # To an address: queued onto our persistent connection to it. To an inbound session: written
+        # back over that session. False if the transport is down or the queue stayed full.
+        if isinstance(peer, PeerTransport.InboundSession):
+            sent = peer.reply(message.encode())
+        else:
+            sent = self.transport is not None and self.transport.send_threadsafe(peer, message.encode())
+        if not sent:
+            print(f"Failed to send message to {peer}")
+            return False
+        return True
 
     def connect_to_peer(self, peer_address: Tuple[str, int]):
         if peer_address not in self.peers:
@@ -178,7 +985,7 @@ class QuantumFuseNode:
                 recipient = input("Enter recipient: ")
                 amount = float(input("Enter amount: "))
                 tx = Transaction(sender, recipient, amount)
-                self.add_transaction(tx.__dict__)
+                self.add_transaction(tx.to_dict())
             elif command == "balance":
                 address = input("Enter address: ")
                 balance = self.blockchain.get_balance(address)
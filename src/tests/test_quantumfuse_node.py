@@ -1,44 +1,61 @@
+import asyncio
+import base64
+import json
+import queue
+import socket
+import time
 import unittest
 from unittest.mock import patch, MagicMock
-from quantumfuse_blockchain import Transaction
-from quantumfuse_node import QuantumFuseNode
+from quantumfuse_blockchain import Transaction, Block
+from quantumfuse_node import QuantumFuseNode, PeerTransport, SecureChannel, LRUCache
+from cryptography.hazmat.primitives.asymmetric import rsa
 
 
 class TestQuantumFuseNode(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        cls.alice_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
     def setUp(self):
         self.node = QuantumFuseNode('localhost', 5000, stake=0.8)
+        self.node.identity_registry["Alice"] = self.alice_key.public_key()
+
+    def signed_transaction_data(self, amount):
+        transaction = Transaction('Alice', 'Bob', amount, 'QFC')
+        transaction.sign_transaction(self.alice_key)
+        return transaction.to_dict()
+
+    def tearDown(self):
+        self.node.stop()
 
     @patch('quantumfuse_node.socket.socket')
     def test_add_transaction(self, mock_socket):
-        # Mock the transaction process
-        transaction_data = {
+        # Transactions are only accepted with a valid signature from a registered sender
+        unsigned = {
             'sender': 'Alice',
             'recipient': 'Bob',
-            'amount': 100,
+            'amount': 50,
             'asset': 'QFC'
         }
-        self.node.add_transaction(transaction_data)
+        self.assertFalse(self.node.add_transaction(unsigned))
+        self.assertTrue(self.node.add_transaction(self.signed_transaction_data(100)))
 
         # Assert that the transaction is in pending transactions
         self.assertEqual(len(self.node.pending_transactions), 1,
-                         "Transaction should be added to pending transactions")
+                         "Only the signed transaction should be added to pending transactions")
 
     @patch('quantumfuse_node.socket.socket')
     def test_mine_block(self, mock_socket):
-        # Mock a valid transaction
-        transaction_data = {
-            'sender': 'Alice',
-            'recipient': 'Bob',
-            'amount': 100,
-            'asset': 'QFC'
-        }
-        self.node.add_transaction(transaction_data)
+        # A valid transaction
+        self.assertTrue(self.node.add_transaction(self.signed_transaction_data(100)))
 
-        # Test block creation
-        with patch.object(self.node.blockchain, 'mine_block', return_value=MagicMock()) as mock_mine:
+        # Test block creation once the node is picked as validator
+        with patch.object(self.node, 'is_validator', return_value=True), \
+                patch.object(self.node, 'broadcast_block'), \
+                patch.object(self.node.blockchain, 'mine_block', return_value=MagicMock()) as mock_mine:
             self.node.create_block()
-            self.assertTrue(mock_mine.called, "Mine block should be called")
+            mock_mine.assert_called_once_with(self.node.miner_address)
 
     @patch('quantumfuse_node.socket.socket')
     @patch('requests.post')
@@ -67,9 +84,364 @@ class TestQuantumFuseNode(unittest.TestCase):
     @patch('quantumfuse_node.socket.socket')
     def test_listen_for_peers(self, mock_socket):
         # This test will simply check that the listening thread starts without errors
-        with patch.object(self.node, 'listen_for_peers', return_value=None) as mock_listen:
+        # The render loop and the command prompt never return, so neither is run here
+        with patch.object(self.node, 'listen_for_peers', return_value=None) as mock_listen, \
+                patch('quantumfuse_node.threading.Thread') as mock_thread, patch.object(self.node, 'run') as mock_run:
             self.node.start()
             self.assertTrue(mock_listen.called, "Listening for peers should be initiated")
+            self.assertTrue(mock_run.called)
+        self.assertEqual(mock_thread.call_args.kwargs['target'], self.node.blockchain.visualization.start,
+                         "The chain's visualization should render in the background")
+
+
+class TestQuantumFuseNodeSignatures(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = {name: rsa.generate_private_key(public_exponent=65537, key_size=2048)
+                    for name in ("Alice", "Bob", "Carol")}
+
+    def setUp(self):
+        self.node = QuantumFuseNode('localhost', 0, stake=0.8)
+        for name, private_key in self.keys.items():
+            self.node.identity_registry[name] = private_key.public_key()
+
+    def tearDown(self):
+        self.node.stop()
+
+    def signed_transaction(self, sender, amount):
+        tx = Transaction(sender, "Dave", amount)
+        tx.sign_transaction(self.keys[sender])
+        return tx
+
+    def test_add_transactions_batch(self):
+        valid = self.signed_transaction("Alice", 10).to_dict()
+        forged = self.signed_transaction("Bob", 10).to_dict()
+        forged["amount"] = 10_000
+        unknown_sender = Transaction("Mallory", "Dave", 5).to_dict()
+        malformed = dict(self.signed_transaction("Alice", 5).to_dict(), signature="not hex")
+        with patch.object(self.node, 'broadcast_transactions') as mock_broadcast:
+            results = self.node.add_transactions([valid, forged, unknown_sender, malformed])
+        self.assertEqual(results, [True, False, False, False])
+        self.assertEqual(len(self.node.pending_transactions), 1)
+        self.assertEqual(len(mock_broadcast.call_args[0][0]), 1, "Only valid transactions should be rebroadcast")
+
+    def test_duplicate_transaction_is_not_rebroadcast(self):
+        tx = self.signed_transaction("Alice", 10).to_dict()
+        with patch.object(self.node, 'broadcast_transactions') as mock_broadcast:
+            self.assertTrue(self.node.add_transaction(tx))
+            self.assertFalse(self.node.add_transaction(tx))
+        self.assertEqual(mock_broadcast.call_count, 1)
+
+    def test_rejected_transaction_is_retried_after_the_window(self):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        tx = Transaction("Erin", "Dave", 10)
+        tx.sign_transaction(key)
+        with patch.object(self.node, 'broadcast_transactions'):
+            self.assertFalse(self.node.add_transaction(tx.to_dict()), "Erin's identity is not registered yet")
+            self.assertNotIn(tx.calculate_hash(), self.node.seen, "A rejected hash is not marked seen")
+            self.node.identity_registry["Erin"] = key.public_key()
+            self.assertFalse(self.node.add_transaction(tx.to_dict()), "Still inside the retry window")
+            self.node.rejected.set(tx.calculate_hash(), time.monotonic() - 1)
+            self.assertTrue(self.node.add_transaction(tx.to_dict()))
+        self.assertIn(tx.calculate_hash(), self.node.seen)
+
+    def test_create_block_mines_for_the_node_address(self):
+        blockchain = self.node.blockchain
+        coordinator = blockchain.cross_shard_coordinator
+        blockchain.add_balance("Alice", 10)
+        # Mine the shard whose mempool holds Alice's transfer.
+        coordinator.assign_shards({self.node.miner_address: coordinator.get_shard_id("Alice")})
+        self.assertTrue(blockchain.add_transaction(self.signed_transaction("Alice", 10)))
+        with patch.object(self.node, 'is_validator', return_value=True), \
+                patch.object(self.node, 'broadcast_block') as mock_broadcast:
+            self.node.create_block()
+        self.assertTrue(mock_broadcast.called, "The mined block should be broadcast")
+        block = mock_broadcast.call_args[0][0]
+        shard = coordinator.get_shard_for_address(self.node.miner_address)
+        self.assertEqual(shard.get_latest_block().hash, block.hash)
+
+    def test_verify_multi_sig_transaction(self):
+        tx = Transaction("Alice", "Dave", 50)
+        for name in ("Alice", "Bob"):
+            signer_tx = Transaction.from_dict(tx.to_dict())
+            signer_tx.sign_transaction(self.keys[name])
+            tx.signatures.append({"signer": name, "signature": signer_tx.signature})
+        tx.signatures.append({"signer": "Carol", "signature": "00"})
+        self.assertTrue(self.node.verify_multi_sig_transaction(tx), "2 of 3 valid signatures is a majority")
+        tx.signatures[1]["signature"] = "00"
+        self.assertFalse(self.node.verify_multi_sig_transaction(tx), "1 of 3 valid signatures is not")
+
+    def test_inv_fetches_only_unknown_items(self):
+        known = self.signed_transaction("Alice", 10)
+        self.node.seen.add(known.calculate_hash())
+        origin = ('127.0.0.1', 9)
+        with patch.object(self.node, 'send_message_to_peer') as mock_send:
+            self.node.handle_inv([["transaction", known.calculate_hash()], ["transaction", "ab" * 32]], origin)
+            self.node.handle_inv([["transaction", "ab" * 32]], origin)
+        self.assertEqual(mock_send.call_count, 1, "An item already requested is not fetched twice")
+        request = json.loads(mock_send.call_args[0][1])
+        self.assertEqual(request['type'], 'getdata')
+        self.assertEqual(request['items'], [["transaction", "ab" * 32]])
+
+    def test_announce_excludes_origin_and_serves_getdata(self):
+        self.node.peers = [('127.0.0.1', port) for port in range(10, 30)]
+        self.node.gossip_fanout = 4
+        tx = self.signed_transaction("Alice", 10)
+        with patch.object(self.node, 'send_message_to_peer') as mock_send:
+            self.node.broadcast_transactions([tx], exclude=('127.0.0.1', 10))
+            targets = [call[0][0] for call in mock_send.call_args_list]
+            self.assertEqual(len(targets), 4)
+            self.assertNotIn(('127.0.0.1', 10), targets)
+            mock_send.reset_mock()
+            self.node.handle_getdata([["transaction", tx.calculate_hash()]], ('127.0.0.1', 11))
+        body = json.loads(mock_send.call_args[0][1])
+        self.assertEqual(Transaction.from_dict(body['transaction']).calculate_hash(), tx.calculate_hash())
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_add_reports_first_sighting_and_evicts_oldest(self):
+        cache = LRUCache(2)
+        self.assertTrue(cache.add("a"))
+        self.assertFalse(cache.add("a"))
+        cache.add("b")
+        cache.add("a")
+        cache.add("c", "body")
+        self.assertNotIn("b", cache, "Least recently used entry is evicted")
+        self.assertIn("a", cache)
+        self.assertEqual(cache.get("c"), "body")
+
+
+class TestPeerTransport(unittest.TestCase):
+
+    def listening_transport(self, received, **kwargs):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.bind(('127.0.0.1', 0))
+        server_socket.listen(5)
+        transport = PeerTransport(lambda payload, peer: received.put(payload), **kwargs)
+        transport.start(server_socket)
+        self.addCleanup(transport.stop)
+        return transport, server_socket.getsockname()
+
+    def test_large_messages_are_framed_over_one_connection(self):
+        received = queue.Queue()
+        _, address = self.listening_transport(received)
+        sender = PeerTransport(lambda payload, peer: None)
+        sender.start()
+        self.addCleanup(sender.stop)
+        payloads = [bytes([i]) * (64 * 1024 + i) for i in range(5)]
+        for payload in payloads:
+            self.assertTrue(sender.send_threadsafe(address, payload))
+        self.assertEqual([received.get(timeout=5) for _ in payloads], payloads)
+        self.assertEqual(len(sender.connections), 1)
+        self.assertEqual(sender.stats["reconnects"], 0)
+
+    def test_oversized_payload_is_dropped_not_retried(self):
+        received = queue.Queue()
+        _, address = self.listening_transport(received)
+        sender = PeerTransport(lambda payload, peer: None)
+        sender.start()
+        self.addCleanup(sender.stop)
+        self.assertFalse(sender.send_threadsafe(address, b"x" * (PeerTransport.MAX_PAYLOAD_BYTES + 1)),
+                         "The cap applies to the sealed frame, tag included")
+        self.assertTrue(sender.send_threadsafe(address, b"after"))
+        self.assertEqual(received.get(timeout=5), b"after")
+        self.assertEqual((sender.stats["dropped"], sender.stats["reconnects"]), (1, 0))
+
+    def test_full_queue_applies_backpressure(self):
+        # Nothing listens on this port, so the queue never drains.
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            address = s.getsockname()
+        sender = PeerTransport(lambda payload, peer: None, queue_size=1, initial_backoff=10)
+        sender.start()
+        self.addCleanup(sender.stop)
+        results = [sender.send_threadsafe(address, b"x", timeout=0.2) for _ in range(3)]
+        self.assertIn(False, results)
+        self.assertGreaterEqual(sender.stats["dropped"], 1)
+
+    def test_headless_nodes_exchange_messages(self):
+        node_a = QuantumFuseNode('127.0.0.1', 0, stake=0.8)
+        node_b = QuantumFuseNode('127.0.0.1', 0, stake=0.8)
+        for node in (node_a, node_b):
+            node.start(interactive=False)
+            self.addCleanup(node.stop)
+        received = queue.Queue()
+        with patch.object(node_b, 'process_message', side_effect=received.put):
+            node_a.peers.append(node_b.server_socket.getsockname())
+            message = '{"type": "ping", "padding": "%s"}' % ("p" * 10_000)
+            node_a.broadcast_message(message)
+            self.assertEqual(received.get(timeout=5), message)
+
+    def test_requests_are_answered_on_the_arriving_session(self):
+        node = QuantumFuseNode('127.0.0.1', 0, stake=0.8)
+        node.start(interactive=False)
+        self.addCleanup(node.stop)
+        received = queue.Queue()
+        client = PeerTransport(lambda payload, peer: received.put((json.loads(payload), peer)))
+        client.start()
+        self.addCleanup(client.stop)
+        spoofed = ('127.0.0.1', 9)
+        request = {'type': 'sync_request', 'from': spoofed, 'heights': [1, 1, 1]}
+        self.assertTrue(client.send_threadsafe(node.address, json.dumps(request).encode()))
+        reply, peer = received.get(timeout=5)
+        self.assertEqual((reply['type'], reply['heights']), ('sync_status', node.chain_sync.heights()))
+        self.assertEqual(peer, node.address, "The answer comes back over the connection we opened")
+        self.assertNotIn(spoofed, node.transport.connections, "The claimed address is never dialed")
+
+    def test_transaction_gossips_across_a_line_of_nodes(self):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        nodes = [QuantumFuseNode('127.0.0.1', 0, stake=0.8) for _ in range(3)]
+        for node in nodes:
+            node.identity_registry["Alice"] = key.public_key()
+            node.start(interactive=False)
+            self.addCleanup(node.stop)
+        for left, right in zip(nodes, nodes[1:]):
+            left.peers.append(right.address)
+            right.peers.append(left.address)
+        tx = Transaction("Alice", "Bob", 5)
+        tx.sign_transaction(key)
+        self.assertTrue(nodes[0].add_transaction(tx.to_dict()))
+        deadline = time.time() + 10
+        while tx.calculate_hash() not in nodes[2].pending_transactions and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIn(tx.calculate_hash(), nodes[2].pending_transactions)
+        self.assertEqual(nodes[0].gossip_stats["getdata_sent"], 0, "The origin is never offered its own transaction")
+
+
+class TestSecureChannel(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.initiator_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        cls.responder_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def handshake(self, responder_key=None):
+        async def run():
+            accepted = asyncio.get_running_loop().create_future()
+
+            async def on_connect(reader, writer):
+                try:
+                    accepted.set_result(await SecureChannel.accept(reader, writer, responder_key or self.responder_key))
+                except ValueError as e:
+                    accepted.set_exception(e)
+                    writer.close()
+
+            server = await asyncio.start_server(on_connect, '127.0.0.1', 0)
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+            try:
+                initiator = await SecureChannel.initiate(reader, writer, self.initiator_key)
+                return initiator, await accepted
+            finally:
+                writer.close()
+                server.close()
+        return asyncio.run(run())
+
+    def test_handshake_derives_matching_directional_keys(self):
+        initiator, responder = self.handshake()
+        large = b"b" * 100_000
+        self.assertEqual(responder.decrypt(initiator.encrypt(large)), large)
+        self.assertEqual(initiator.decrypt(responder.encrypt(b"ack")), b"ack")
+        self.assertEqual(initiator.remote_public_key.public_numbers(),
+                         self.responder_key.public_key().public_numbers())
+        self.assertEqual(responder.remote_public_key.public_numbers(),
+                         self.initiator_key.public_key().public_numbers())
+
+    def test_tampered_or_replayed_frames_are_rejected(self):
+        initiator, responder = self.handshake()
+        first = initiator.encrypt(b"first")
+        tampered = bytearray(initiator.encrypt(b"second"))
+        tampered[0] ^= 1
+        self.assertEqual(responder.decrypt(first), b"first")
+        with self.assertRaises(ValueError):
+            responder.decrypt(first)
+        with self.assertRaises(ValueError):
+            responder.decrypt(bytes(tampered))
+
+    def test_cap_applies_to_sealed_size(self):
+        initiator, responder = self.handshake()
+        largest = b"x" * PeerTransport.MAX_PAYLOAD_BYTES
+        sealed = initiator.encrypt(largest)
+        self.assertEqual(len(sealed), PeerTransport.MAX_FRAME_BYTES)
+        PeerTransport.encode_frame(sealed)
+        with self.assertRaises(ValueError):
+            initiator.encrypt(largest + b"x")
+        self.assertEqual(responder.decrypt(sealed), largest)
+        self.assertEqual(responder.decrypt(initiator.encrypt(b"next")), b"next",
+                         "A rejected frame does not use up a nonce")
+
+    def test_forged_hello_signature_is_rejected(self):
+        _, ephemeral_public = SecureChannel.ephemeral_keypair()
+        hello = bytearray(SecureChannel.encode_hello(self.initiator_key, SecureChannel.INITIATOR, ephemeral_public))
+        hello[0] ^= 1
+        with self.assertRaises(ValueError):
+            SecureChannel.decode_hello(bytes(hello), SecureChannel.INITIATOR)
+
+
+class TestChainSync(unittest.TestCase):
+
+    def make_node(self, **kwargs):
+        node = QuantumFuseNode('127.0.0.1', 0, stake=0.8, num_shards=2, difficulty=1)
+        node.chain_sync.blocks_per_request = kwargs.get("blocks_per_request", 16)
+        node.chain_sync.headers_per_request = kwargs.get("headers_per_request", 50)
+        node.start(interactive=False)
+        self.addCleanup(node.stop)
+        return node
+
+    def extend(self, node, shard_id, count):
+        pow_engine = node.blockchain.consensus.green_pow
+        for _ in range(count):
+            tip = node.blockchain.shards[shard_id].get_latest_block()
+            block = Block(tip.index + 1, [Transaction("Network", f"miner-{tip.index}", 1.0)], tip.hash)
+            block.nonce, block.hash = pow_engine._search_nonces(block.pow_data(), "wind", 1, 0, 1)
+            block.energy_source = "wind"
+            node.blockchain.append_block(shard_id, block)
+
+    def wait_for_heights(self, node, heights, timeout=20):
+        deadline = time.time() + timeout
+        while node.chain_sync.heights() != heights and time.time() < deadline:
+            time.sleep(0.02)
+        node.chain_sync.wait(timeout)
+        return node.chain_sync.heights()
+
+    def test_fresh_node_syncs_every_shard_from_two_peers(self):
+        sources = [self.make_node(), self.make_node()]
+        self.extend(sources[0], 0, 120)
+        self.extend(sources[0], 1, 30)
+        for shard_id in range(2):
+            for block in sources[0].blockchain.get_blocks(shard_id, 1, 1000):
+                sources[1].blockchain.append_block(shard_id, block)
+        fresh = self.make_node()
+        for source in sources:
+            fresh.connect_to_peer(source.address)
+        self.assertEqual(self.wait_for_heights(fresh, [121, 31]), [121, 31])
+        for shard_id in range(2):
+            self.assertEqual(fresh.blockchain.shards[shard_id].get_latest_block().hash,
+                             sources[0].blockchain.shards[shard_id].get_latest_block().hash)
+        self.assertEqual(fresh.blockchain.get_balance("miner-5"), 2.0, "Synced transactions are applied to state")
+        self.assertTrue(all(source.chain_sync.stats["served_blocks"] > 0 for source in sources),
+                        "Block ranges are spread across peers")
+
+    def test_invalid_headers_are_rejected(self):
+        source = self.make_node()
+        self.extend(source, 0, 10)
+        serve_headers = source.chain_sync.serve_headers
+
+        def forged(data):
+            headers = source.blockchain.get_headers(data['shard'], data['start'], data['count'])
+            headers[3].timestamp += 1
+            return dict(serve_headers(data), headers=base64.b64encode(b"".join(h.to_bytes() for h in headers)).decode())
+
+        fresh = self.make_node()
+        with patch.object(source.chain_sync, 'serve_headers', side_effect=forged):
+            fresh.connect_to_peer(source.address)
+            deadline = time.time() + 10
+            while not fresh.chain_sync.stats["invalid_headers"] and time.time() < deadline:
+                time.sleep(0.02)
+            fresh.chain_sync.wait(10)
+        self.assertEqual(fresh.chain_sync.stats["invalid_headers"], 1)
+        self.assertEqual(fresh.chain_sync.heights()[0], 4, "Only the verified header prefix is downloaded")
 
 
 if __name__ == "__main__":
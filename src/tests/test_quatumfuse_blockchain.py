@@ -1,5 +1,17 @@
+import json
+import os
+import tempfile
+import time
 import unittest
-from quantumfuse_blockchain import EnhancedQuantumFuseBlockchain, Transaction
+import zlib
+from unittest.mock import patch
+import networkx as nx
+import numpy as np
+import torch
+from quantumfuse_blockchain import (
+    EnhancedQuantumFuseBlockchain, Transaction, Block, BlockHeader, MerkleTree, SignatureVerifier, FileBlockStore,
+    MemoryBlockStore, StateStore, Mempool, TransactionGraph
+)
 from cryptography.hazmat.primitives.asymmetric import rsa
 
 
@@ -57,12 +69,1495 @@ class TestEnhancedQuantumFuseBlockchain(unittest.TestCase):
         self.assertTrue(result, "KYC should be performed successfully")
 
     def test_cross_shard_transaction(self):
-        # Test cross shard transaction
+        # Test cross shard transaction; prepare now checks the sender's funds
+        self.blockchain.add_balance("Alice", 100)
         tx = Transaction("Alice", "Bob", 50, "QFC")
         tx.sign_transaction(self.private_key)
-        self.blockchain.add_transaction(tx)
         result = self.blockchain.cross_shard_coordinator.initiate_cross_shard_transaction(tx)
         self.assertTrue(result, "Cross shard transaction should be initiated successfully")
+        self.assertEqual(self.blockchain.get_balance("Alice"), 50)
+
+
+class TestGreenProofOfWork(unittest.TestCase):
+
+    def setUp(self):
+        self.block_data = '{"index": 1, "transactions": []}'
+
+    def test_mine_single_worker(self):
+        pow_engine = EnhancedQuantumFuseBlockchain.GreenConsensus.GreenProofOfWork(initial_difficulty=2)
+        nonce, block_hash, energy_source = pow_engine.mine(self.block_data, "MinerAddress")
+        self.assertTrue(block_hash.startswith("00"), "Mined hash should meet the difficulty target")
+        self.assertEqual(pow_engine.calculate_hash(self.block_data, nonce, energy_source), block_hash)
+        self.assertIn("MinerAddress", pow_engine.carbon_credits, "Miner should be awarded carbon credits")
+
+    def test_mine_parallel_workers(self):
+        pow_engine = EnhancedQuantumFuseBlockchain.GreenConsensus.GreenProofOfWork(
+            initial_difficulty=3, mining_workers=2, nonce_batch_size=256
+        )
+        try:
+            nonce, block_hash, energy_source = pow_engine.mine(self.block_data, "MinerAddress")
+            self.assertTrue(block_hash.startswith("000"), "Mined hash should meet the difficulty target")
+            self.assertEqual(pow_engine.calculate_hash(self.block_data, nonce, energy_source), block_hash)
+            self.assertEqual(len(pow_engine.block_times), 1, "Block time should be recorded once per block")
+            # The pool is reused for the next block.
+            pow_engine.mine(self.block_data, "MinerAddress")
+            self.assertEqual(len(pow_engine.block_times), 2)
+        finally:
+            pow_engine.shutdown()
+
+    def test_midstate_search_matches_naive_hashing(self):
+        pow_engine = EnhancedQuantumFuseBlockchain.GreenConsensus.GreenProofOfWork(initial_difficulty=2)
+        nonce, block_hash = pow_engine._search_nonces(self.block_data, "solar", 2, 0, 1, 64)
+        naive_nonce = next(
+            n for n in range(nonce + 1)
+            if pow_engine.calculate_hash(self.block_data, n, "solar").startswith("00")
+        )
+        self.assertEqual(nonce, naive_nonce, "Midstate search should find the first valid nonce")
+        self.assertEqual(block_hash, pow_engine.calculate_hash(self.block_data, nonce, "solar"))
+
+    def test_verify_header_accepts_mined_block(self):
+        block = Block(1, [Transaction("Alice", "Bob", 10, "QFC")], "0" * 64)
+        pow_engine = EnhancedQuantumFuseBlockchain.GreenConsensus.GreenProofOfWork(initial_difficulty=2)
+        block.nonce, block.hash, block.energy_source = pow_engine.mine(block.pow_data(), "MinerAddress")
+        self.assertTrue(pow_engine.verify_header(block.header(), 2))
+        block.nonce += 1
+        self.assertFalse(pow_engine.verify_header(block.header(), 2))
+
+
+class TestMerkleTree(unittest.TestCase):
+
+    def test_incremental_append_matches_rebuild(self):
+        leaves = [f"tx{i}".encode() for i in range(13)]
+        tree = MerkleTree()
+        for count, leaf in enumerate(leaves, start=1):
+            tree.append(leaf)
+            self.assertEqual(tree.root, MerkleTree(leaves[:count]).root,
+                             "Incremental root should match a full rebuild")
+
+    def test_proofs_verify_for_every_leaf(self):
+        for size in (1, 2, 5, 8, 11):
+            leaves = [f"tx{i}".encode() for i in range(size)]
+            tree = MerkleTree(leaves)
+            for index, leaf in enumerate(leaves):
+                proof = tree.get_proof(index)
+                self.assertTrue(MerkleTree.verify_proof(leaf, proof, tree.root))
+                self.assertFalse(MerkleTree.verify_proof(b"forged", proof, tree.root))
+
+    def test_odd_leaf_is_not_duplicated(self):
+        leaves = [b"a", b"b", b"c"]
+        self.assertNotEqual(MerkleTree(leaves).root, MerkleTree(leaves + [b"c"]).root)
+        self.assertNotEqual(MerkleTree(leaves[:1]).root, MerkleTree(leaves[:1] * 2).root)
+
+    def test_update_changes_root(self):
+        leaves = [f"tx{i}".encode() for i in range(6)]
+        tree = MerkleTree(leaves)
+        old_root = tree.root
+        tree.update(3, b"replaced")
+        leaves[3] = b"replaced"
+        self.assertNotEqual(tree.root, old_root)
+        self.assertEqual(tree.root, MerkleTree(leaves).root)
+
+    def test_bulk_extend_and_update_match_rebuild(self):
+        leaves = [f"tx{i}".encode() for i in range(5)]
+        tree = MerkleTree(leaves[:2])
+        tree.extend(leaves[2:])
+        self.assertEqual(tree.levels, MerkleTree(leaves).levels)
+        tree.update_many([(4, b"a"), (0, b"b"), (4, b"c")])
+        leaves[0], leaves[4] = b"b", b"c"
+        self.assertEqual(tree.levels, MerkleTree(leaves).levels)
+        with self.assertRaises(IndexError):
+            tree.update_many([(5, b"d")])
+
+    def test_block_header_commits_to_merkle_root(self):
+        transactions = [Transaction("Alice", "Bob", i + 1, "QFC") for i in range(4)]
+        block = Block(1, list(transactions), "0")
+        self.assertEqual(block.merkle_root, MerkleTree(bytes.fromhex(tx.calculate_hash()) for tx in transactions).root)
+        self.assertNotIn("transactions", block.header_dict())
+        block_hash = block.hash
+        block.add_transaction(Transaction("Bob", "Carol", 1, "QFC"))
+        self.assertNotEqual(block.hash, block_hash, "Adding a transaction should change the block hash")
+        proof = block.get_transaction_proof(4)
+        self.assertTrue(MerkleTree.verify_proof(bytes.fromhex(block.transactions[4].calculate_hash()), proof, block.merkle_root))
+
+    def test_plasma_block_proofs(self):
+        layer2 = EnhancedQuantumFuseBlockchain.Layer2Solution()
+        transactions = [{"from": "Alice", "to": "Bob", "amount": i} for i in range(5)]
+        block_index = layer2.create_plasma_block(transactions)
+        merkle_root = layer2.plasma_chain[block_index]["merkle_root"]
+        proof = layer2.get_plasma_proof(block_index, 2)
+        self.assertTrue(layer2.verify_plasma_transaction(transactions[2], proof, merkle_root))
+        self.assertFalse(layer2.verify_plasma_transaction(transactions[3], proof, merkle_root))
+
+
+class TestSignatureVerifier(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        cls.public_key = cls.private_key.public_key()
+
+    def setUp(self):
+        self.verifier = SignatureVerifier(max_workers=4, chunk_size=2)
+
+    def tearDown(self):
+        self.verifier.shutdown()
+
+    def test_signed_transaction_verifies(self):
+        tx = Transaction("Alice", "Bob", 100, "QFC")
+        tx.sign_transaction(self.private_key)
+        self.assertTrue(tx.verify_signature(self.public_key), "A freshly signed transaction should verify")
+        tx.amount = 1000
+        self.assertFalse(tx.verify_signature(self.public_key), "Tampered transaction should not verify")
+
+    def test_verify_batch_returns_per_transaction_results(self):
+        transactions = []
+        for i in range(7):
+            tx = Transaction("Alice", "Bob", i + 1, "QFC")
+            tx.sign_transaction(self.private_key)
+            transactions.append(tx)
+        transactions[2].amount = 999
+        transactions[5].signature = "not-hex"
+        public_keys = [self.public_key] * len(transactions)
+        public_keys[4] = None
+        results = self.verifier.verify_batch(transactions, public_keys)
+        self.assertEqual(results, [True, True, False, True, False, False, True])
+
+    def test_hash_cache_tracks_field_changes(self):
+        tx = Transaction("Alice", "Bob", 100, "QFC")
+        first_hash = tx.calculate_hash()
+        self.assertEqual(tx.calculate_hash(), first_hash)
+        tx.recipient = "Carol"
+        self.assertNotEqual(tx.calculate_hash(), first_hash, "Cached hash should follow field changes")
+
+
+class TestBinaryEncoding(unittest.TestCase):
+
+    def test_transaction_round_trip(self):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        tx = Transaction("Alice", "Bob", 12.5, "QFC")
+        tx.sign_transaction(private_key)
+        tx.signatures = [{"signer": "Carol", "signature": "abcd"}]
+        decoded = Transaction.from_bytes(tx.to_bytes())
+        self.assertEqual(decoded.to_dict(), tx.to_dict())
+        self.assertEqual(decoded.calculate_hash(), tx.calculate_hash())
+        self.assertTrue(decoded.verify_signature(private_key.public_key()))
+
+    def test_malformed_signatures_are_rejected_not_raised(self):
+        data = Transaction("Alice", "Bob", 1).to_dict()
+        for bad in ({"signature": "zz"}, {"signatures": [{"signer": "Carol", "signature": "xyz"}]},
+                    {"signatures": [{"signature": "00"}]}):
+            with self.assertRaises(ValueError):
+                Transaction.from_dict({**data, **bad})
+        tx = Transaction("Alice", "Bob", 1)
+        self.assertEqual(tx.signatures, [])
+        tx.signature = "not hex"
+        mempool = Mempool()
+        self.assertFalse(mempool.add(tx))
+        self.assertEqual(mempool.metrics()["rejected"], 1)
+
+    def test_transaction_uses_slots(self):
+        tx = Transaction("Alice", "Bob", 1)
+        self.assertFalse(hasattr(tx, "__dict__"), "Transactions should not carry a per-instance dict")
+        with self.assertRaises(AttributeError):
+            tx.unexpected_field = 1
+
+    def test_signing_payload_ignores_signatures(self):
+        tx = Transaction("Alice", "Bob", 1)
+        signing_hash = tx.signing_hash()
+        tx.signature = "00ff"
+        self.assertEqual(tx.signing_hash(), signing_hash)
+        self.assertNotEqual(tx.calculate_hash(), Transaction.from_dict({**tx.to_dict(), "signature": ""}).calculate_hash())
+
+    def test_block_round_trip(self):
+        transactions = [Transaction("Alice", "Bob", i + 1, "QFC") for i in range(3)]
+        block = Block(1, transactions, "ab" * 32)
+        block.energy_source = "solar"
+        encoded = block.to_bytes()
+        decoded = Block.from_bytes(encoded)
+        self.assertEqual(decoded.to_dict(), block.to_dict())
+        self.assertEqual(decoded.calculate_hash(), block.hash)
+        self.assertEqual(len(block.header_bytes()), Block.HEADER.size)
+        self.assertEqual(Block.from_dict(block.to_dict()).to_bytes(), encoded)
+
+    def test_block_from_bytes_rejects_tampered_transactions(self):
+        block = Block(1, [Transaction("Alice", "Bob", 5, "QFC")], "0" * 64)
+        encoded = bytearray(block.to_bytes())
+        # Flip a byte inside the transaction's amount field.
+        encoded[Block.HEADER.size + 33 + 4 + 4 + 2] ^= 0xFF
+        with self.assertRaises(ValueError):
+            Block.from_bytes(bytes(encoded))
+
+
+class TestFileBlockStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def make_chain(self, store, count):
+        previous_hash = "0" * 64 if len(store) == 0 else store[-1].hash
+        for _ in range(count):
+            block = Block(len(store), [Transaction("Alice", "Bob", len(store) + 1)], previous_hash)
+            store.append(block)
+            previous_hash = block.hash
+
+    def test_reads_by_height_and_hash_after_reopen(self):
+        store = FileBlockStore(self.directory, max_segment_bytes=1024, sync_every=4)
+        self.make_chain(store, 20)
+        hashes = [block.hash for block in store]
+        store.close()
+        self.assertGreater(len([n for n in os.listdir(self.directory) if n.startswith("segment-")]), 1,
+                           "Small segments should roll over")
+
+        store = FileBlockStore(self.directory, max_segment_bytes=1024)
+        self.assertEqual(len(store), 20)
+        self.assertEqual([block.hash for block in store], hashes)
+        self.assertEqual(store.get_by_hash(hashes[7]).index, 7)
+        self.assertEqual(store[-1].hash, hashes[-1])
+        self.assertEqual([block.index for block in store[3:6]], [3, 4, 5])
+        self.make_chain(store, 1)
+        self.assertEqual(store[20].previous_hash, hashes[-1])
+        store.close()
+
+    def test_stores_share_the_lookup_interface(self):
+        for store in (MemoryBlockStore(), FileBlockStore(self.directory)):
+            self.make_chain(store, 4)
+            self.assertEqual([store.get_height(block.hash) for block in store], [0, 1, 2, 3])
+            self.assertIsNone(store.get_height("ff" * 32))
+            self.assertIsNone(store.get_by_hash("ff" * 32))
+            store.close()
+
+    def test_torn_tail_write_is_truncated(self):
+        store = FileBlockStore(self.directory)
+        self.make_chain(store, 5)
+        store.close()
+        segment = os.path.join(self.directory, "segment-000000.dat")
+        intact_size = os.path.getsize(segment)
+        with open(segment, "ab") as f:
+            f.write(FileBlockStore.RECORD_MAGIC + b"\x00\x00\x10\x00partial")
+
+        store = FileBlockStore(self.directory)
+        self.assertEqual(len(store), 5)
+        self.assertEqual(os.path.getsize(segment), intact_size, "Torn record should be truncated")
+        self.make_chain(store, 1)
+        self.assertEqual(store[5].index, 5)
+        store.close()
+
+    def test_lost_index_entries_are_rebuilt_from_segments(self):
+        store = FileBlockStore(self.directory)
+        self.make_chain(store, 6)
+        hashes = [block.hash for block in store]
+        store.close()
+        index_path = os.path.join(self.directory, FileBlockStore.INDEX_FILE)
+        with open(index_path, "r+b") as f:
+            f.truncate(2 * FileBlockStore.INDEX_ENTRY.size + 5)
+
+        store = FileBlockStore(self.directory)
+        self.assertEqual([block.hash for block in store], hashes)
+        self.assertEqual(store.get_by_hash(hashes[5]).index, 5)
+        store.close()
+
+    def test_shard_chain_survives_restart(self):
+        shard = EnhancedQuantumFuseBlockchain.Shard(0, FileBlockStore(self.directory))
+        shard.add_transaction(Transaction("Alice", "Bob", 10))
+        block = shard.create_block("MinerAddress")
+        shard.add_block(block)
+        shard.chain.close()
+
+        restarted = EnhancedQuantumFuseBlockchain.Shard(0, FileBlockStore(self.directory))
+        self.assertEqual(len(restarted.chain), 2, "Genesis should not be recreated on restart")
+        self.assertEqual(restarted.get_latest_block().hash, block.hash)
+        self.assertEqual(restarted.get_latest_block().transactions[0].recipient, "Bob")
+        restarted.chain.close()
+
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_transfers_and_indexes(self):
+        state = StateStore()
+        state.credit("QFC", "Alice", 100)
+        state.credit("GOLD", "Alice", 5)
+        state.apply_transfer("QFC", "Alice", "Bob", 40)
+        self.assertEqual(state.get_balance("QFC", "Alice"), 60)
+        self.assertEqual(state.get_balance("QFC", "Bob"), 40)
+        self.assertEqual(state.get_balances("Alice"), {"QFC": 60, "GOLD": 5})
+        self.assertEqual(state.get_holders("QFC"), {"Alice": 60, "Bob": 40})
+
+    def test_rollback_reverts_block_diffs(self):
+        state = StateStore()
+        state.credit("QFC", "Alice", 100, tag="tx-1")
+        state.commit_block("block-1", ["tx-1"])
+        state.apply_transfer("QFC", "Alice", "Bob", 30, tag="tx-2")
+        state.commit_block("block-2", ["tx-2"])
+        state.apply_transfer("QFC", "Bob", "Carol", 10, tag="tx-3")
+        self.assertTrue(state.revert("tx-3"), "Uncommitted changes are reverted by tag")
+        self.assertFalse(state.revert("tx-3"))
+        state.rollback_to(1)
+        self.assertEqual(state.height, 1)
+        self.assertEqual(state.get_balance("QFC", "Alice"), 100)
+        self.assertEqual(state.get_holders("QFC"), {"Alice": 100})
+        with self.assertRaises(ValueError):
+            state.rollback_to(-5)
+
+    def test_diffs_hold_only_each_blocks_transactions(self):
+        state = StateStore()
+        state.credit("QFC", "Alice", 100)
+        state.credit("QFC", "Bob", 100)
+        state.apply_transfer("QFC", "Alice", "Carol", 10, tag="a-1")
+        state.apply_transfer("QFC", "Bob", "Dave", 20, tag="b-1")
+        state.apply_transfer("QFC", "Alice", "Carol", 5, tag="a-2")
+        state.commit_block("shard0-1", ["a-1"], shard_id=0)
+        state.commit_block("shard1-1", ["b-1"], shard_id=1)
+        state.commit_block("shard0-2", ["a-2"], shard_id=0)
+        self.assertEqual([diff[3] for diff in state.block_diffs], [
+            {("QFC", "Alice"): -10, ("QFC", "Carol"): 10},
+            {("QFC", "Bob"): -20, ("QFC", "Dave"): 20},
+            {("QFC", "Alice"): -5, ("QFC", "Carol"): 5},
+        ])
+        state.rollback_block("shard0-1")
+        self.assertEqual((state.get_balance("QFC", "Alice"), state.get_balance("QFC", "Carol")), (95, 5))
+        self.assertEqual(state.get_balance("QFC", "Dave"), 20, "Other blocks keep their changes")
+        state.rollback_shard(1)
+        self.assertEqual(state.get_balances("Bob"), {"QFC": 100})
+        self.assertEqual(state.get_holders("QFC"), {"Alice": 95, "Bob": 100, "Carol": 5})
+        self.assertEqual(state.height, 1)
+        with self.assertRaises(ValueError):
+            state.rollback_shard(1)
+
+    def test_restart_replays_write_ahead_log(self):
+        state = StateStore(self.directory)
+        state.credit("QFC", "Alice", 100)
+        state.commit_block("block-1")
+        state.apply_transfer("QFC", "Alice", "Bob", 25, tag="tx-2")
+        state.commit_block("block-2", ["tx-2"], shard_id=0)
+        state.apply_transfer("QFC", "Alice", "Carol", 5, tag="tx-3")
+        state.commit_block("block-3", ["tx-3"], shard_id=1)
+        state.close()
+
+        restarted = StateStore(self.directory)
+        self.assertEqual(restarted.height, 3)
+        self.assertEqual(restarted.get_balance("QFC", "Bob"), 25)
+        restarted.rollback_shard(0)
+        self.assertEqual(restarted.get_balance("QFC", "Bob"), 0)
+        restarted.close()
+        restarted = StateStore(self.directory)
+        self.assertEqual((restarted.get_balance("QFC", "Alice"), restarted.get_balance("QFC", "Carol")), (95, 5))
+        self.assertEqual([diff[2] for diff in restarted.block_diffs], ["block-1", "block-3"])
+        restarted.close()
+
+    def test_snapshot_plus_log_tail(self):
+        state = StateStore(self.directory, snapshot_every=2)
+        state.credit("QFC", "Alice", 100)
+        state.commit_block("block-1")
+        state.apply_transfer("QFC", "Alice", "Bob", 10, tag="tx-2")
+        state.commit_block("block-2", ["tx-2"])  # Snapshot taken here.
+        state.apply_transfer("QFC", "Alice", "Bob", 5, tag="tx-3")
+        state.commit_block("block-3", ["tx-3"])
+        state.close()
+        with open(os.path.join(self.directory, StateStore.WAL_FILE)) as f:
+            self.assertEqual(sum(1 for line in f if '"commit"' in line), 1, "Only the tail should be in the log")
+        with open(os.path.join(self.directory, StateStore.WAL_FILE), "a") as f:
+            f.write('{"a": "QFC", "k": "Bob"')  # Torn record.
+
+        restarted = StateStore(self.directory, snapshot_every=2)
+        self.assertEqual(restarted.height, 3)
+        self.assertEqual(restarted.get_balance("QFC", "Bob"), 15)
+        restarted.rollback_to(1)
+        self.assertEqual(restarted.get_balance("QFC", "Bob"), 0)
+        restarted.close()
+
+    def test_stale_log_after_snapshot_is_ignored(self):
+        state = StateStore(self.directory)
+        state.credit("QFC", "Alice", 100)
+        state.commit_block("block-1")
+        state.flush()
+        with open(os.path.join(self.directory, StateStore.WAL_FILE)) as f:
+            stale_log = f.read()
+        state.snapshot()
+        state.close()
+        # Simulate a crash between writing the snapshot and resetting the log.
+        with open(os.path.join(self.directory, StateStore.WAL_FILE), "w") as f:
+            f.write(stale_log)
+
+        restarted = StateStore(self.directory)
+        self.assertEqual(restarted.height, 1)
+        self.assertEqual(restarted.get_balance("QFC", "Alice"), 100)
+        restarted.close()
+
+
+class TestMempool(unittest.TestCase):
+
+    def test_deduplicates_by_hash(self):
+        mempool = Mempool()
+        tx = Transaction("Alice", "Bob", 1, fee=1)
+        self.assertTrue(mempool.add(tx))
+        self.assertFalse(mempool.add(Transaction.from_dict(tx.to_dict())))
+        self.assertEqual(len(mempool), 1)
+        self.assertEqual(mempool.metrics()["duplicates"], 1)
+
+    def test_selects_by_fee_respecting_sender_nonces(self):
+        mempool = Mempool()
+        alice_first = Transaction("Alice", "Bob", 1, fee=1, nonce=0)
+        alice_second = Transaction("Alice", "Bob", 1, fee=100, nonce=1)
+        bob = Transaction("Bob", "Carol", 1, fee=10, nonce=0)
+        for tx in (alice_second, bob, alice_first):
+            mempool.add(tx)
+        selected = mempool.select()
+        self.assertEqual(selected, [bob, alice_first, alice_second],
+                         "Alice's high-fee transaction must wait for her earlier nonce")
+
+    def test_replace_by_fee(self):
+        mempool = Mempool()
+        original = Transaction("Alice", "Bob", 1, fee=1, nonce=0)
+        mempool.add(original)
+        self.assertFalse(mempool.add(Transaction("Alice", "Carol", 1, fee=1, nonce=0)))
+        replacement = Transaction("Alice", "Carol", 1, fee=5, nonce=0)
+        self.assertTrue(mempool.add(replacement))
+        self.assertEqual(mempool.select(), [replacement])
+        self.assertEqual(mempool.metrics()["replaced"], 1)
+
+    def test_evicts_lowest_priority_when_full(self):
+        mempool = Mempool(max_count=3)
+        transactions = [Transaction(f"Sender{i}", "Bob", 1, fee=fee) for i, fee in enumerate((5, 1, 9))]
+        for tx in transactions:
+            mempool.add(tx)
+        self.assertTrue(mempool.add(Transaction("Sender3", "Bob", 1, fee=7)))
+        self.assertNotIn(transactions[1].calculate_hash(), mempool, "Lowest fee should be evicted")
+        self.assertFalse(mempool.add(Transaction("Sender4", "Bob", 1, fee=0)),
+                         "A transaction below every pooled fee should be rejected")
+        metrics = mempool.metrics()
+        self.assertEqual((metrics["count"], metrics["evicted"], metrics["rejected"]), (3, 1, 1))
+
+    def test_byte_cap(self):
+        size = len(Transaction("Alice", "Bob", 1).to_bytes())
+        mempool = Mempool(max_bytes=size * 2)
+        for i in range(5):
+            mempool.add(Transaction("Alice", "Bob", 1, fee=i + 1))
+        self.assertLessEqual(mempool.metrics()["bytes"], size * 2)
+        self.assertEqual(len(mempool), 2)
+
+    def test_shard_block_respects_size_limit(self):
+        shard = EnhancedQuantumFuseBlockchain.Shard(0, max_block_transactions=3)
+        for i in range(5):
+            self.assertTrue(shard.add_transaction(Transaction(f"Sender{i}", "Bob", 1, fee=i)))
+        block = shard.create_block("MinerAddress")
+        self.assertEqual([tx.fee for tx in block.transactions], [4, 3, 2])
+        self.assertEqual(len(shard.pending_transactions), 2)
+
+
+class TestCrossShardCoordinator(unittest.TestCase):
+
+    def setUp(self):
+        self.shards = [EnhancedQuantumFuseBlockchain.Shard(i) for i in range(4)]
+        self.state = StateStore()
+        self.coordinator = EnhancedQuantumFuseBlockchain.CrossShardCoordinator(
+            self.shards, self.state, lock_timeout=0.05, prepare_timeout=0.05
+        )
+
+    def addresses_on(self, shard_id, count, prefix="user"):
+        found = []
+        i = 0
+        while len(found) < count:
+            address = f"{prefix}-{i}"
+            if self.coordinator.get_shard_id(address) == shard_id:
+                found.append(address)
+            i += 1
+        return found
+
+    def test_consistent_hash_routes_any_address(self):
+        addresses = [f"user-{i}" for i in range(4000)] + ["Alice", "Bob", "0xdeadbeef"]
+        before = {address: self.coordinator.get_shard_id(address) for address in addresses}
+        self.assertEqual(set(before.values()), {0, 1, 2, 3})
+        self.shards.append(EnhancedQuantumFuseBlockchain.Shard(4))
+        self.coordinator.rebuild_ring()
+        moved = [a for a in addresses if self.coordinator.get_shard_id(a) != before[a]]
+        self.assertTrue(all(self.coordinator.get_shard_id(a) == 4 for a in moved), "Keys only move to the new shard")
+        self.assertLess(len(moved), len(addresses) * 0.35)
+
+    def test_cross_shard_credits_arrive_as_one_batch_per_block(self):
+        (sender,) = self.addresses_on(0, 1, "sender")
+        recipients = self.addresses_on(1, 3, "recipient")
+        self.state.credit("QFC", sender, 100)
+        for amount, recipient in enumerate(recipients, start=1):
+            self.assertTrue(self.coordinator.initiate_cross_shard_transaction(Transaction(sender, recipient, amount)))
+        self.assertEqual(self.state.get_balance("QFC", sender), 94, "Sender is debited at commit")
+        self.assertEqual(len(self.shards[1].pending_transactions), 0, "Destination does not queue the transaction")
+        self.assertEqual(self.state.get_balance("QFC", recipients[0]), 0, "Credit waits for the source block")
+
+        block = self.shards[0].create_block("miner")
+        self.shards[0].add_block(block)
+        (batch,) = self.coordinator.on_block(0, block)
+        self.assertEqual(len(batch["entries"]), 3)
+        self.assertEqual(self.coordinator.apply_receipts(1), 3)
+        self.assertEqual([self.state.get_balance("QFC", r) for r in recipients], [1, 2, 3])
+        metrics = self.coordinator.metrics()
+        self.assertEqual((metrics["cross_shard"], metrics["receipt_batches"]), (3, 1))
+        self.assertEqual(metrics["pending_receipts"][1], 0)
+
+    def test_insufficient_funds_abort_and_release_lock(self):
+        (sender,) = self.addresses_on(0, 1, "sender")
+        (recipient,) = self.addresses_on(2, 1, "recipient")
+        self.state.credit("QFC", sender, 5)
+        self.assertFalse(self.coordinator.initiate_cross_shard_transaction(Transaction(sender, recipient, 10)))
+        self.assertEqual(self.coordinator.stats["aborted_insufficient_funds"], 1)
+        self.assertNotIn(sender, self.coordinator.account_locks)
+        self.assertTrue(self.coordinator.initiate_cross_shard_transaction(Transaction(sender, recipient, 5)))
+
+    def test_prepared_lock_blocks_others_until_timeout_abort(self):
+        (sender,) = self.addresses_on(0, 1, "sender")
+        (recipient,) = self.addresses_on(3, 1, "recipient")
+        self.state.credit("QFC", sender, 100)
+        first, second = Transaction(sender, recipient, 10), Transaction(sender, recipient, 20)
+        self.assertTrue(self.coordinator.prepare_transaction(first, self.shards[0], self.shards[3]))
+        self.assertFalse(self.coordinator.prepare_transaction(second, self.shards[0], self.shards[3]),
+                         "Sender stays locked while the first transfer is prepared")
+        self.assertEqual(self.coordinator.stats["aborted_lock_timeout"], 1)
+        time.sleep(0.06)
+        self.assertFalse(self.coordinator.commit_transaction(first, self.shards[0], self.shards[3]),
+                         "A commit after the prepare deadline aborts")
+        self.assertTrue(self.coordinator.initiate_cross_shard_transaction(second))
+        self.assertEqual(self.state.get_balance("QFC", sender), 80)
+
+    def test_evicted_and_replaced_transactions_are_reverted(self):
+        shards = [EnhancedQuantumFuseBlockchain.Shard(i, mempool=Mempool(max_count=2)) for i in range(4)]
+        coordinator = EnhancedQuantumFuseBlockchain.CrossShardCoordinator(shards, self.state)
+        self.coordinator = coordinator
+        (sender,) = self.addresses_on(0, 1, "sender")
+        (local,) = self.addresses_on(0, 1, "local")
+        (remote,) = self.addresses_on(1, 1, "remote")
+        self.state.credit("QFC", sender, 100)
+        for fee, recipient in enumerate((local, remote, local, remote), start=1):
+            self.assertTrue(coordinator.initiate_cross_shard_transaction(Transaction(sender, recipient, 10, fee=fee)))
+        self.assertEqual(len(shards[0].pending_transactions), 2)
+        self.assertEqual(self.state.get_balance("QFC", sender), 80, "Only pooled transfers stay applied")
+        self.assertEqual(self.state.get_balance("QFC", local), 10)
+        self.assertEqual((len(coordinator.awaiting_block), coordinator.pending_receipts[1]), (1, 1))
+
+        original = Transaction(sender, local, 5, fee=10, nonce=0)
+        self.assertTrue(coordinator.initiate_cross_shard_transaction(original))
+        self.assertFalse(coordinator.initiate_cross_shard_transaction(Transaction.from_dict(original.to_dict())),
+                         "A duplicate is rejected and not applied twice")
+        self.assertTrue(coordinator.initiate_cross_shard_transaction(Transaction(sender, local, 5, fee=20, nonce=0)))
+        self.assertEqual(self.state.get_balance("QFC", sender), 85, "Replace-by-fee debits once")
+        self.assertEqual(self.state.get_balance("QFC", local), 5)
+        self.assertTrue(coordinator.initiate_cross_shard_transaction(Transaction(sender, local, 1, fee=30)))
+        self.assertEqual(self.state.get_balance("QFC", sender), 94)
+        self.assertEqual((len(coordinator.awaiting_block), coordinator.pending_receipts[1]), (0, 0),
+                         "The evicted cross-shard transfer releases its receipt slot")
+        self.assertEqual(self.state.pending.keys(), {tx.calculate_hash() for tx in shards[0].pending_transactions})
+
+class TestShardScheduler(unittest.TestCase):
+
+    def make_chain(self, workers):
+        blockchain = EnhancedQuantumFuseBlockchain(num_shards=3, difficulty=1, mining_workers=workers)
+        self.addCleanup(blockchain.close)
+        blockchain.consensus.green_pow.difficulty = 1
+        blockchain.consensus.green_pow.adjustment_interval = 10**9
+        return blockchain
+
+    def fill_shards(self, blockchain, per_shard):
+        coordinator = blockchain.cross_shard_coordinator
+        for shard in blockchain.shards:
+            senders = [a for a in (f"sender-{i}" for i in range(200))
+                       if coordinator.get_shard_id(a) == shard.shard_id][:per_shard]
+            for sender in senders:
+                shard.add_transaction(Transaction(sender, "Bob", 1))
+
+    def check_produces_every_shard(self, workers):
+        blockchain = self.make_chain(workers)
+        self.fill_shards(blockchain, 5)
+        blocks = blockchain.mine_all_shards("Miner")
+        self.assertEqual(len(blocks), 3)
+        self.assertEqual([len(shard.chain) for shard in blockchain.shards], [2, 2, 2])
+        for shard in blockchain.shards:
+            self.assertTrue(blockchain.consensus.validate_block(shard.get_latest_block()))
+        metrics = blockchain.shard_scheduler.metrics()
+        self.assertEqual(metrics["transactions"], 15)
+        self.assertEqual(sorted(metrics["shards"]), [0, 1, 2])
+        self.assertEqual(blockchain.mine_all_shards("Miner"), [], "Empty mempools produce no blocks")
+        return blockchain, blocks
+
+    def test_produce_blocks_inline(self):
+        self.check_produces_every_shard(1)
+
+    def test_produce_and_validate_blocks_in_pool(self):
+        source, _ = self.check_produces_every_shard(2)
+        replica = self.make_chain(2)
+        by_shard = {shard.shard_id: [shard.get_latest_block()] for shard in source.shards}
+        self.assertEqual(replica.shard_scheduler.validate_blocks(by_shard), {0: [True], 1: [True], 2: [True]})
+        by_shard[1] = [Block.from_bytes(by_shard[1][0].to_bytes())]
+        by_shard[1][0].nonce += 1
+        self.assertEqual(replica.shard_scheduler.validate_blocks(by_shard)[1], [False])
+
+    def test_stale_candidate_requeues_transactions(self):
+        blockchain = self.make_chain(1)
+        self.fill_shards(blockchain, 2)
+        shard = blockchain.shards[0]
+        candidate = shard.create_block("Miner")
+        competing = Block(1, [], shard.get_latest_block().hash)
+        shard.add_block(competing)
+        self.assertFalse(blockchain.shard_scheduler.finalize(0, candidate, 0, "00" * 32, "solar",
+                                                             time.monotonic(), "Miner"))
+        self.assertEqual(len(shard.pending_transactions), 2)
+        self.assertEqual(blockchain.shard_scheduler.metrics()["shards"][0]["stale"], 1)
+
+    def test_stale_requeue_reverts_rejected_transactions(self):
+        blockchain = self.make_chain(1)
+        coordinator = blockchain.cross_shard_coordinator
+        sender, recipient = [a for a in (f"user-{i}" for i in range(200)) if coordinator.get_shard_id(a) == 0][:2]
+        blockchain.add_balance(sender, 100)
+        for fee in (1, 2):
+            self.assertTrue(coordinator.initiate_cross_shard_transaction(Transaction(sender, recipient, 10, fee=fee)))
+        shard = blockchain.shards[0]
+        candidate = shard.create_block("Miner")
+        shard.add_block(Block(1, [], shard.get_latest_block().hash))
+        shard.pending_transactions.max_count = 1
+        self.assertFalse(blockchain.shard_scheduler.finalize(0, candidate, 0, "00" * 32, "solar",
+                                                             time.monotonic(), "Miner"))
+        self.assertEqual([tx.fee for tx in shard.pending_transactions], [2])
+        self.assertEqual(blockchain.get_balance(sender), 90, "The transfer the mempool dropped is reverted")
+        self.assertEqual(blockchain.get_balance(recipient), 10)
+
+
+class TestBlockHeaders(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.alice_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def setUp(self):
+        self.blockchain = EnhancedQuantumFuseBlockchain(num_shards=2, difficulty=1)
+        self.blockchain.identity_manager.create_identity("Alice", self.alice_key.public_key())
+
+    def tearDown(self):
+        self.blockchain.close()
+
+    def mine_on(self, shard_id, transactions):
+        tip = self.blockchain.shards[shard_id].get_latest_block()
+        block = Block(tip.index + 1, transactions, tip.hash)
+        pow_engine = self.blockchain.consensus.green_pow
+        block.nonce, block.hash = pow_engine._search_nonces(block.pow_data(), "solar", 1, 0, 1)
+        block.energy_source = "solar"
+        return block
+
+    def test_genesis_is_deterministic(self):
+        self.assertEqual(Block.genesis(1).hash, self.blockchain.shards[1].get_latest_block().hash)
+        self.assertNotEqual(Block.genesis(0).hash, Block.genesis(1).hash)
+
+    def test_header_round_trip_and_proof_of_work(self):
+        block = self.mine_on(0, [Transaction("Alice", "Bob", 5)])
+        encoded = block.header().to_bytes()
+        header, offset = BlockHeader.from_bytes(encoded + b"trailing", 0)
+        self.assertEqual(offset, len(encoded))
+        self.assertEqual(header.to_bytes(), encoded)
+        self.assertTrue(block.to_bytes().startswith(encoded), "Headers are the prefix of the block encoding")
+        self.assertTrue(self.blockchain.consensus.validate_header(header))
+        header.timestamp += 1
+        self.assertFalse(self.blockchain.consensus.validate_header(header), "Proof of work covers the header")
+
+    def signed(self, amount, nonce=None, recipient="Bob"):
+        transaction = Transaction("Alice", recipient, amount, nonce=nonce)
+        transaction.sign_transaction(self.alice_key)
+        return transaction
+
+    def test_add_block_extends_matching_shard(self):
+        self.blockchain.add_balance("Alice", 10)
+        shard_id = self.blockchain.cross_shard_coordinator.get_shard_id("Bob")
+        block = self.mine_on(shard_id, [self.signed(4)])
+        unmined = Block(1, [], block.previous_hash)
+        self.assertFalse(self.blockchain.add_block(unmined))
+        self.assertTrue(self.blockchain.add_block(block), "Shard is found from the previous hash")
+        self.assertEqual(self.blockchain.shards[shard_id].get_latest_block().hash, block.hash)
+        self.assertEqual(self.blockchain.get_balance("Bob"), 4)
+        self.assertFalse(self.blockchain.add_block(block), "A block cannot be applied twice")
+
+    def test_received_block_transactions_are_validated(self):
+        self.blockchain.add_balance("Alice", 10)
+        forged = self.signed(4)
+        forged.amount = 9
+        unsigned = Transaction("Alice", "Bob", 4)
+        rejected = [
+            [forged],
+            [unsigned],
+            [self.signed(6, nonce=1), self.signed(6, nonce=2)],
+            [Transaction("Network", "Miner", 1), Transaction("Network", "Miner", 1)],
+            [Transaction("Network", "Miner", self.blockchain.consensus.qfc_rewards + 1)],
+        ]
+        for transactions in rejected:
+            self.assertFalse(self.blockchain.add_block(self.mine_on(0, transactions)))
+        self.assertEqual(len(self.blockchain.shards[0].chain), 1)
+        self.assertEqual(self.blockchain.get_balance("Alice"), 10, "Rejected blocks leave state untouched")
+
+        self.assertTrue(self.blockchain.add_block(self.mine_on(0, [
+            Transaction("Network", "Miner", 1), self.signed(3, nonce=1), self.signed(3, nonce=2, recipient="Carol")
+        ])))
+        self.assertEqual(self.blockchain.get_balance("Alice"), 4)
+        replayed = self.mine_on(0, [self.signed(1, nonce=2)])
+        self.assertFalse(self.blockchain.add_block(replayed), "A sender nonce is used only once")
+
+    def test_received_cross_shard_block_credits_through_receipts(self):
+        miner = EnhancedQuantumFuseBlockchain(num_shards=2, difficulty=1)
+        self.addCleanup(miner.close)
+        miner.identity_manager.create_identity("Alice", self.alice_key.public_key())
+        for chain in (miner, self.blockchain):
+            chain.add_balance("Alice", 10)
+        coordinator = self.blockchain.cross_shard_coordinator
+        source = coordinator.get_shard_id("Alice")
+        recipient = next(name for name in (f"user-{i}" for i in range(100)) if coordinator.get_shard_id(name) != source)
+        destination = coordinator.get_shard_id(recipient)
+        self.assertTrue(miner.add_transaction(self.signed(4, recipient=recipient)))
+        block = miner.mine_block("Alice")
+
+        self.assertTrue(self.blockchain.add_block(block))
+        self.assertEqual(self.blockchain.get_balance("Alice"), 6)
+        self.assertEqual(self.blockchain.get_balance(recipient), 0, "The credit waits for the destination's block")
+        self.assertEqual(coordinator.pending_receipts[destination], 1)
+        self.assertEqual(coordinator.awaiting_block, {})
+        self.assertTrue(self.blockchain.add_block(self.mine_on(destination, [Transaction("Network", "Miner", 1)])))
+        self.assertEqual(self.blockchain.get_balance(recipient), 4)
+        self.assertEqual(coordinator.pending_receipts[destination], 0)
+
+    def test_slow_blocks_do_not_lower_difficulty_below_what_peers_check(self):
+        miner = EnhancedQuantumFuseBlockchain(num_shards=2, difficulty=2)
+        peer = EnhancedQuantumFuseBlockchain(num_shards=2, difficulty=2)
+        for chain in (miner, peer):
+            self.addCleanup(chain.close)
+            chain.identity_manager.create_identity("Alice", self.alice_key.public_key())
+            chain.add_balance("Alice", 10)
+        pow_engine = miner.consensus.green_pow
+        pow_engine.block_times = [pow_engine.target_block_time * 2] * pow_engine.adjustment_interval
+        pow_engine.adjust_difficulty()
+        self.assertEqual(pow_engine.difficulty, 2, "Retargeting stops at the chain's difficulty")
+
+        self.assertTrue(miner.add_transaction(self.signed(4)))
+        block = miner.mine_block("Alice")
+        self.assertTrue(peer.consensus.validate_block(block))
+        self.assertTrue(peer.add_block(block))
+
+
+class TestShardRebalancer(unittest.TestCase):
+
+    def setUp(self):
+        self.blockchain = EnhancedQuantumFuseBlockchain(num_shards=3, difficulty=1)
+        self.blockchain.consensus.green_pow.difficulty = 1
+        self.blockchain.consensus.green_pow.adjustment_interval = 10**9
+        self.coordinator = self.blockchain.cross_shard_coordinator
+        self.rebalancer = self.blockchain.shard_rebalancer
+        self.rebalancer.epoch_rounds = 1
+
+    def tearDown(self):
+        self.blockchain.close()
+
+    def addresses_on(self, shard_id, count, prefix):
+        return [a for a in (f"{prefix}-{i}" for i in range(count * 10))
+                if self.coordinator.get_shard_id(a) == shard_id][:count]
+
+    def submit(self, senders, recipient):
+        for sender in senders:
+            self.blockchain.add_balance(sender, 10)
+            self.assertTrue(self.blockchain.add_transaction(Transaction(sender, recipient, 1)))
+
+    def check_mempools_follow_routing(self, expected):
+        pending = [(shard.shard_id, tx) for shard in self.blockchain.shards for tx in shard.pending_transactions]
+        self.assertEqual(len(pending), expected)
+        for shard_id, tx in pending:
+            self.assertEqual(shard_id, self.coordinator.get_shard_id(tx.sender))
+
+    def test_hot_arcs_move_to_cold_shards_with_their_mempool(self):
+        senders = self.addresses_on(0, 300, "sender")
+        (recipient,) = self.addresses_on(0, 1, "recipient")
+        self.submit(senders, recipient)
+        record = self.rebalancer.rebalance()
+        self.assertTrue(record["moves"])
+        self.assertIsNone(record["merged"], "Idle shards take load instead of being merged")
+        self.assertGreater(record["moved_transactions"], 0)
+        self.check_mempools_follow_routing(300)
+        counts = [sum(1 for s in senders if self.coordinator.get_shard_id(s) == shard_id) for shard_id in range(3)]
+        self.assertLessEqual(max(counts), 1.5 * 100, counts)
+        self.assertEqual(self.coordinator.arc_load, [0] * len(self.coordinator.arc_load), "Statistics restart per epoch")
+
+    def test_undelivered_receipts_follow_recipient(self):
+        (sender,) = self.addresses_on(0, 1, "sender")
+        (recipient,) = self.addresses_on(1, 1, "recipient")
+        self.submit([sender], recipient)
+        arc = self.coordinator.locate(recipient)
+        self.coordinator.on_block(0, self.blockchain.shards[0].create_block("Miner"))
+        self.assertEqual(self.coordinator.pending_receipts[1], 1)
+        handoff = self.coordinator.reassign_arcs({arc: 2})
+        self.assertEqual(handoff["moved_receipts"], 1)
+        self.assertEqual(self.coordinator.pending_receipts, {0: 0, 1: 0, 2: 1})
+        self.assertEqual(self.coordinator.apply_receipts(1), 0)
+        self.assertEqual(self.coordinator.apply_receipts(2), 1)
+        self.assertEqual(self.blockchain.get_balance(recipient), 1)
+
+    def test_prepared_transfers_defer_the_epoch(self):
+        (sender,) = self.addresses_on(0, 1, "sender")
+        (recipient,) = self.addresses_on(1, 1, "recipient")
+        self.blockchain.add_balance(sender, 10)
+        shards = self.blockchain.shards
+        self.assertTrue(self.coordinator.prepare_transaction(Transaction(sender, recipient, 1), shards[0], shards[1]))
+        self.assertIsNone(self.coordinator.reassign_arcs({0: 1}))
+        self.assertIsNone(self.rebalancer.on_round())
+        self.assertEqual(self.rebalancer.epoch, 0)
+
+    def test_saturated_shards_split(self):
+        for shard in self.blockchain.shards:
+            shard.max_block_transactions = 2
+            self.submit(self.addresses_on(shard.shard_id, 20, f"sender{shard.shard_id}"),
+                        self.addresses_on(shard.shard_id, 1, "recipient")[0])
+        self.blockchain.mine_all_shards("Miner")
+        record = self.rebalancer.history[-1]
+        self.assertEqual(record["split"], 3)
+        self.assertEqual(len(self.blockchain.shards), 4)
+        self.assertEqual(self.coordinator.active_shard_ids(), [0, 1, 2, 3])
+        self.check_mempools_follow_routing(54)
+        self.assertGreater(len(self.blockchain.shards[3].pending_transactions), 0)
+        self.assertEqual(len(self.blockchain.mine_all_shards("Miner")), 4)
+
+    def test_aborted_split_removes_the_new_shard(self):
+        for shard in self.blockchain.shards:
+            shard.max_block_transactions = 2
+            self.submit(self.addresses_on(shard.shard_id, 20, f"sender{shard.shard_id}"),
+                        self.addresses_on(shard.shard_id, 1, "recipient")[0])
+        with patch.object(self.coordinator, 'reassign_arcs', return_value=None):
+            self.blockchain.mine_all_shards("Miner")
+        self.assertEqual(self.rebalancer.epoch, 0)
+        self.assertEqual(len(self.blockchain.shards), 3, "The split is undone with the epoch")
+        self.assertEqual(sorted(self.coordinator.pending_receipts), [0, 1, 2])
+        self.blockchain.mine_all_shards("Miner")
+        self.assertEqual(self.rebalancer.history[-1]["split"], 3, "The next epoch splits again")
+        self.assertEqual(self.coordinator.active_shard_ids(), [0, 1, 2, 3])
+
+    def test_idle_shard_merges_when_balanced(self):
+        self.coordinator.arc_load = [0 if shard_id == 2 else 10 for shard_id in self.coordinator.ring_shards]
+        senders = self.addresses_on(2, 3, "sender")
+        for sender in senders:
+            self.blockchain.shards[2].add_transaction(Transaction(sender, "Bob", 1))
+        record = self.rebalancer.rebalance()
+        self.assertEqual(record["merged"], 2)
+        self.assertEqual(self.coordinator.active_shard_ids(), [0, 1])
+        self.check_mempools_follow_routing(3)
+
+
+class TestAIRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.blockchain = EnhancedQuantumFuseBlockchain(num_shards=3, difficulty=1)
+        self.coordinator = self.blockchain.cross_shard_coordinator
+
+    def tearDown(self):
+        self.blockchain.close()
+
+    def test_batch_routes_to_active_shards_in_one_pass(self):
+        service = self.blockchain.enable_ai_routing()
+        transactions = [Transaction(f"sender-{i}", f"recipient-{i}", 1 + i) for i in range(200)]
+        features = service.featurize(transactions)
+        self.assertEqual(features.shape, (200, 10))
+        shards = service.route(transactions)
+        self.assertTrue(set(shards) <= {0, 1, 2}, "The model has 5 outputs but only 3 shards exist")
+        self.assertEqual(service.metrics()["batches"], 1)
+        for transaction, shard_id in zip(transactions, shards):
+            self.assertEqual(self.coordinator.get_shard_id(transaction.sender), shard_id)
+
+    def test_placement_is_sticky_and_used_for_ingest(self):
+        self.blockchain.add_balance("Alice", 10)
+        self.coordinator.assign_shards({"Alice": 2})
+        self.assertEqual(self.coordinator.assign_shards({"Alice": 0}), 0, "Existing pins are kept")
+        self.assertEqual(self.coordinator.assign_shards({"Alice": 7}, replace=True), 0, "Unknown shards are ignored")
+        self.assertEqual(self.blockchain.add_transactions([Transaction("Alice", "Alice", 1),
+                                                           Transaction("Alice", "Bob", 100)]), [True, False])
+        self.assertEqual(len(self.blockchain.shards[2].pending_transactions), 1)
+
+    def test_queue_micro_batches_concurrent_submissions(self):
+        service = self.blockchain.enable_ai_routing(max_delay=0.05)
+        transactions = [Transaction(f"sender-{i}", "Bob", 1) for i in range(40)]
+        futures = [service.submit(transaction) for transaction in transactions]
+        shards = [future.result(timeout=5) for future in futures]
+        self.assertEqual(shards, [self.coordinator.get_shard_id(tx.sender) for tx in transactions])
+        self.assertLess(service.metrics()["batches"], 40)
+
+    def test_torchscript_matches_eager_model(self):
+        optimizer = self.blockchain.ai_optimizer
+        compiled = optimizer.RoutingService.compile(optimizer.transaction_routing_model.eval())
+        features = torch.rand(8, 10)
+        with torch.inference_mode():
+            self.assertTrue(torch.allclose(compiled(features), optimizer.transaction_routing_model(features)))
+        self.assertIsInstance(optimizer.optimize_transaction_routing(features[0]), int)
+        self.assertEqual(len(optimizer.optimize_transaction_routing(features)), 8)
+
+
+class TestConsensusEfficiencyModel(unittest.TestCase):
+
+    def make_model(self, **options):
+        model = EnhancedQuantumFuseBlockchain.AIOptimizer.ConsensusEfficiencyModel(n_estimators=10, **options)
+        self.addCleanup(model.shutdown)
+        return model
+
+    def feed(self, pow_engine, blocks):
+        # Block time is fastest to the target at difficulty 3 in this synthetic workload.
+        for i in range(blocks):
+            pow_engine.difficulty = 1 + i % 5
+            pow_engine.record_block(pow_engine.target_block_time * 2 ** (pow_engine.difficulty - 3), "solar")
+        pow_engine.block_times, pow_engine.block_energy = [], []
+
+    def test_ring_buffer_keeps_latest_samples(self):
+        model = self.make_model(buffer_size=8, retrain_interval=10**9)
+        for i in range(20):
+            model.record([i, 0.0], i / 20)
+        features, scores = model.samples()
+        self.assertEqual(len(features), 8)
+        self.assertEqual(sorted(features[:, 0]), list(range(12, 20)))
+
+    def test_background_retrain_swaps_model(self):
+        model = self.make_model(retrain_interval=50, min_samples=50)
+        pow_engine = EnhancedQuantumFuseBlockchain.GreenConsensus.GreenProofOfWork(initial_difficulty=1)
+        pow_engine.efficiency_model = model
+        self.feed(pow_engine, 49)
+        self.assertIsNone(model.training)
+        self.feed(pow_engine, 1)
+        model.wait(timeout=30)
+        self.assertTrue(model.ready)
+        self.assertEqual(model.version, 1)
+        scores = model.predict([pow_engine.consensus_features(d, ["solar"]) for d in (1, 3, 5)])
+        self.assertEqual(scores.shape, (3,))
+        self.assertEqual(int(scores.argmax()), 1)
+
+    def test_adjust_difficulty_uses_predictions(self):
+        model = self.make_model(retrain_interval=10**9, background=False)
+        pow_engine = EnhancedQuantumFuseBlockchain.GreenConsensus.GreenProofOfWork(initial_difficulty=1,
+                                                                                  adjustment_interval=2)
+        pow_engine.efficiency_model = model
+        self.feed(pow_engine, 100)
+        pow_engine.difficulty = 1
+        pow_engine.adjust_difficulty()
+        self.assertEqual(pow_engine.difficulty, 1, "Nothing changes before the adjustment interval")
+        model.retrain()
+
+        def adjust(difficulty, block_time):
+            pow_engine.difficulty = difficulty
+            pow_engine.record_block(pow_engine.target_block_time * block_time, "solar")
+            pow_engine.record_block(pow_engine.target_block_time * block_time, "wind")
+            pow_engine.adjust_difficulty()
+            self.assertEqual(pow_engine.block_energy, [])
+            return pow_engine.difficulty
+
+        self.assertEqual(adjust(4, 2), 3)
+        self.assertEqual(adjust(3, 0.9), 3, "The model vetoes a step away from its most efficient difficulty")
+        self.assertEqual(adjust(5, 0.5), 6, "Blocks faster than the target never lower the difficulty")
+
+    def test_difficulty_never_falls_while_blocks_are_fast(self):
+        # Each difficulty level makes blocks 16x slower; at difficulty 4 they land at 0.6x the target,
+        # so the most efficient difficulty is 4 and nothing below it is ever warranted.
+        model = self.make_model(retrain_interval=50, min_samples=20, background=False)
+        pow_engine = EnhancedQuantumFuseBlockchain.GreenConsensus.GreenProofOfWork(initial_difficulty=4,
+                                                                                  adjustment_interval=10)
+        pow_engine.efficiency_model = model
+        rng = np.random.default_rng(7)
+        difficulties = []
+        for _ in range(1000):
+            speed = 0.6 * 16.0 ** (pow_engine.difficulty - 4) * rng.uniform(0.5, 1.5)
+            pow_engine.record_block(pow_engine.target_block_time * speed, "solar")
+            pow_engine.adjust_difficulty()
+            difficulties.append(pow_engine.difficulty)
+        self.assertGreater(model.version, 10)
+        self.assertEqual(min(difficulties), 4)
+        self.assertLessEqual(max(difficulties), 5)
+
+    def test_model_persists_across_restarts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "efficiency_model.pkl")
+            model = self.make_model(model_path=path, background=False)
+            for i in range(40):
+                model.record([i % 4, 1.0], (i % 4) / 4)
+            model.retrain()
+            restored = self.make_model(model_path=path)
+            self.assertTrue(restored.ready)
+            self.assertEqual(restored.version, 1)
+            self.assertEqual(restored.predict_efficiency([2, 1.0]), model.predict_efficiency([2, 1.0]))
+
+
+class TestDecentralizedExchange(unittest.TestCase):
+
+    def setUp(self):
+        self.exchange = EnhancedQuantumFuseBlockchain.DecentralizedExchange()
+        self.events = []
+        self.exchange.subscribe(self.events.append)
+
+    def test_price_time_priority_and_partial_fills(self):
+        first = self.exchange.place_order("Alice", "QFT", 5, 10.0, is_buy=False)
+        second = self.exchange.place_order("Bob", "QFT", 5, 10.0, is_buy=False)
+        cheaper = self.exchange.place_order("Carol", "QFT", 2, 9.5, is_buy=False)
+        taker = self.exchange.place_order("Dave", "QFT", 10, 10.0, is_buy=True)
+        self.assertEqual([(t["sell_order_id"], t["price"], t["amount"]) for t in self.events],
+                         [(cheaper, 9.5, 2), (first, 10.0, 5), (second, 10.0, 3)])
+        self.assertIsNone(self.exchange.get_order(taker), "A filled taker does not rest")
+        self.assertEqual(self.exchange.get_order(second)["amount"], 2)
+        self.assertEqual(self.exchange.order_book["QFT"].depth(), {"bids": [], "asks": [(10.0, 2, 1)]})
+
+    def test_remainder_rests_and_cancel_is_skipped(self):
+        bid = self.exchange.place_order("Alice", "QFT", 4, 8.0, is_buy=True)
+        cancelled = self.exchange.place_order("Bob", "QFT", 3, 8.0, is_buy=True)
+        later = self.exchange.place_order("Carol", "QFT", 3, 8.0, is_buy=True)
+        self.assertTrue(self.exchange.cancel_order(cancelled))
+        self.assertFalse(self.exchange.cancel_order(cancelled))
+        self.assertEqual(self.exchange.order_book["QFT"].depth()["bids"], [(8.0, 7, 2)])
+        self.exchange.place_order("Dave", "QFT", 6, 7.0, is_buy=False)
+        self.assertEqual([(t["buy_order_id"], t["amount"], t["price"]) for t in self.events],
+                         [(bid, 4, 8.0), (later, 2, 8.0)])
+        self.assertEqual(self.exchange.get_order(later)["filled"], 2)
+
+    def test_match_orders_uncrosses_resting_orders(self):
+        sell = self.exchange.place_order("Alice", "QFT", 5, 9.0, is_buy=False, match=False)
+        self.exchange.place_order("Bob", "QFT", 8, 11.0, is_buy=True, match=False)
+        trades = self.exchange.match_orders("QFT")
+        self.assertEqual([(t["amount"], t["price"], t["maker_order_id"]) for t in trades], [(5, 9.0, sell)])
+        self.assertEqual(self.exchange.order_book["QFT"].depth(), {"bids": [(11.0, 3, 1)], "asks": []})
+        self.assertEqual(self.exchange.match_orders("unknown"), [])
+
+    def test_submit_batch_matches_sequential_calls(self):
+        sequential = EnhancedQuantumFuseBlockchain.DecentralizedExchange()
+        resting = self.exchange.place_order("Maker", "QFT", 5, 10.0, is_buy=False)
+        sequential.place_order("Maker", "QFT", 5, 10.0, is_buy=False)
+        users, amounts, prices, sides = ["A", "B", "C"], [3, 4, 2], [10.0, 10.5, 9.0], [True, True, False]
+        result = self.exchange.submit_batch("QFT", users, amounts, prices, sides, cancels=[resting + 100])
+        for args in zip(users, amounts, prices, sides):
+            sequential.place_order(args[0], "QFT", *args[1:])
+        self.assertEqual(result["cancelled"].tolist(), [False])
+        self.assertEqual(result["filled"].tolist(), [3, 4, 2])
+        self.assertEqual(result["remaining"].tolist(), [0, 0, 0], "C fills the part of B that rested")
+        self.assertEqual(result["fills"]["price"].tolist(), [10.0, 10.0, 10.5])
+        self.assertEqual(result["fills"]["amount"].tolist(), [3, 2, 2])
+        self.assertEqual(self.exchange.order_book["QFT"].depth(), sequential.order_book["QFT"].depth())
+        with self.assertRaises(ValueError):
+            self.exchange.submit_batch("QFT", ["A"], [1, 2], [1.0], [True])
+
+    def test_batch_cancels_only_its_own_token(self):
+        other = self.exchange.place_order("Maker", "NFT", 5, 10.0, is_buy=False)
+        own = self.exchange.place_order("Maker", "QFT", 5, 10.0, is_buy=False)
+        result = self.exchange.submit_batch("QFT", [], [], [], [], cancels=[other, own])
+        self.assertEqual(result["cancelled"].tolist(), [False, True])
+        self.assertIsNotNone(self.exchange.get_order(other), "Another token's order stays on its book")
+        self.assertIsNone(self.exchange.get_order(own))
+
+    def test_uniform_price_auction(self):
+        self.exchange.set_auction_mode("QFT")
+        bids = self.exchange.submit_batch("QFT", ["A", "B", "C"], [10, 5, 5], [11.0, 10.0, 9.0], [True] * 3)
+        asks = self.exchange.submit_batch("QFT", ["D", "E", "F"], [8, 4, 10], [9.0, 10.0, 12.0], [False] * 3)
+        self.assertEqual(bids["filled"].sum() + asks["filled"].sum(), 0, "Auction tokens do not match on arrival")
+        result = self.exchange.run_auction("QFT")
+        self.assertEqual((result["price"], result["volume"]), (10.0, 12))
+        a, b, _ = bids["order_id"].tolist()
+        d, e, _ = asks["order_id"].tolist()
+        fills = result["fills"]
+        self.assertEqual(list(zip(fills["buy_order_id"].tolist(), fills["sell_order_id"].tolist(),
+                                  fills["amount"].tolist())), [(a, d, 8), (a, e, 2), (b, e, 2)])
+        self.assertTrue((fills["price"] == 10.0).all())
+        self.assertEqual(self.exchange.order_book["QFT"].depth(),
+                         {"bids": [(10.0, 3, 1), (9.0, 5, 1)], "asks": [(12.0, 10, 1)]})
+        self.assertEqual(self.exchange.run_auction("QFT")["volume"], 0)
+
+    def test_rejects_invalid_orders(self):
+        with self.assertRaises(ValueError):
+            self.exchange.place_order("Alice", "QFT", 0, 1.0, is_buy=True)
+
+
+class TestNFTMarketplace(unittest.TestCase):
+
+    def setUp(self):
+        self.market = EnhancedQuantumFuseBlockchain.NFTMarketplace()
+        self.market.mint_many((f"nft-{i}", "Alice" if i % 2 else "Bob", {"i": i}) for i in range(10))
+
+    def test_owner_index_follows_transfers(self):
+        self.assertEqual(self.market.balance_of("Alice"), 5)
+        self.assertEqual(self.market.transfer_many([("nft-1", "Alice", "Carol"), ("nft-2", "Alice", "Carol"),
+                                                    ("nft-3", "Alice", "Carol")]), [True, False, True])
+        self.assertEqual(self.market.tokens_of_owner("Carol"), ["nft-1", "nft-3"])
+        self.assertEqual(self.market.tokens_of_owner("Alice"), ["nft-5", "nft-7", "nft-9"])
+        self.assertEqual(self.market.tokens_of_owner("Alice", offset=1, limit=1), ["nft-7"])
+        self.assertEqual(self.market.fractions_of_holder("Carol"), [("nft-1", 1.0), ("nft-3", 1.0)])
+        self.assertEqual(self.market.mint_many([("nft-1", "Dave", {})]), [False])
+
+    def test_collections_reject_duplicates(self):
+        self.market.create_collection("art", "Alice")
+        self.assertTrue(self.market.add_nft_to_collection("nft-1", "art"))
+        self.assertFalse(self.market.add_nft_to_collection("nft-1", "art"))
+        self.assertTrue(self.market.add_nft_to_collection("nft-4", "art"))
+        self.assertEqual(self.market.tokens_in_collection("art"), ["nft-1", "nft-4"])
+        self.assertEqual(self.market.tokens_in_collection("missing"), [])
+
+    def test_fixed_point_fractions(self):
+        self.assertTrue(self.market.fractionalize_nft("nft-1", {"Alice": 0.1, "Bob": 0.2, "Carol": 0.7}),
+                        "0.1 + 0.2 + 0.7 is not exactly 1.0 in floating point")
+        self.assertFalse(self.market.fractionalize_nft("nft-1", {"Alice": 0.5, "Bob": 0.4}))
+        self.assertEqual(self.market.fraction_of("nft-1", "Carol"), 0.7)
+        self.assertIn(("nft-1", 0.2), self.market.fractions_of_holder("Bob"))
+        self.assertTrue(self.market.transfer_fraction("nft-1", "Alice", "Dave", 0.1))
+        self.assertFalse(self.market.transfer_fraction("nft-1", "Alice", "Dave", 0.1))
+        self.assertNotIn("nft-1", self.market.holder_index["Alice"])
+        self.assertEqual(self.market.fractions_of_holder("Dave"), [("nft-1", 0.1)])
+        self.assertEqual(sum(self.market.nfts["nft-1"]["fractions"].values()), self.market.FRACTION_UNITS)
+
+    def test_thirds_split_into_whole_units(self):
+        self.assertTrue(self.market.fractionalize_nft("nft-1", {"Alice": 1 / 3, "Bob": 1 / 3, "Carol": 1 / 3}))
+        units = self.market.nfts["nft-1"]["fractions"]
+        self.assertEqual(sum(units.values()), self.market.FRACTION_UNITS)
+        self.assertEqual(sorted(units.values()), [333_333_333, 333_333_333, 333_333_334])
+        self.assertFalse(self.market.fractionalize_nft("nft-1", {"Alice": 1 / 3, "Bob": 1 / 3}))
+
+
+class TestLayer2StateChannels(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = [rsa.generate_private_key(public_exponent=65537, key_size=2048) for _ in range(2)]
+
+    def setUp(self):
+        self.state = StateStore()
+        self.identities = EnhancedQuantumFuseBlockchain.DecentralizedIdentity()
+        for user, key in zip(("Alice", "Bob", "Carol", "Dave", "Erin"), self.keys * 3):
+            self.identities.create_identity(user, key.public_key())
+        for user in ("Alice", "Bob", "Carol", "Dave"):
+            self.state.credit("QFC", user, 100)
+        self.layer2 = EnhancedQuantumFuseBlockchain.Layer2Solution(self.state, self.identities)
+        self.channel_id = self.layer2.open_state_channel("Alice", "Bob", 50,
+                                                         [key.public_key() for key in self.keys])
+
+    def signed(self, nonce, balances, channel_id=None):
+        channel_id = channel_id or self.channel_id
+        return (channel_id, nonce, balances,
+                [self.layer2.sign_update(key, channel_id, nonce, balances) for key in self.keys])
+
+    def test_signed_updates_are_nonce_ordered(self):
+        _, nonce, balances, signatures = self.signed(2, (40, 60))
+        self.assertEqual(self.layer2.update_state_channel(self.channel_id, {"Alice": 40, "Bob": 60}, nonce,
+                                                          signatures), 2)
+        _, _, _, stale = self.signed(1, (10, 90))
+        with self.assertRaises(ValueError):
+            self.layer2.update_state_channel(self.channel_id, {"Alice": 10, "Bob": 90}, 1, stale)
+        with self.assertRaises(ValueError):
+            self.layer2.update_state_channel(self.channel_id, {"Alice": 10, "Bob": 90}, 3, signatures)
+        with self.assertRaises(ValueError, msg="Unsigned updates are rejected"):
+            self.layer2.update_state_channel(self.channel_id, {"Alice": 10, "Bob": 90}, 3)
+        _, _, _, unbalanced = self.signed(3, (40, 70))
+        with self.assertRaises(ValueError):
+            self.layer2.update_state_channel(self.channel_id, {"Alice": 40, "Bob": 70}, 3, unbalanced)
+        self.assertEqual(self.layer2.get_channel(self.channel_id).balances, (40, 60))
+
+    def test_bulk_updates_keep_latest_valid_state(self):
+        other = self.layer2.open_state_channel("Carol", "Dave", 10)  # Keys come from the identity registry.
+        forged = self.signed(5, (0, 100))
+        forged = forged[:3] + ([forged[3][0], forged[3][0]],)
+        updates = [self.signed(n, (50 - n, 50 + n)) for n in range(1, 5)] + [forged]
+        updates += [self.signed(1, (5, 15), other), (other, 2, (0, 20), None), ("missing", 1, (1, 1), None)]
+        self.assertEqual(self.layer2.apply_updates(updates), 2)
+        channel = self.layer2.get_channel(self.channel_id)
+        self.assertEqual((channel.nonce, channel.balances), (4, (46, 54)))
+        self.assertEqual(self.layer2.get_channel(other).balances, (5, 15), "The unsigned update is rejected")
+        self.assertEqual(self.layer2.stats["verified"], 3, "Superseded updates skip signature checks")
+        self.assertEqual(self.layer2.stats["superseded"], 3)
+        self.assertEqual(self.layer2.stats["rejected"], 3)
+
+    def test_settlements_batch_per_block(self):
+        self.layer2.apply_updates([self.signed(1, (30, 70))])
+        self.layer2.open_state_channel("Alice", "Carol", 5)
+        final = self.layer2.close_state_channel(self.channel_id)
+        self.assertEqual(final["balance"], {"Alice": 30, "Bob": 70})
+        self.assertEqual(self.state.get_balance("QFC", "Alice"), 45, "Deposits are locked when a channel opens")
+        settlement = self.layer2.settle("block-1")
+        self.assertEqual((settlement["opens"], settlement["closes"]), (2, 1))
+        self.assertEqual(self.state.get_balance("QFC", "Alice"), 75)
+        self.assertEqual(self.state.get_balance("QFC", "Bob"), 120)
+        self.assertEqual(self.state.get_balance("QFC", self.layer2.ESCROW), 10)
+        self.assertIsNone(self.layer2.settle("block-2"))
+        with self.assertRaises(ValueError):
+            self.layer2.close_state_channel(self.channel_id)
+
+    def test_open_requires_both_deposits(self):
+        with self.assertRaises(ValueError):
+            self.layer2.open_state_channel("Alice", "Erin", 10)
+        with self.assertRaises(ValueError):
+            self.layer2.open_state_channel("Carol", "Dave", 150)
+        self.assertEqual([self.state.get_balance("QFC", user) for user in ("Alice", "Carol", "Dave", "Erin")],
+                         [50, 100, 100, 0], "A rejected open locks nothing")
+        self.assertEqual(len(self.layer2.state_channels), 1)
+
+    def test_open_requires_both_keys(self):
+        self.state.credit("QFC", "Mallory", 100)
+        with self.assertRaises(ValueError):
+            self.layer2.open_state_channel("Alice", "Mallory", 10)
+        with self.assertRaises(ValueError):
+            EnhancedQuantumFuseBlockchain.Layer2Solution(self.state).open_state_channel("Alice", "Bob", 10)
+        self.assertEqual([self.state.get_balance("QFC", user) for user in ("Alice", "Bob", "Mallory")],
+                         [50, 50, 100], "A rejected open locks nothing")
+
+    def test_block_commits_settlement(self):
+        blockchain = EnhancedQuantumFuseBlockchain(num_shards=1, difficulty=1)
+        self.addCleanup(blockchain.close)
+        blockchain.consensus.green_pow.difficulty = 1
+        blockchain.add_balance("Alice", 100)
+        blockchain.add_balance("Bob", 100)
+        blockchain.state.commit_block()
+        for user, key in zip(("Alice", "Bob"), self.keys):
+            blockchain.identity_manager.create_identity(user, key.public_key())
+        blockchain.layer2_solution.open_state_channel("Alice", "Bob", 25)
+        blockchain.shards[0].add_transaction(Transaction("Alice", "Carol", 1))
+        block = blockchain.mine_block("Miner")
+        self.assertEqual(blockchain.layer2_solution.settlements[-1]["block_hash"], block.hash)
+        self.assertEqual(blockchain.state.get_balance("QFC", blockchain.layer2_solution.ESCROW), 50)
+        self.assertEqual(blockchain.get_qfc_balance("Bob"), 75)
+        self.assertNotIn(blockchain.layer2_solution.LOCK_TAG, blockchain.state.pending, "The block commits the locks")
+
+
+class TestRollup(unittest.TestCase):
+
+    def setUp(self):
+        self.state = StateStore()
+        self.state.credit("QFC", "Alice", 100)
+        self.state.credit("QFC", "Bob", 10)
+        self.layer2 = EnhancedQuantumFuseBlockchain.Layer2Solution(self.state)
+        self.assertTrue(self.layer2.deposit_to_rollup("Alice", 100))
+        self.assertTrue(self.layer2.deposit_to_rollup("Bob", 10))
+        self.first = self.layer2.create_rollup_batch()
+        for i in range(20):
+            self.layer2.submit_l2_transfer("Alice", f"user-{i % 4}", 2)
+        self.layer2.submit_l2_transfer("Bob", "Alice", 50)
+        self.layer2.submit_l2_transfer("Nobody", "Alice", 1)
+        self.layer2.submit_l2_transfer("Bob", "Alice", 0)
+        self.second = self.layer2.create_rollup_batch()
+
+    def test_batches_apply_valid_transfers(self):
+        self.assertEqual((self.first["count"], self.second["count"]), (2, 20))
+        self.assertEqual(self.layer2.stats["rollup_rejected"], 3)
+        rollup = self.layer2.rollup_state
+        self.assertEqual(rollup.balance_of("Alice"), 60)
+        self.assertEqual(rollup.balance_of("user-3"), 10)
+        self.assertEqual(self.second["pre_root"], self.first["post_root"])
+        addresses, ops = self.layer2.decode_rollup_delta(self.second["delta"])
+        self.assertEqual(addresses, ["user-0", "user-1", "user-2", "user-3"])
+        self.assertEqual(ops[0], (rollup.TRANSFER, 0, 2, 2.0))
+        self.assertLess(self.second["posted_bytes"], 20 * self.layer2.ROLLUP_OP.size)
+        leaf, proof = rollup.get_proof("user-1")
+        self.assertTrue(MerkleTree.verify_proof(leaf, proof, self.second["post_root"]))
+        self.assertIsNone(self.layer2.create_rollup_batch(), "Nothing queued")
+
+    def test_replay_detects_fraud(self):
+        state, bad = self.layer2.replay_rollup()
+        self.assertIsNone(bad)
+        self.assertEqual(state.root, self.layer2.rollup_state.root)
+        self.assertIsNone(self.layer2.rollup_fraud_proof(1))
+        forged = dict(self.second)
+        forged["post_root"] = self.first["post_root"]
+        self.layer2.rollup_batches[1] = forged
+        self.assertEqual(self.layer2.replay_rollup()[1], 1)
+        proof = self.layer2.rollup_fraud_proof(1)
+        self.assertEqual(proof["computed_root"], self.second["post_root"])
+        # A sequencer that spends more than an account holds is caught by re-execution too.
+        overdraft = EnhancedQuantumFuseBlockchain.Layer2Solution.ROLLUP_OP.pack(0, 1, 0, 1000.0)
+        forged["delta"] = zlib.compress(zlib.decompress(self.second["delta"]) + overdraft)
+        forged["post_root"] = self.second["post_root"]
+        self.assertIsNone(self.layer2.rollup_fraud_proof(1)["computed_root"])
+
+    def test_settle_posts_batches_and_deposits(self):
+        settlement = self.layer2.settle("block-1")
+        self.assertEqual(settlement["rollups"], [0, 1])
+        self.assertEqual(settlement["rollup_bytes"], self.first["posted_bytes"] + self.second["posted_bytes"])
+        self.assertEqual(self.second["block_hash"], "block-1")
+        self.assertEqual(self.state.get_balance("QFC", "Alice"), 0)
+        self.assertEqual(self.state.get_balance("QFC", self.layer2.ESCROW), 110)
+        self.assertIsNone(self.layer2.settle("block-2"))
+
+    def test_deposits_must_be_covered(self):
+        self.assertFalse(self.layer2.deposit_to_rollup("Carol", 500))
+        self.assertFalse(self.layer2.deposit_to_rollup("Alice", 1), "Alice's balance is already in escrow")
+        self.assertIsNone(self.layer2.create_rollup_batch(), "Rejected deposits are never queued")
+        self.assertEqual(self.state.get_balance("QFC", "Carol"), 0)
+        self.assertEqual(self.layer2.rollup_state.balance_of("Carol"), 0)
+        self.assertEqual(self.layer2.stats["rollup_rejected"], 5)
+
+
+class TestAMLScreening(unittest.TestCase):
+
+    NOW = 1_700_000_000.0
+
+    def setUp(self):
+        self.compliance = EnhancedQuantumFuseBlockchain.ComplianceTools(
+            window=3600, short_window=60, buckets=60, max_velocity=3, max_volume=30_000, structuring_count=3)
+        self.screener = self.compliance.aml_screener
+
+    def test_rolling_rules_within_and_across_batches(self):
+        masks = self.screener.screen(["Alice"] * 5 + ["Bob"], [1, 1, 1, 1, 20_000, 9_500], self.NOW)
+        self.assertEqual([self.screener.reasons(int(mask)) for mask in masks],
+                         [(), (), (), ("velocity",), ("large", "velocity"), ()])
+        # The 60s velocity window has passed but the hourly volume and structuring windows have not.
+        masks = self.screener.screen(["Bob", "Bob", "Alice"], [9_500, 9_500, 9_999], self.NOW + 120)
+        self.assertEqual([self.screener.reasons(int(mask)) for mask in masks],
+                         [(), ("structuring",), ("volume",)])
+        masks = self.screener.screen(["Alice", "Bob"], [1, 9_500], self.NOW + 3 * 3600)
+        self.assertEqual(masks.tolist(), [0, 0], "Buckets outside the window are ignored")
+
+    def test_bounded_memory_evicts_least_recent(self):
+        compliance = EnhancedQuantumFuseBlockchain.ComplianceTools(capacity=4, max_velocity=2)
+        screener = compliance.aml_screener
+        screener.screen(["a", "a"], [1, 1], self.NOW)
+        masks = screener.screen([f"user-{i}" for i in range(6)] + ["a"], [1] * 7, self.NOW)
+        self.assertEqual(masks.tolist(), [0] * 7, "a was evicted, so its history is gone")
+        self.assertEqual(len(screener.slots), 4)
+        self.assertEqual(screener.stats["evicted"], 3 + 1)
+
+    def test_blocking_rules_and_alert_records(self):
+        self.screener.set_blocking("large")
+        transactions = [Transaction("Alice", "Bob", 50_000), Transaction("Carol", "Bob", 10)]
+        self.assertEqual(self.compliance.screen_batch(transactions), [False, True])
+        self.assertFalse(self.compliance.screen(Transaction("Alice", "Bob", 60_000)))
+        self.assertEqual(self.compliance.aml_checks["Alice"]["count"], 2)
+        self.assertEqual(self.compliance.aml_checks["Alice"]["reasons"], {"large": 2, "volume": 2})
+        self.screener.add_rule("self_transfer", lambda f: f["amount"] == 7)
+        self.screener.screen_transactions([Transaction("Dave", "Dave", 7)])
+        self.assertEqual(self.compliance.aml_checks["Dave"]["reasons"], {"self_transfer": 1})
+
+    def test_deferred_screening_in_ingest_path(self):
+        blockchain = EnhancedQuantumFuseBlockchain(num_shards=1, difficulty=1)
+        self.addCleanup(blockchain.close)
+        screener = blockchain.compliance_tools.aml_screener
+        screener.batch_size, screener.budget_us = 4, 0.0
+        blockchain.add_balance("Alice", 100_000)
+        for _ in range(3):
+            self.assertTrue(blockchain.add_transaction(Transaction("Alice", "Bob", 10_000)))
+        self.assertEqual(screener.metrics()["pending"], 3)
+        self.assertEqual(blockchain.add_transactions([Transaction("Alice", "Bob", 1)]), [True])
+        self.assertTrue(blockchain.add_transaction(Transaction("Alice", "Bob", 1)))
+        self.assertEqual(screener.stats["screened"], 5)
+        self.assertEqual(screener.batch_size, 8, "Over budget, so the micro-batch grows")
+        self.assertEqual(blockchain.compliance_tools.aml_checks["Alice"]["reasons"]["large"], 3)
+
+
+class TestTransactionGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = TransactionGraph()
+        block = Block(1, [Transaction("A", "B", 60), Transaction("A", "C", 40), Transaction("B", "D", 30),
+                          Transaction("C", "D", 40), Transaction("D", "E", 50), Transaction("X", "Y", 5),
+                          Transaction("Network", "A", 100)], "0")
+        self.graph.add_block(block)
+        self.graph.add_block(Block(2, [Transaction("A", "B", 40)], "0"))
+
+    def test_edges_accumulate(self):
+        edge = self.graph.graph["A"]["B"]
+        self.assertEqual((edge["amount"], edge["count"], edge["last_block"]), (100, 2, 2))
+        self.assertNotIn("Network", self.graph.graph)
+
+    def test_neighborhoods(self):
+        self.assertEqual(self.graph.neighborhood("A", 2, "out"), {"A": 0, "B": 1, "C": 1, "D": 2})
+        self.assertEqual(self.graph.neighborhood("D", 1, "in"), {"D": 0, "B": 1, "C": 1})
+        self.assertEqual(set(self.graph.neighborhood("B", 2)), {"A", "B", "C", "D", "E"})
+        self.assertEqual(len(self.graph.neighborhood("A", 3, limit=2)), 2)
+        self.assertEqual(self.graph.neighborhood("missing"), {})
+
+    def test_fund_flow(self):
+        traced = self.graph.trace_funds("A", hops=3)
+        # B received 100 of A's 140 and passed all of it on; C received 40.
+        self.assertAlmostEqual(traced["B"], 100)
+        self.assertAlmostEqual(traced["D"], 140)
+        self.assertAlmostEqual(traced["E"], 140)
+        self.assertNotIn("E", self.graph.trace_funds("A", hops=2))
+        self.assertEqual(self.graph.max_flow("A", "D"), 70)
+        self.assertEqual(self.graph.max_flow("A", "Y"), 0)
+
+    def test_components_and_csr(self):
+        self.assertEqual(self.graph.component_count, 2)
+        self.assertEqual(sorted(self.graph.cluster("E")), ["A", "B", "C", "D", "E"])
+        self.assertNotEqual(self.graph.component_id("A"), self.graph.component_id("X"))
+        self.graph.add_transaction("Y", "E", 1)
+        self.assertEqual(self.graph.component_id("A"), self.graph.component_id("X"))
+        self.assertEqual(len(self.graph.clusters()[0]), 7)
+        indptr, indices, data, nodes = self.graph.to_csr()
+        matrix = np.zeros((len(nodes), len(nodes)))
+        for row in range(len(nodes)):
+            matrix[row, indices[indptr[row]:indptr[row + 1]]] = data[indptr[row]:indptr[row + 1]]
+        expected = nx.to_numpy_array(self.graph.graph, nodelist=nodes, weight="amount")
+        self.assertTrue(np.array_equal(matrix, expected))
+        sparse_matrix, _ = self.graph.to_sparse()
+        self.assertTrue(np.array_equal(sparse_matrix.toarray(), expected))
+
+    def test_chain_maintains_graph(self):
+        blockchain = EnhancedQuantumFuseBlockchain(num_shards=1, difficulty=1)
+        self.addCleanup(blockchain.close)
+        blockchain.consensus.green_pow.difficulty = 1
+        blockchain.add_balance("Alice", 10)
+        blockchain.add_transaction(Transaction("Alice", "Bob", 3))
+        blockchain.mine_block("Miner")
+        self.assertEqual(blockchain.transaction_graph.graph["Alice"]["Bob"]["amount"], 3)
+
+
+class TestDecentralizedIdentity(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = [rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key() for _ in range(3)]
+
+    def pem(self, i):
+        return EnhancedQuantumFuseBlockchain.DecentralizedIdentity.encode_public_key(self.keys[i])
+
+    def test_parsed_keys_are_cached_with_lru_eviction(self):
+        identities = EnhancedQuantumFuseBlockchain.DecentralizedIdentity(cache_size=2)
+        for i in range(3):
+            self.assertTrue(identities.create_identity(f"user-{i}", self.pem(i)))
+        self.assertFalse(identities.create_identity("user-0", self.pem(1)))
+        first = identities.get_public_key("user-0")
+        self.assertIs(identities.get_public_key("user-0"), first)
+        self.assertEqual(self.pem(0), identities.encode_public_key(first))
+        identities.get_public_keys(["user-1", "user-2"])
+        self.assertEqual(list(identities.key_cache), ["user-1", "user-2"])
+        self.assertEqual((identities.stats["hits"], identities.stats["misses"], identities.stats["evicted"]), (1, 3, 1))
+        self.assertIsNone(identities.get_public_key("nobody"))
+        identities["user-1"] = self.keys[0]
+        self.assertIs(identities.get_public_key("user-1"), self.keys[0], "Key objects are cached as given")
+        self.assertEqual(identities.identities["user-1"]["public_key"], self.pem(0))
+
+    def test_invalid_pem_is_rejected(self):
+        identities = EnhancedQuantumFuseBlockchain.DecentralizedIdentity()
+        truncated = self.pem(0)[:100]
+        with self.assertRaises(ValueError):
+            identities.create_identity("Alice", truncated)
+        self.assertNotIn("Alice", identities, "A rejected key creates no identity")
+        identities.create_identity("Alice", self.pem(0))
+        with self.assertRaises(ValueError):
+            identities.set_public_key("Alice", b"not a key")
+        self.assertEqual(identities.encode_public_key(identities.get_public_key("Alice")), self.pem(0))
+        identities.identities["Bob"] = {"public_key": truncated, "attributes": {}}
+        self.assertIsNone(identities.get_public_key("Bob"), "A stored key that does not parse is no key")
+
+    def test_bulk_attribute_verification(self):
+        identities = EnhancedQuantumFuseBlockchain.DecentralizedIdentity()
+        for i in range(3):
+            identities.create_identity(f"user-{i}", self.keys[i])
+            identities.add_attribute(f"user-{i}", "country", "NL" if i % 2 else "DE")
+        claims = [("user-0", "country", "DE"), ("user-1", "country", "DE"), ("user-2", "age", None),
+                  ("nobody", "country", "DE")]
+        self.assertEqual(identities.verify_attributes(claims), [True, False, False, False])
+        self.assertEqual([identities.verify_attribute(*claim) for claim in claims], [True, False, False, False])
+
+    def test_registry_persists(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            blockchain = EnhancedQuantumFuseBlockchain(num_shards=1, difficulty=1, data_dir=data_dir)
+            blockchain.identity_manager.create_identity("Alice", self.keys[0])
+            blockchain.identity_manager.add_attribute("Alice", "kyc", "verified")
+            blockchain.close()
+            reopened = EnhancedQuantumFuseBlockchain(num_shards=1, difficulty=1, data_dir=data_dir)
+            identities = reopened.identity_manager
+            self.assertTrue(identities.verify_attribute("Alice", "kyc", "verified"))
+            self.assertEqual(identities.encode_public_key(identities.get_public_key("Alice")), self.pem(0))
+            reopened.close()
 
 
 if __name__ == "__main__":